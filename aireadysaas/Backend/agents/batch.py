@@ -0,0 +1,79 @@
+"""
+Concurrent fan-out over the agents.
+
+``aask_many`` runs one agent over many prompts at once: at most
+``concurrency`` calls are in flight, each call still waits on the shared
+rate limiter, and results come back in input order. A failed prompt yields
+its exception in place of the text instead of failing the batch.
+"""
+import asyncio
+import importlib
+
+from django.conf import settings
+
+from .clients import aclose_clients
+
+# Agent name -> (module, async function)
+AGENTS = {
+    "claude": ("agents.claude_agent", "aask_claude"),
+    "claude_dev": ("agents.claude_agent", "aask_claude_dev"),
+    "claude_throttle": ("agents.claude_agent", "aask_claude_throttle"),
+    "openai": ("agents.openai_agent", "aask_openai"),
+    "openai_dev": ("agents.openai_agent", "aask_openai_dev"),
+    "openai_assistant": ("agents.openai_agent", "aask_openai_assistant"),
+}
+
+
+def _agent(provider):
+    try:
+        module, function = AGENTS[provider]
+    except KeyError:
+        raise ValueError(f"Unknown agent: {provider}") from None
+    return getattr(importlib.import_module(module), function)
+
+
+async def aask_many(prompts, provider="claude", concurrency=None, **kwargs):
+    """
+    Ask an agent several prompts concurrently.
+
+    Args:
+        prompts (list[str]): Prompts to send
+        provider (str): Agent name, a key of AGENTS (default: claude)
+        concurrency (int): Maximum calls in flight (default: AGENT_CONCURRENCY)
+        **kwargs: Passed to every call (e.g. temperature, max_tokens)
+
+    Returns:
+        list[str | Exception]: One result per prompt, in input order
+    """
+    ask = _agent(provider)
+    semaphore = asyncio.Semaphore(concurrency or getattr(settings, "AGENT_CONCURRENCY", 8))
+
+    async def one(prompt):
+        async with semaphore:
+            return await ask(prompt, **kwargs)
+
+    results = await asyncio.gather(*(one(prompt) for prompt in prompts), return_exceptions=True)
+    failed = sum(isinstance(result, Exception) for result in results)
+    if failed:
+        print(f"⚠️ {failed} of {len(results)} {provider} prompts failed")
+    return results
+
+
+def ask_many(prompts, provider="claude", concurrency=None, **kwargs):
+    """
+    Blocking wrapper around aask_many for synchronous code.
+
+    Runs its own event loop, so call aask_many directly from async code.
+
+    Returns:
+        list[str | Exception]: One result per prompt, in input order
+    """
+
+    async def run():
+        try:
+            return await aask_many(prompts, provider, concurrency, **kwargs)
+        finally:
+            # The async clients belong to this short-lived loop
+            await aclose_clients()
+
+    return asyncio.run(run())
@@ -1,18 +1,48 @@
 """
 Claude Agent with built-in rate limiting
-Rate limit: 1.3 seconds between requests
+Rate limit: shared requests/tokens per minute buckets (agents.rate_limit)
+Async variants (aask_*) use the SDK's async clients and the same limits
+Streaming variants (stream_*) yield the response text as it arrives
 """
-import time
+import asyncio
 import os
-from anthropic import Anthropic
+import time
 from django.conf import settings
+from utils.metrics import llm_call, observe_llm_call, observe_llm_tokens, observe_ttft
+from utils.tokens import count_tokens, token_ledger
+
+from .clients import get_async_client, get_client
+from .memo import memo_lookup, memo_store
+from .personas import PERSONAS, aask_persona, ask_persona, stream_persona
+from .rate_limit import get_limiter, stream_tokens_used
+from .retry import agent_failure, aretrying, retrying
+
+# Persona models and prompts, kept here for existing imports
+DEV_MODEL = PERSONAS["claude_dev"].model
+DEV_SYSTEM_PROMPT = PERSONAS["claude_dev"].system_prompt
+THROTTLE_MODEL = PERSONAS["claude_throttle"].model
+THROTTLE_SYSTEM_PROMPT = PERSONAS["claude_throttle"].system_prompt
+
 
-# Rate limiting state
-_last_request_time = 0
-_min_request_interval = 1.3  # seconds
+def _api_key():
+    api_key = getattr(settings, 'ANTHROPIC_API_KEY', None) or os.getenv("ANTHROPIC_API_KEY", "")
+    if not api_key:
+        raise ValueError("ANTHROPIC_API_KEY not found in settings or environment variables")
+    return api_key
 
 
-def ask_claude(prompt, model="claude-3-sonnet-20240229", temperature=0.2, max_tokens=1024):
+def ask_claude(
+    prompt,
+    model="claude-3-sonnet-20240229",
+    temperature=0.2,
+    max_tokens=1024,
+    estimated_tokens=None,
+    call="claude",
+    timeout=None,
+    block=True,
+    use_memo=None,
+    max_retries=None,
+):
     """
     Send a request to Claude API with built-in rate limiting.
     
@@ -21,100 +51,272 @@ def ask_claude(prompt, model="claude-3-sonnet-20240229", temperature=0.2, max_to
         model (str): The Claude model to use (default: claude-3-sonnet-20240229)
         temperature (float): Temperature setting (default: 0.2)
         max_tokens (int): Maximum tokens in response (default: 1024)
+        estimated_tokens (int): Prompt token estimate to record (default: counted here)
+        call (str): Name the call is recorded under in the token ledger
+        timeout (float): Request timeout in seconds (default: the SDK's own)
+        block (bool): Wait for rate limit capacity instead of raising (default: True)
+        use_memo (bool): Use the on-disk memo cache (default: AGENT_MEMO setting)
+        max_retries (int): Retries of transient failures (default: AGENT_MAX_RETRIES)
     
     Returns:
         str: Claude's response text
         
     Raises:
-        Exception: If API call fails
+        RateLimitExceeded: If block is False and the rate limit is exhausted
+        AgentBadRequest: If the provider rejects the request
+        AgentRateLimited, AgentOverloaded, AgentTimeout: If retries run out
     """
-    global _last_request_time
-    
-    # Enforce rate limiting
-    current_time = time.time()
-    time_since_last_request = current_time - _last_request_time
-    
-    if time_since_last_request < _min_request_interval:
-        sleep_time = _min_request_interval - time_since_last_request
-        time.sleep(sleep_time)
-    
+    memo_key, cached = memo_lookup(
+        "claude", model, None, prompt, temperature, max_tokens, use_memo
+    )
+    if cached is not None:
+        return cached
+
     # Initialize Anthropic client
-    api_key = os.getenv("ANTHROPIC_API_KEY", "")
-    if not api_key:
-        raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
+    api_key = _api_key()
     
-    client = Anthropic(api_key=api_key)
+    # Shared client: its connection pool stays warm between calls
+    client = get_client("claude", api_key)
+
+    if estimated_tokens is None:
+        estimated_tokens = count_tokens(prompt, model)
+
+    # Reserve the prompt plus the largest possible reply; the unused part
+    # is refunded once the API reports actual usage
+    limiter = get_limiter("claude")
+    reserved = estimated_tokens + max_tokens
+
+    # Only pass a timeout when given; None would disable the SDK's default
+    options = {"timeout": timeout} if timeout is not None else {}
+
+    # Transient failures are retried; every attempt takes its own reservation
+    with llm_call("claude", model, call):
+        for attempt in retrying(max_retries):
+            with attempt:
+                limiter.acquire(tokens=reserved, block=block)
+                try:
+                    # Make the API call
+                    response = client.messages.create(
+                        model=model,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": prompt
+                            }
+                        ],
+                        **options
+                    )
+                except Exception as e:
+                    limiter.refund(reserved)
+                    raise agent_failure("Claude", e, limiter) from e
+
+    limiter.refund(reserved - response.usage.input_tokens - response.usage.output_tokens)
+    observe_llm_tokens("claude", model, call, response.usage.input_tokens, response.usage.output_tokens)
+
+    # Record estimated vs. actual prompt tokens
+    token_ledger.record(call, model, estimated_tokens, response.usage.input_tokens)
     
+    # Extract and return the text content
+    text = response.content[0].text
+    memo_store(memo_key, text)
+    return text
+
+
+async def aask_claude(
+    prompt,
+    model="claude-3-sonnet-20240229",
+    temperature=0.2,
+    max_tokens=1024,
+    estimated_tokens=None,
+    call="claude",
+    timeout=None,
+    block=True,
+    use_memo=None,
+    max_retries=None,
+):
+    """
+    Async variant of ask_claude; waits for rate limit capacity on the event loop.
+
+    The memo cache and rate limit store are blocking (SQLite) and run on
+    worker threads.
+
+    Args:
+        Same as ask_claude
+
+    Returns:
+        str: Claude's response text
+    """
+    memo_key, cached = await asyncio.to_thread(
+        memo_lookup, "claude", model, None, prompt, temperature, max_tokens, use_memo
+    )
+    if cached is not None:
+        return cached
+
+    client = get_async_client("claude", _api_key())
+
+    if estimated_tokens is None:
+        estimated_tokens = count_tokens(prompt, model)
+
+    limiter = get_limiter("claude")
+    reserved = estimated_tokens + max_tokens
+    options = {"timeout": timeout} if timeout is not None else {}
+
+    with llm_call("claude", model, call):
+        async for attempt in aretrying(max_retries):
+            with attempt:
+                await limiter.aacquire(tokens=reserved, block=block)
+                try:
+                    response = await client.messages.create(
+                        model=model,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        messages=[{"role": "user", "content": prompt}],
+                        **options
+                    )
+                except Exception as e:
+                    await limiter.arefund(reserved)
+                    error = await asyncio.to_thread(agent_failure, "Claude", e, limiter)
+                    raise error from e
+
+    await limiter.arefund(reserved - response.usage.input_tokens - response.usage.output_tokens)
+    observe_llm_tokens("claude", model, call, response.usage.input_tokens, response.usage.output_tokens)
+    token_ledger.record(call, model, estimated_tokens, response.usage.input_tokens)
+    text = response.content[0].text
+    await asyncio.to_thread(memo_store, memo_key, text)
+    return text
+
+
+def stream_claude(
+    prompt,
+    model="claude-3-sonnet-20240229",
+    temperature=0.2,
+    max_tokens=1024,
+    estimated_tokens=None,
+    call="claude",
+    timeout=None,
+    block=True,
+):
+    """
+    Stream a Claude reply, yielding text deltas as they arrive.
+
+    Rate limited like ask_claude. Token usage and time to first token are
+    recorded when the stream finishes.
+
+    Args:
+        Same as ask_claude
+
+    Yields:
+        str: The next piece of Claude's response text
+
+    Returns:
+        dict: input_tokens, output_tokens, ttft and elapsed seconds (the value
+            of ``yield from``)
+    """
+    client = get_client("claude", _api_key())
+
+    if estimated_tokens is None:
+        estimated_tokens = count_tokens(prompt, model)
+
+    limiter = get_limiter("claude")
+    reserved = estimated_tokens + max_tokens
+    limiter.acquire(tokens=reserved, block=block)
+
+    options = {"timeout": timeout} if timeout is not None else {}
+    started = time.monotonic()
+    ttft = None
+    deltas = []
+    used = None
     try:
-        # Make the API call
-        response = client.messages.create(
+        with client.messages.stream(
             model=model,
             max_tokens=max_tokens,
             temperature=temperature,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        )
-        
-        # Update last request time
-        _last_request_time = time.time()
-        
-        # Extract and return the text content
-        return response.content[0].text
-        
+            messages=[{"role": "user", "content": prompt}],
+            **options
+        ) as stream:
+            for text in stream.text_stream:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                deltas.append(text)
+                yield text
+            usage = stream.get_final_message().usage
+        input_tokens, output_tokens = usage.input_tokens, usage.output_tokens
+        used = input_tokens + output_tokens
     except Exception as e:
-        raise Exception(f"Claude API error: {str(e)}")
+        error = agent_failure("Claude", e, limiter)
+        observe_llm_call("claude", model, call, time.monotonic() - started, error)
+        raise error from e
+    finally:
+        # Also runs when the stream fails or the caller stops reading early
+        limiter.refund(reserved - stream_tokens_used(used, ttft, estimated_tokens, deltas, model))
 
+    elapsed = time.monotonic() - started
+    observe_llm_call("claude", model, call, elapsed)
+    observe_llm_tokens("claude", model, call, input_tokens, output_tokens)
+    if ttft is not None:
+        observe_ttft("claude", model, call, ttft)
+    token_ledger.record(call, model, estimated_tokens, input_tokens)
+    print(
+        f"⏱️ {call} ({model}): first token after {ttft or elapsed:.2f}s, "
+        f"{output_tokens} output tokens in {elapsed:.2f}s"
+    )
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "ttft": ttft,
+        "elapsed": elapsed,
+    }
 
-def ask_claude_dev(prompt, temperature=0.3, max_tokens=2048):
+
+def ask_claude_dev(prompt, temperature=None, max_tokens=None, use_memo=None):
     """
     Claude Dev agent - highly experienced full-stack engineer
-    
+
     Args:
         prompt (str): The coding question or task
         temperature (float): Temperature setting (default: 0.3)
         max_tokens (int): Maximum tokens in response (default: 2048)
-    
+        use_memo (bool): Use the on-disk memo cache (default: AGENT_MEMO setting)
+
     Returns:
         str: Claude's response
     """
-    system_prompt = """You are a highly experienced full-stack engineer working on a modular, scalable Django + Next.js project. 
-Respond professionally. Write clean code. Always explain decisions. Add comments when needed. Follow best practices."""
-    
-    full_prompt = f"{system_prompt}\n\n{prompt}"
-    
-    return ask_claude(
-        prompt=full_prompt,
-        model="claude-3-opus-20240229",
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
+    return ask_persona("claude_dev", prompt, temperature, max_tokens, use_memo)
+
 
+async def aask_claude_dev(prompt, temperature=None, max_tokens=None, use_memo=None):
+    """Async variant of ask_claude_dev."""
+    return await aask_persona("claude_dev", prompt, temperature, max_tokens, use_memo)
 
-def ask_claude_throttle(prompt, temperature=0.2, max_tokens=1024):
+
+def stream_claude_dev(prompt, temperature=None, max_tokens=None):
+    """Streaming variant of ask_claude_dev; yields Claude's response text as it arrives."""
+    return (yield from stream_persona("claude_dev", prompt, temperature, max_tokens))
+
+
+def ask_claude_throttle(prompt, temperature=None, max_tokens=None, use_memo=None):
     """
     Claude Throttle agent - smart rate-limited assistant for summarization and data processing
-    
+
     Args:
         prompt (str): The task to process
         temperature (float): Temperature setting (default: 0.2)
         max_tokens (int): Maximum tokens in response (default: 1024)
-    
+        use_memo (bool): Use the on-disk memo cache (default: AGENT_MEMO setting)
+
     Returns:
         str: Claude's response
     """
-    system_prompt = """You are a smart rate-limited AI assistant focused on summarization and data processing. 
-Never exceed request thresholds. Always respect rate limits. Provide concise, accurate responses."""
-    
-    full_prompt = f"{system_prompt}\n\n{prompt}"
-    
-    return ask_claude(
-        prompt=full_prompt,
-        model="claude-3-sonnet-20240229",
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
+    return ask_persona("claude_throttle", prompt, temperature, max_tokens, use_memo)
+
+
+async def aask_claude_throttle(prompt, temperature=None, max_tokens=None, use_memo=None):
+    """Async variant of ask_claude_throttle."""
+    return await aask_persona("claude_throttle", prompt, temperature, max_tokens, use_memo)
+
 
+def stream_claude_throttle(prompt, temperature=None, max_tokens=None):
+    """Streaming variant of ask_claude_throttle; yields Claude's response text as it arrives."""
+    return (yield from stream_persona("claude_throttle", prompt, temperature, max_tokens))
@@ -0,0 +1,126 @@
+"""
+Shared SDK clients for the agents.
+
+Building an ``Anthropic`` or ``OpenAI`` client creates a new httpx connection
+pool, so a client per call pays for the TCP+TLS handshake on every request.
+The SDK clients are thread-safe; one client per (provider, API key, base URL)
+is created on first use and reused, keeping its keep-alive connections.
+
+Per-call timeouts are passed to the request itself (``timeout=...`` on
+``create``), which does not copy or rebuild the client.
+
+Async clients (``get_async_client``) are bound to the event loop they were
+created on, so they are kept per loop as well.
+"""
+import asyncio
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+
+_clients = {}
+_lock = threading.Lock()
+# Event loop -> {(provider, api key, base URL): async client}
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=getattr(settings, "LLM_HTTP_MAX_CONNECTIONS", 100),
+        max_keepalive_connections=getattr(settings, "LLM_HTTP_MAX_KEEPALIVE", 20),
+    )
+
+
+def _build(provider, api_key, base_url, asynchronous=False):
+    # Imported on first use so each SDK loads only when its agent is used.
+    # The pool is passed in explicitly: it is sized from settings, and the
+    # pinned anthropic SDK builds its default with ``proxies=``, which
+    # httpx 0.28 no longer accepts
+    if provider == "claude":
+        import anthropic as sdk
+
+        client_class = sdk.AsyncAnthropic if asynchronous else sdk.Anthropic
+    elif provider == "openai":
+        import openai as sdk
+
+        client_class = sdk.AsyncOpenAI if asynchronous else sdk.OpenAI
+    else:
+        raise ValueError(f"Unknown agent provider: {provider}")
+
+    http_client_class = sdk.DefaultAsyncHttpxClient if asynchronous else sdk.DefaultHttpxClient
+    return client_class(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=http_client_class(limits=_limits()),
+        # agents.retry is the only retry layer
+        max_retries=0,
+    )
+
+
+def _base_url(provider, base_url):
+    return base_url or getattr(settings, f"{provider.upper()}_BASE_URL", "") or None
+
+
+def get_client(provider, api_key, base_url=None):
+    """
+    Return the shared client for a provider.
+
+    Args:
+        provider (str): "claude" or "openai"
+        api_key (str): API key the client authenticates with
+        base_url (str): API base URL (default: CLAUDE_BASE_URL / OPENAI_BASE_URL
+            setting, else the SDK's own)
+
+    Returns:
+        Anthropic | OpenAI: A client shared by every caller with the same key and URL
+    """
+    base_url = _base_url(provider, base_url)
+    key = (provider, api_key, base_url)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _build(provider, api_key, base_url)
+                _clients[key] = client
+    return client
+
+
+def close_clients():
+    """Close every shared client and its connection pool (e.g. on shutdown)."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def get_async_client(provider, api_key, base_url=None):
+    """
+    Return the shared async client for a provider on the running event loop.
+
+    Args:
+        provider (str): "claude" or "openai"
+        api_key (str): API key the client authenticates with
+        base_url (str): API base URL (default: as for get_client)
+
+    Returns:
+        AsyncAnthropic | AsyncOpenAI: A client shared by coroutines on this loop
+    """
+    base_url = _base_url(provider, base_url)
+    key = (provider, api_key, base_url)
+    # Only the loop's own thread touches its entry, so no lock is needed
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(key)
+    if client is None:
+        client = _build(provider, api_key, base_url, asynchronous=True)
+        clients[key] = client
+    return client
+
+
+async def aclose_clients():
+    """Close the async clients of the running event loop."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
@@ -0,0 +1,136 @@
+"""
+Typed errors for the agents.
+
+Provider SDK exceptions are mapped to a small hierarchy so callers (and the
+retry policy in agents.retry) can tell a transient failure from a permanent
+one. Every error keeps the "<Provider> API error: ..." message the agents
+have always raised, and is still an ``Exception``.
+
+``retry_after`` is how long the provider asked us to wait, read from
+``Retry-After`` / ``retry-after-ms`` or the provider's rate-limit reset
+headers; it is None when the response did not say.
+"""
+import email.utils
+import re
+import time
+from datetime import datetime
+
+
+class AgentError(Exception):
+    """An agent call failed."""
+
+    retryable = False
+
+    def __init__(self, message, provider=None, status=None, retry_after=None):
+        super().__init__(message)
+        self.provider = provider
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AgentRateLimited(AgentError):
+    """The provider rejected the call with 429 Too Many Requests."""
+
+    retryable = True
+
+
+class AgentOverloaded(AgentError):
+    """The provider is overloaded or failing (529, 5xx)."""
+
+    retryable = True
+
+
+class AgentTimeout(AgentError):
+    """The call timed out or the connection failed before a response."""
+
+    retryable = True
+
+
+class AgentBadRequest(AgentError):
+    """The provider rejected the request itself (4xx); retrying will not help."""
+
+
+# "1s", "6m0s", "20ms", "1h2m3.5s" (OpenAI x-ratelimit-reset-* headers)
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# Rate-limit window headers: (reset, remaining)
+RESET_HEADERS = (
+    ("anthropic-ratelimit-requests-reset", "anthropic-ratelimit-requests-remaining"),
+    ("anthropic-ratelimit-tokens-reset", "anthropic-ratelimit-tokens-remaining"),
+    ("anthropic-ratelimit-input-tokens-reset", "anthropic-ratelimit-input-tokens-remaining"),
+    ("anthropic-ratelimit-output-tokens-reset", "anthropic-ratelimit-output-tokens-remaining"),
+    ("x-ratelimit-reset-requests", "x-ratelimit-remaining-requests"),
+    ("x-ratelimit-reset-tokens", "x-ratelimit-remaining-tokens"),
+)
+
+
+def _parse_duration(value):
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+    # RFC 3339 timestamp (Anthropic) or HTTP date (Retry-After)
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        try:
+            moment = email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+    return moment - time.time()
+
+
+def retry_after_from_headers(headers, rate_limited=False):
+    """
+    Seconds the provider asked us to wait, or None if the headers do not say.
+
+    Rate-limit reset headers come with every response, so they are only
+    consulted for a 429 (``rate_limited``) and only for exhausted windows.
+    """
+    if not headers:
+        return None
+    candidates = []
+    if headers.get("retry-after-ms"):
+        try:
+            candidates.append(float(headers["retry-after-ms"]) / 1000)
+        except ValueError:
+            pass
+    if not candidates and headers.get("retry-after"):
+        candidates.append(_parse_duration(headers["retry-after"]))
+    if not candidates and rate_limited:
+        # Without Retry-After, wait for the longest exhausted window to reset
+        candidates = [
+            _parse_duration(headers[reset])
+            for reset, remaining in RESET_HEADERS
+            if headers.get(reset) and headers.get(remaining, "0").strip() in ("0", "")
+        ]
+    candidates = [seconds for seconds in candidates if seconds is not None]
+    return max(0.0, max(candidates)) if candidates else None
+
+
+def agent_error(label, error):
+    """Map an SDK exception from provider ``label`` ("Claude", "OpenAI") to an AgentError."""
+    if isinstance(error, AgentError):
+        return error
+    message = f"{label} API error: {str(error)}"
+    names = {cls.__name__ for cls in type(error).__mro__}
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    retry_after = retry_after_from_headers(getattr(response, "headers", None), status == 429)
+
+    if "APITimeoutError" in names or "APIConnectionError" in names or status == 408:
+        error_class = AgentTimeout
+    elif status == 429:
+        error_class = AgentRateLimited
+    elif status is not None and status >= 500:
+        error_class = AgentOverloaded
+    elif status is not None and 400 <= status < 500:
+        error_class = AgentBadRequest
+    else:
+        error_class = AgentError
+    return error_class(message, provider=label.lower(), status=status, retry_after=retry_after)
@@ -0,0 +1,241 @@
+"""
+Opt-in on-disk memoization of agent replies.
+
+Internal tooling sends the same prompts again and again (review templates,
+summaries of unchanged documents). With ``AGENT_MEMO`` enabled, replies are
+stored in a local SQLite file keyed on (provider, model, system prompt,
+prompt, temperature, max_tokens), zstd-compressed, and a repeat call is
+answered from disk instead of the provider.
+
+The file is capped at ``AGENT_MEMO_MAX_MB``; least recently used entries are
+evicted first. The total size is kept up to date by triggers, so a write
+never has to add up the whole table. Pass ``use_memo=False`` to an agent call to bypass the cache
+(it neither reads nor writes it), or ``use_memo=True`` to use it when it is
+disabled globally.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import zstandard
+from django.conf import settings
+
+
+class MemoCache:
+    """SQLite-backed reply cache with zstd values and LRU size eviction."""
+
+    # Last-used times of hits are written in batches, so a hit is one SELECT
+    TOUCH_BATCH = 100
+
+    def __init__(self, path, max_bytes, level=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.level = level
+        # Connections and zstd contexts are not thread-safe; each thread has its own
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS memo_used_at ON memo (used_at)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS memo_size "
+                "(id INTEGER PRIMARY KEY, bytes INTEGER NOT NULL)"
+            )
+            connection.executescript(
+                """
+                CREATE TRIGGER IF NOT EXISTS memo_size_insert AFTER INSERT ON memo BEGIN
+                    UPDATE memo_size SET bytes = bytes + new.size WHERE id = 1;
+                END;
+                CREATE TRIGGER IF NOT EXISTS memo_size_update AFTER UPDATE OF size ON memo BEGIN
+                    UPDATE memo_size SET bytes = bytes - old.size + new.size WHERE id = 1;
+                END;
+                CREATE TRIGGER IF NOT EXISTS memo_size_delete AFTER DELETE ON memo BEGIN
+                    UPDATE memo_size SET bytes = bytes - old.size WHERE id = 1;
+                END;
+                """
+            )
+            # Seeded once, after the triggers exist, so no write is missed
+            connection.execute(
+                "INSERT OR IGNORE INTO memo_size (id, bytes) "
+                "SELECT 1, COALESCE(SUM(size), 0) FROM memo"
+            )
+            self._local.connection = connection
+        return connection
+
+    def _compressor(self):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return compressor
+
+    def _decompressor(self):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor()
+        return decompressor
+
+    @staticmethod
+    def _size(connection):
+        return connection.execute("SELECT bytes FROM memo_size WHERE id = 1").fetchone()[0]
+
+    @staticmethod
+    def make_key(provider, model, system_prompt, prompt, temperature, max_tokens):
+        payload = json.dumps(
+            [provider, model, system_prompt or "", prompt, temperature, max_tokens],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM memo WHERE key = ?", (key,)
+        ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            flush = len(self._touched) >= self.TOUCH_BATCH
+        if flush:
+            self._flush_touches(self._connection())
+        return self._decompressor().decompress(row[0]).decode("utf-8")
+
+    def set(self, key, text):
+        value = self._compressor().compress(text.encode("utf-8"))
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # An upsert, not INSERT OR REPLACE: replaced rows skip delete triggers
+            connection.execute(
+                "INSERT INTO memo (key, value, size, created_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                "value = excluded.value, size = excluded.size, "
+                "created_at = excluded.created_at, used_at = excluded.used_at",
+                (key, value, len(value), now, now),
+            )
+            self._flush_touches(connection, in_transaction=True)
+            evicted, freed = self._evict(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if evicted:
+            # Logged after COMMIT so the write lock is not held for console I/O
+            print(f"🧹 Evicted {evicted} memoized agent replies ({freed} bytes)")
+
+    def _flush_touches(self, connection, in_transaction=False):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        statement = "UPDATE memo SET used_at = ? WHERE key = ?"
+        rows = [(used_at, key) for key, used_at in touched.items()]
+        if in_transaction:
+            connection.executemany(statement, rows)
+        else:
+            with connection:
+                connection.executemany(statement, rows)
+
+    def _evict(self, connection):
+        """Delete least recently used rows when over max_bytes; returns (rows, bytes)."""
+        total = self._size(connection)
+        if total <= self.max_bytes:
+            return 0, 0
+        # Evict down to 90% so the next few writes do not evict again
+        target = total - int(self.max_bytes * 0.9)
+        freed = evicted = 0
+        for key, size in connection.execute("SELECT key, size FROM memo ORDER BY used_at"):
+            if freed >= target:
+                break
+            connection.execute("DELETE FROM memo WHERE key = ?", (key,))
+            freed += size
+            evicted += 1
+        self.evictions += evicted
+        return evicted, freed
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM memo")
+
+    def stats(self):
+        connection = self._connection()
+        (entries,) = connection.execute("SELECT COUNT(*) FROM memo").fetchone()
+        size = self._size(connection)
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_memo_cache = None
+_memo_lock = threading.Lock()
+
+
+def get_memo_cache():
+    """The shared MemoCache configured from settings."""
+    global _memo_cache
+    if _memo_cache is None:
+        with _memo_lock:
+            if _memo_cache is None:
+                _memo_cache = MemoCache(
+                    getattr(settings, "AGENT_MEMO_PATH", "")
+                    or str(settings.BASE_DIR / "agent_memo.sqlite3"),
+                    getattr(settings, "AGENT_MEMO_MAX_MB", 256) * 1024 * 1024,
+                    getattr(settings, "AGENT_MEMO_ZSTD_LEVEL", 3),
+                )
+    return _memo_cache
+
+
+def memo_lookup(provider, model, system_prompt, prompt, temperature, max_tokens, use_memo=None):
+    """
+    Look a call up in the memo cache.
+
+    Returns:
+        tuple: (key, text); key is None when the call is not memoized and
+            text is None on a miss
+    """
+    if use_memo is None:
+        use_memo = getattr(settings, "AGENT_MEMO", False)
+    if not use_memo:
+        return None, None
+    cache = get_memo_cache()
+    key = cache.make_key(provider, model, system_prompt, prompt, temperature, max_tokens)
+    try:
+        return key, cache.get(key)
+    except sqlite3.Error as e:
+        # A broken cache must not break the call
+        print(f"⚠️ Agent memo cache read failed: {e}")
+        return None, None
+
+
+def memo_store(key, text):
+    """Store a reply under a key from memo_lookup (no-op when key is None)."""
+    if key is None or text is None:
+        return
+    try:
+        get_memo_cache().set(key, text)
+    except sqlite3.Error as e:
+        print(f"⚠️ Agent memo cache write failed: {e}")
@@ -1,17 +1,48 @@
 """
 OpenAI Agent with built-in rate limiting
+Rate limit: shared requests/tokens per minute buckets (agents.rate_limit)
+Async variants (aask_*) use the SDK's async clients and the same limits
+Streaming variants (stream_*) yield the response text as it arrives
 """
-import time
+import asyncio
 import os
-from openai import OpenAI
+import time
 from django.conf import settings
+from utils.metrics import llm_call, observe_llm_call, observe_llm_tokens, observe_ttft
+from utils.tokens import count_tokens, token_ledger
+
+from .clients import get_async_client, get_client
+from .memo import memo_lookup, memo_store
+from .personas import PERSONAS, aask_persona, ask_persona, stream_persona
+from .rate_limit import get_limiter, stream_tokens_used
+from .retry import agent_failure, aretrying, retrying
+
+# Persona models and prompts, kept here for existing imports
+DEV_MODEL = PERSONAS["openai_dev"].model
+DEV_SYSTEM_PROMPT = PERSONAS["openai_dev"].system_prompt
+ASSISTANT_MODEL = PERSONAS["openai_assistant"].model
+ASSISTANT_SYSTEM_PROMPT = PERSONAS["openai_assistant"].system_prompt
+
 
-# Rate limiting state
-_last_request_time = 0
-_min_request_interval = 0.1  # seconds (OpenAI has more generous limits)
+def _api_key():
+    api_key = getattr(settings, 'OPENAI_API_KEY', None) or os.getenv("OPENAI_API_KEY", "")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not found in settings or environment variables")
+    return api_key
 
 
-def ask_openai(prompt, model="gpt-3.5-turbo", temperature=0.4, max_tokens=1024):
+def ask_openai(
+    prompt,
+    model="gpt-3.5-turbo",
+    temperature=0.4,
+    max_tokens=1024,
+    estimated_tokens=None,
+    call="openai",
+    timeout=None,
+    block=True,
+    use_memo=None,
+    max_retries=None,
+):
     """
     Send a request to OpenAI API with built-in rate limiting.
     
@@ -20,100 +51,287 @@ def ask_openai(prompt, model="gpt-3.5-turbo", temperature=0.4, max_tokens=1024):
         model (str): The OpenAI model to use (default: gpt-3.5-turbo)
         temperature (float): Temperature setting (default: 0.4)
         max_tokens (int): Maximum tokens in response (default: 1024)
+        estimated_tokens (int): Prompt token estimate to record (default: counted here)
+        call (str): Name the call is recorded under in the token ledger
+        timeout (float): Request timeout in seconds (default: the SDK's own)
+        block (bool): Wait for rate limit capacity instead of raising (default: True)
+        use_memo (bool): Use the on-disk memo cache (default: AGENT_MEMO setting)
+        max_retries (int): Retries of transient failures (default: AGENT_MAX_RETRIES)
     
     Returns:
         str: OpenAI's response text
         
     Raises:
-        Exception: If API call fails
+        RateLimitExceeded: If block is False and the rate limit is exhausted
+        AgentBadRequest: If the provider rejects the request
+        AgentRateLimited, AgentOverloaded, AgentTimeout: If retries run out
     """
-    global _last_request_time
-    
-    # Enforce rate limiting
-    current_time = time.time()
-    time_since_last_request = current_time - _last_request_time
-    
-    if time_since_last_request < _min_request_interval:
-        sleep_time = _min_request_interval - time_since_last_request
-        time.sleep(sleep_time)
-    
+    memo_key, cached = memo_lookup(
+        "openai", model, None, prompt, temperature, max_tokens, use_memo
+    )
+    if cached is not None:
+        return cached
+
     # Initialize OpenAI client
-    api_key = getattr(settings, 'OPENAI_API_KEY', None) or os.getenv("OPENAI_API_KEY", "")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY not found in settings or environment variables")
+    api_key = _api_key()
     
-    client = OpenAI(api_key=api_key)
+    # Shared client: its connection pool stays warm between calls
+    client = get_client("openai", api_key)
+
+    if estimated_tokens is None:
+        estimated_tokens = count_tokens(prompt, model)
+
+    # Reserve the prompt plus the largest possible reply; the unused part
+    # is refunded once the API reports actual usage
+    limiter = get_limiter("openai")
+    reserved = estimated_tokens + max_tokens
+
+    # Only pass a timeout when given; None would disable the SDK's default
+    options = {"timeout": timeout} if timeout is not None else {}
+
+    # Transient failures are retried; every attempt takes its own reservation
+    with llm_call("openai", model, call):
+        for attempt in retrying(max_retries):
+            with attempt:
+                limiter.acquire(tokens=reserved, block=block)
+                try:
+                    # Make the API call
+                    response = client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": prompt
+                            }
+                        ],
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        **options
+                    )
+                except Exception as e:
+                    limiter.refund(reserved)
+                    raise agent_failure("OpenAI", e, limiter) from e
+
+    limiter.refund(reserved - response.usage.prompt_tokens - response.usage.completion_tokens)
+    observe_llm_tokens("openai", model, call, response.usage.prompt_tokens, response.usage.completion_tokens)
+
+    # Record estimated vs. actual prompt tokens
+    token_ledger.record(call, model, estimated_tokens, response.usage.prompt_tokens)
     
+    # Extract and return the text content
+    text = response.choices[0].message.content
+    memo_store(memo_key, text)
+    return text
+
+
+async def aask_openai(
+    prompt,
+    model="gpt-3.5-turbo",
+    temperature=0.4,
+    max_tokens=1024,
+    estimated_tokens=None,
+    call="openai",
+    timeout=None,
+    block=True,
+    use_memo=None,
+    max_retries=None,
+):
+    """
+    Async variant of ask_openai; waits for rate limit capacity on the event loop.
+
+    The memo cache and rate limit store are blocking (SQLite) and run on
+    worker threads.
+
+    Args:
+        Same as ask_openai
+
+    Returns:
+        str: OpenAI's response text
+    """
+    memo_key, cached = await asyncio.to_thread(
+        memo_lookup, "openai", model, None, prompt, temperature, max_tokens, use_memo
+    )
+    if cached is not None:
+        return cached
+
+    client = get_async_client("openai", _api_key())
+
+    if estimated_tokens is None:
+        estimated_tokens = count_tokens(prompt, model)
+
+    limiter = get_limiter("openai")
+    reserved = estimated_tokens + max_tokens
+    options = {"timeout": timeout} if timeout is not None else {}
+
+    with llm_call("openai", model, call):
+        async for attempt in aretrying(max_retries):
+            with attempt:
+                await limiter.aacquire(tokens=reserved, block=block)
+                try:
+                    response = await client.chat.completions.create(
+                        model=model,
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        **options
+                    )
+                except Exception as e:
+                    await limiter.arefund(reserved)
+                    error = await asyncio.to_thread(agent_failure, "OpenAI", e, limiter)
+                    raise error from e
+
+    await limiter.arefund(
+        reserved - response.usage.prompt_tokens - response.usage.completion_tokens
+    )
+    observe_llm_tokens("openai", model, call, response.usage.prompt_tokens, response.usage.completion_tokens)
+    token_ledger.record(call, model, estimated_tokens, response.usage.prompt_tokens)
+    text = response.choices[0].message.content
+    await asyncio.to_thread(memo_store, memo_key, text)
+    return text
+
+
+def stream_openai(
+    prompt,
+    model="gpt-3.5-turbo",
+    temperature=0.4,
+    max_tokens=1024,
+    estimated_tokens=None,
+    call="openai",
+    timeout=None,
+    block=True,
+):
+    """
+    Stream an OpenAI reply, yielding text deltas as they arrive.
+
+    Rate limited like ask_openai. Token usage and time to first token are
+    recorded when the stream finishes.
+
+    Args:
+        Same as ask_openai
+
+    Yields:
+        str: The next piece of OpenAI's response text
+
+    Returns:
+        dict: input_tokens, output_tokens, ttft and elapsed seconds (the value
+            of ``yield from``)
+    """
+    client = get_client("openai", _api_key())
+
+    if estimated_tokens is None:
+        estimated_tokens = count_tokens(prompt, model)
+
+    limiter = get_limiter("openai")
+    reserved = estimated_tokens + max_tokens
+    limiter.acquire(tokens=reserved, block=block)
+
+    options = {"timeout": timeout} if timeout is not None else {}
+    started = time.monotonic()
+    ttft = None
+    usage = None
+    deltas = []
+    used = None
     try:
-        # Make the API call
-        response = client.chat.completions.create(
+        # include_usage adds a final chunk with the token counts
+        with client.chat.completions.create(
             model=model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
+            messages=[{"role": "user", "content": prompt}],
             temperature=temperature,
-            max_tokens=max_tokens
-        )
-        
-        # Update last request time
-        _last_request_time = time.time()
-        
-        # Extract and return the text content
-        return response.choices[0].message.content
-        
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            **options
+        ) as stream:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    deltas.append(chunk.choices[0].delta.content)
+                    yield deltas[-1]
+        if usage is not None:
+            input_tokens, output_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            # Compatible servers that ignore include_usage: fall back to estimates
+            input_tokens, output_tokens = estimated_tokens, count_tokens("".join(deltas), model)
+        used = input_tokens + output_tokens
     except Exception as e:
-        raise Exception(f"OpenAI API error: {str(e)}")
+        error = agent_failure("OpenAI", e, limiter)
+        observe_llm_call("openai", model, call, time.monotonic() - started, error)
+        raise error from e
+    finally:
+        # Also runs when the stream fails or the caller stops reading early
+        limiter.refund(reserved - stream_tokens_used(used, ttft, estimated_tokens, deltas, model))
+
+    elapsed = time.monotonic() - started
+    if usage is not None:
+        token_ledger.record(call, model, estimated_tokens, input_tokens)
+    else:
+        token_ledger.record(call, model, estimated_tokens)
+    observe_llm_call("openai", model, call, elapsed)
+    observe_llm_tokens("openai", model, call, input_tokens, output_tokens)
+    if ttft is not None:
+        observe_ttft("openai", model, call, ttft)
+    print(
+        f"⏱️ {call} ({model}): first token after {ttft or elapsed:.2f}s, "
+        f"{output_tokens} output tokens in {elapsed:.2f}s"
+    )
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "ttft": ttft,
+        "elapsed": elapsed,
+    }
 
 
-def ask_openai_dev(prompt, temperature=0.3, max_tokens=2048):
+def ask_openai_dev(prompt, temperature=None, max_tokens=None, use_memo=None):
     """
     OpenAI Dev agent - world-class AI specializing in Django, Next.js, and AI agent architecture
-    
+
     Args:
         prompt (str): The coding question or task
         temperature (float): Temperature setting (default: 0.3)
         max_tokens (int): Maximum tokens in response (default: 2048)
-    
+        use_memo (bool): Use the on-disk memo cache (default: AGENT_MEMO setting)
+
     Returns:
         str: OpenAI's response
     """
-    system_prompt = """You are a world-class AI specializing in Django, Next.js, and AI agent architecture. 
-Provide professional, concise answers. Focus on clean and scalable code. Always include brief explanations and comments when helpful."""
-    
-    full_prompt = f"{system_prompt}\n\n{prompt}"
-    
-    return ask_openai(
-        prompt=full_prompt,
-        model="gpt-4-turbo",
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
+    return ask_persona("openai_dev", prompt, temperature, max_tokens, use_memo)
 
 
-def ask_openai_assistant(prompt, temperature=0.4, max_tokens=1024):
+async def aask_openai_dev(prompt, temperature=None, max_tokens=None, use_memo=None):
+    """Async variant of ask_openai_dev."""
+    return await aask_persona("openai_dev", prompt, temperature, max_tokens, use_memo)
+
+
+def stream_openai_dev(prompt, temperature=None, max_tokens=None):
+    """Streaming variant of ask_openai_dev; yields OpenAI's response text as it arrives."""
+    return (yield from stream_persona("openai_dev", prompt, temperature, max_tokens))
+
+
+def ask_openai_assistant(prompt, temperature=None, max_tokens=None, use_memo=None):
     """
     OpenAI Assistant - smart coding assistant for small tasks, debugging, and fast answers
-    
+
     Args:
         prompt (str): The task to process
         temperature (float): Temperature setting (default: 0.4)
         max_tokens (int): Maximum tokens in response (default: 1024)
-    
+        use_memo (bool): Use the on-disk memo cache (default: AGENT_MEMO setting)
+
     Returns:
         str: OpenAI's response
     """
-    system_prompt = """You are a smart coding assistant specialized in small tasks, debugging, and fast answers. 
-Prioritize speed and helpfulness over formality. Focus on simple and practical solutions."""
-    
-    full_prompt = f"{system_prompt}\n\n{prompt}"
-    
-    return ask_openai(
-        prompt=full_prompt,
-        model="gpt-3.5-turbo",
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
+    return ask_persona("openai_assistant", prompt, temperature, max_tokens, use_memo)
+
+
+async def aask_openai_assistant(prompt, temperature=None, max_tokens=None, use_memo=None):
+    """Async variant of ask_openai_assistant."""
+    return await aask_persona("openai_assistant", prompt, temperature, max_tokens, use_memo)
+
 
+def stream_openai_assistant(prompt, temperature=None, max_tokens=None):
+    """Streaming variant of ask_openai_assistant; yields OpenAI's response text as it arrives."""
+    return (yield from stream_persona("openai_assistant", prompt, temperature, max_tokens))
@@ -0,0 +1,170 @@
+"""
+Agent personas: a provider, model, system prompt and default settings.
+
+``PERSONAS`` is the one table of them. ``ask_persona``, ``aask_persona`` and
+``stream_persona`` run any persona the same way: memo lookup, fitting the
+prompt to the model's budget (AGENT_PROMPT_TOKEN_BUDGET), the provider call
+recorded under the persona's name, and storing the reply. The named helpers
+in claude_agent and openai_agent (ask_claude_dev, ...) are thin wrappers.
+"""
+import asyncio
+import importlib
+from collections import namedtuple
+
+from django.conf import settings
+from utils.tokens import fit_prompt
+
+from .memo import memo_lookup, memo_store
+
+Persona = namedtuple(
+    "Persona", ["provider", "model", "system_prompt", "temperature", "max_tokens"]
+)
+
+CLAUDE_DEV_MODEL = "claude-3-opus-20240229"
+CLAUDE_DEV_SYSTEM_PROMPT = """You are a highly experienced full-stack engineer working on a modular, scalable Django + Next.js project. 
+Respond professionally. Write clean code. Always explain decisions. Add comments when needed. Follow best practices."""
+
+CLAUDE_THROTTLE_MODEL = "claude-3-sonnet-20240229"
+CLAUDE_THROTTLE_SYSTEM_PROMPT = """You are a smart rate-limited AI assistant focused on summarization and data processing. 
+Never exceed request thresholds. Always respect rate limits. Provide concise, accurate responses."""
+
+OPENAI_DEV_MODEL = "gpt-4-turbo"
+OPENAI_DEV_SYSTEM_PROMPT = """You are a world-class AI specializing in Django, Next.js, and AI agent architecture. 
+Provide professional, concise answers. Focus on clean and scalable code. Always include brief explanations and comments when helpful."""
+
+OPENAI_ASSISTANT_MODEL = "gpt-3.5-turbo"
+OPENAI_ASSISTANT_SYSTEM_PROMPT = """You are a smart coding assistant specialized in small tasks, debugging, and fast answers. 
+Prioritize speed and helpfulness over formality. Focus on simple and practical solutions."""
+
+# Persona name (also the call it is recorded under) -> Persona
+PERSONAS = {
+    "claude_dev": Persona("claude", CLAUDE_DEV_MODEL, CLAUDE_DEV_SYSTEM_PROMPT, 0.3, 2048),
+    "claude_throttle": Persona(
+        "claude", CLAUDE_THROTTLE_MODEL, CLAUDE_THROTTLE_SYSTEM_PROMPT, 0.2, 1024
+    ),
+    "openai_dev": Persona("openai", OPENAI_DEV_MODEL, OPENAI_DEV_SYSTEM_PROMPT, 0.3, 2048),
+    "openai_assistant": Persona(
+        "openai", OPENAI_ASSISTANT_MODEL, OPENAI_ASSISTANT_SYSTEM_PROMPT, 0.4, 1024
+    ),
+}
+
+
+def _persona(name):
+    try:
+        return PERSONAS[name]
+    except KeyError:
+        raise ValueError(f"Unknown persona: {name}") from None
+
+
+def _provider_function(persona, prefix):
+    # Imported on use: the provider modules import this one
+    module = importlib.import_module(f"agents.{persona.provider}_agent")
+    return getattr(module, f"{prefix}{persona.provider}")
+
+
+def _settings(persona, temperature, max_tokens):
+    return (
+        persona.temperature if temperature is None else temperature,
+        persona.max_tokens if max_tokens is None else max_tokens,
+    )
+
+
+def _fit(persona, prompt, max_tokens):
+    """Trim the prompt to the model's budget and keep the estimate for the ledger."""
+    return fit_prompt(
+        persona.system_prompt,
+        prompt,
+        persona.model,
+        max_tokens,
+        getattr(settings, "AGENT_PROMPT_TOKEN_BUDGET", None),
+    )
+
+
+def ask_persona(name, prompt, temperature=None, max_tokens=None, use_memo=None):
+    """
+    Ask a persona from PERSONAS.
+
+    Args:
+        name (str): Persona name, e.g. "claude_dev"
+        prompt (str): The task or question
+        temperature (float): Temperature setting (default: the persona's)
+        max_tokens (int): Maximum tokens in response (default: the persona's)
+        use_memo (bool): Use the on-disk memo cache (default: AGENT_MEMO setting)
+
+    Returns:
+        str: The persona's response
+    """
+    persona = _persona(name)
+    temperature, max_tokens = _settings(persona, temperature, max_tokens)
+    memo_key, cached = memo_lookup(
+        persona.provider,
+        persona.model,
+        persona.system_prompt,
+        prompt,
+        temperature,
+        max_tokens,
+        use_memo,
+    )
+    if cached is not None:
+        return cached
+
+    full_prompt, estimated_tokens = _fit(persona, prompt, max_tokens)
+    text = _provider_function(persona, "ask_")(
+        prompt=full_prompt,
+        model=persona.model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        estimated_tokens=estimated_tokens,
+        call=name,
+        use_memo=False,
+    )
+    memo_store(memo_key, text)
+    return text
+
+
+async def aask_persona(name, prompt, temperature=None, max_tokens=None, use_memo=None):
+    """Async variant of ask_persona; the memo cache is read and written off the event loop."""
+    persona = _persona(name)
+    temperature, max_tokens = _settings(persona, temperature, max_tokens)
+    memo_key, cached = await asyncio.to_thread(
+        memo_lookup,
+        persona.provider,
+        persona.model,
+        persona.system_prompt,
+        prompt,
+        temperature,
+        max_tokens,
+        use_memo,
+    )
+    if cached is not None:
+        return cached
+
+    full_prompt, estimated_tokens = _fit(persona, prompt, max_tokens)
+    text = await _provider_function(persona, "aask_")(
+        prompt=full_prompt,
+        model=persona.model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        estimated_tokens=estimated_tokens,
+        call=name,
+        use_memo=False,
+    )
+    await asyncio.to_thread(memo_store, memo_key, text)
+    return text
+
+
+def stream_persona(name, prompt, temperature=None, max_tokens=None):
+    """Streaming variant of ask_persona; yields the response text as it arrives."""
+    persona = _persona(name)
+    temperature, max_tokens = _settings(persona, temperature, max_tokens)
+    full_prompt, estimated_tokens = _fit(persona, prompt, max_tokens)
+    return (
+        yield from _provider_function(persona, "stream_")(
+            prompt=full_prompt,
+            model=persona.model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            estimated_tokens=estimated_tokens,
+            call=name,
+        )
+    )
@@ -0,0 +1,358 @@
+"""
+Token-bucket rate limiting for the agents, shared by every worker process.
+
+Each provider has two buckets, one for requests per minute and one for tokens
+per minute. A bucket holds up to a minute's allowance (so short bursts are
+allowed) and refills continuously. A call takes from both buckets atomically
+or from neither.
+
+Bucket state lives in a shared store so all gunicorn workers draw on one
+budget (``AGENT_RATE_LIMIT_STORE``):
+    "sqlite" - a SQLite file; BEGIN IMMEDIATE serializes updates across
+               processes on one host (default)
+    "django" - a Django cache alias (use Redis/Memcached for multi-host setups)
+    "memory" - per-process only, for tests and single-process runs
+
+``try_acquire`` never blocks and reports how long to wait; ``acquire``
+(and ``aacquire`` on an event loop) either waits for capacity or raises
+``RateLimitExceeded`` straight away when ``block=False``.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from utils.metrics import observe_rate_limit
+from utils.tokens import count_tokens
+
+# capacity: maximum level; rate: refill per second
+Bucket = namedtuple("Bucket", ["key", "capacity", "rate"])
+
+
+class RateLimitExceeded(Exception):
+    """No capacity is available right now; retry after ``retry_after`` seconds."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Rate limit for {name} exceeded; retry in {retry_after:.2f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def take(buckets, states, costs, now):
+    """
+    Pure token-bucket step for several buckets at once.
+
+    ``states`` maps key to (level, updated_at). Returns
+    ``(granted, retry_after, new_states)``; nothing is deducted unless every
+    bucket can pay its cost.
+    """
+    levels = {}
+    retry_after = 0.0
+    for bucket, cost in zip(buckets, costs):
+        level, updated_at = states.get(bucket.key) or (bucket.capacity, now)
+        # updated_at in the future means the bucket is paused until then
+        paused = max(0.0, updated_at - now)
+        level = min(bucket.capacity, level + max(0.0, now - updated_at) * bucket.rate)
+        levels[bucket.key] = level
+        # A cost above capacity could never be paid; wait for a full bucket instead
+        cost = min(cost, bucket.capacity)
+        if paused or level < cost:
+            retry_after = max(retry_after, paused + max(0.0, cost - level) / bucket.rate)
+
+    if retry_after > 0:
+        return False, retry_after, None
+    new_states = {
+        bucket.key: (levels[bucket.key] - min(cost, bucket.capacity), now)
+        for bucket, cost in zip(buckets, costs)
+    }
+    return True, 0.0, new_states
+
+
+class MemoryStore:
+    """Bucket state for this process only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def transact(self, keys, fn):
+        with self._lock:
+            result, new_states = fn({key: self._states.get(key) for key in keys})
+            if new_states:
+                self._states.update(new_states)
+            return result
+
+
+class SQLiteStore:
+    """Bucket state in a SQLite file shared by every process on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def transact(self, keys, fn):
+        connection = self._connection()
+        # IMMEDIATE takes the write lock up front, so read-modify-write is atomic
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            placeholders = ",".join("?" * len(keys))
+            rows = connection.execute(
+                f"SELECT key, level, updated_at FROM buckets WHERE key IN ({placeholders})",
+                list(keys),
+            ).fetchall()
+            result, new_states = fn({key: (level, updated) for key, level, updated in rows})
+            if new_states:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, level, updated_at) VALUES (?, ?, ?)",
+                    [(key, level, updated) for key, (level, updated) in new_states.items()],
+                )
+            connection.execute("COMMIT")
+            return result
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+
+class DjangoCacheStore:
+    """Bucket state in a Django cache, guarded by an add()-based lock."""
+
+    def __init__(self, alias="default", lock_timeout=5):
+        self.alias = alias
+        self.lock_timeout = lock_timeout
+
+    def transact(self, keys, fn):
+        cache = caches[self.alias]
+        lock_key = "agents:rate_limit:lock:" + ",".join(sorted(keys))
+        deadline = time.monotonic() + self.lock_timeout
+        # add() is atomic on every shared backend; the timeout frees a lock
+        # left behind by a crashed worker
+        while not cache.add(lock_key, 1, timeout=self.lock_timeout):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Timed out waiting for the rate limit lock")
+            time.sleep(0.005)
+        try:
+            raw = cache.get_many([f"agents:rate_limit:{key}" for key in keys])
+            states = {
+                key: tuple(json.loads(raw[f"agents:rate_limit:{key}"]))
+                for key in keys
+                if f"agents:rate_limit:{key}" in raw
+            }
+            result, new_states = fn(states)
+            if new_states:
+                cache.set_many(
+                    {
+                        f"agents:rate_limit:{key}": json.dumps(state)
+                        for key, state in new_states.items()
+                    },
+                    timeout=None,
+                )
+            return result
+        finally:
+            cache.delete(lock_key)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one provider."""
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, store=None):
+        self.name = name
+        self.store = store or MemoryStore()
+        self.buckets = [Bucket(f"{name}:requests", requests_per_minute, requests_per_minute / 60)]
+        if tokens_per_minute:
+            self.buckets.append(
+                Bucket(f"{name}:tokens", tokens_per_minute, tokens_per_minute / 60)
+            )
+        self.granted = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def _costs(self, tokens, requests):
+        return [requests, tokens][: len(self.buckets)]
+
+    def try_acquire(self, tokens=0, requests=1):
+        """Take capacity if it is available now; returns (granted, retry_after)."""
+        costs = self._costs(tokens, requests)
+        keys = [bucket.key for bucket in self.buckets]
+
+        def step(states):
+            granted, retry_after, new_states = take(self.buckets, states, costs, time.time())
+            return (granted, retry_after), new_states
+
+        granted, retry_after = self.store.transact(keys, step)
+        if granted:
+            self.granted += 1
+        else:
+            self.throttled += 1
+        return granted, retry_after
+
+    def acquire(self, tokens=0, requests=1, block=True, timeout=None):
+        """
+        Take capacity, waiting for it if ``block``; returns the seconds waited.
+
+        Raises RateLimitExceeded when not blocking (or when ``timeout`` would
+        be exceeded) and there is no capacity.
+        """
+        started = time.monotonic()
+        while True:
+            granted, retry_after = self.try_acquire(tokens, requests)
+            if granted:
+                waited = time.monotonic() - started
+                self.waited += waited
+                observe_rate_limit(self.name, waited)
+                return waited
+            if not block or (
+                timeout is not None and time.monotonic() - started + retry_after > timeout
+            ):
+                observe_rate_limit(self.name, time.monotonic() - started, rejected=True)
+                raise RateLimitExceeded(self.name, retry_after)
+            time.sleep(retry_after)
+
+    async def aacquire(self, tokens=0, requests=1, block=True, timeout=None):
+        """
+        Async variant of acquire; waits on the event loop instead of sleeping.
+
+        The store is read and written on a worker thread (SQLite and cache
+        round trips block).
+        """
+        started = time.monotonic()
+        while True:
+            granted, retry_after = await asyncio.to_thread(self.try_acquire, tokens, requests)
+            if granted:
+                waited = time.monotonic() - started
+                self.waited += waited
+                observe_rate_limit(self.name, waited)
+                return waited
+            if not block or (
+                timeout is not None and time.monotonic() - started + retry_after > timeout
+            ):
+                observe_rate_limit(self.name, time.monotonic() - started, rejected=True)
+                raise RateLimitExceeded(self.name, retry_after)
+            await asyncio.sleep(retry_after)
+
+    def refund(self, tokens):
+        """Give back reserved tokens that the call did not use."""
+        if tokens <= 0 or len(self.buckets) < 2:
+            return
+        bucket = self.buckets[1]
+
+        def step(states):
+            level, updated_at = states.get(bucket.key) or (bucket.capacity, time.time())
+            return None, {bucket.key: (min(bucket.capacity, level + tokens), updated_at)}
+
+        self.store.transact([bucket.key], step)
+
+    async def arefund(self, tokens):
+        """Async variant of refund, run off the event loop."""
+        await asyncio.to_thread(self.refund, tokens)
+
+    def pause(self, seconds):
+        """
+        Hold every caller, in every process, for ``seconds`` (e.g. a provider's
+        Retry-After). The buckets keep their level and do not refill meanwhile.
+        """
+        now = time.time()
+        resume_at = now + seconds
+
+        def step(states):
+            new_states = {}
+            for bucket in self.buckets:
+                level, updated_at = states.get(bucket.key) or (bucket.capacity, now)
+                level = min(bucket.capacity, level + max(0.0, now - updated_at) * bucket.rate)
+                new_states[bucket.key] = (level, max(updated_at, resume_at))
+            return None, new_states
+
+        self.store.transact([bucket.key for bucket in self.buckets], step)
+        print(f"⏸️ Pausing {self.name} calls for {seconds:.2f}s")
+
+    def stats(self):
+        return {
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "waited": self.waited,
+        }
+
+
+_store = None
+_store_lock = threading.Lock()
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_store():
+    """The shared bucket store selected by AGENT_RATE_LIMIT_STORE."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                kind = getattr(settings, "AGENT_RATE_LIMIT_STORE", "sqlite")
+                if kind == "django":
+                    _store = DjangoCacheStore(
+                        getattr(settings, "AGENT_RATE_LIMIT_CACHE_ALIAS", "default")
+                    )
+                elif kind == "memory":
+                    _store = MemoryStore()
+                else:
+                    _store = SQLiteStore(
+                        getattr(settings, "AGENT_RATE_LIMIT_PATH", None)
+                        or os.path.join(tempfile.gettempdir(), "agents_rate_limits.sqlite3")
+                    )
+    return _store
+
+
+def get_limiter(provider):
+    """The shared limiter for "claude" or "openai", configured from settings."""
+    limiter = _limiters.get(provider)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(provider)
+            if limiter is None:
+                prefix = provider.upper()
+                limiter = RateLimiter(
+                    provider,
+                    getattr(settings, f"{prefix}_REQUESTS_PER_MINUTE", 60),
+                    getattr(settings, f"{prefix}_TOKENS_PER_MINUTE", None),
+                    store=get_store(),
+                )
+                _limiters[provider] = limiter
+    return limiter
+
+
+def stream_tokens_used(used, ttft, estimated_tokens, deltas, model):
+    """
+    Tokens a streamed call used, to settle its reservation.
+
+    Args:
+        used (int): Tokens the provider reported, or None if the stream did not finish
+        ttft (float): Time to the first delta, or None if none arrived
+        estimated_tokens (int): Estimated prompt tokens
+        deltas (list): Text streamed so far
+        model (str): Model the deltas are counted for
+
+    Returns:
+        int: ``used`` when known, 0 if the call failed before any output (it
+            is refunded in full, like a failed non-streaming call), otherwise
+            the prompt plus what was streamed
+    """
+    if used is not None:
+        return used
+    if ttft is None:
+        return 0
+    return estimated_tokens + count_tokens("".join(deltas), model)
@@ -0,0 +1,93 @@
+"""
+Retry policy for agent calls.
+
+Transient errors (AgentRateLimited, AgentOverloaded, AgentTimeout) are
+retried up to ``AGENT_MAX_RETRIES`` times; AgentBadRequest is raised at once.
+When the provider says how long to wait (Retry-After or rate-limit reset
+headers) the retry waits exactly that long and the shared rate limiter is
+paused for the same time, so every worker holds off instead of only this
+call. Otherwise the wait is jittered exponential backoff. A call gives up
+rather than wait longer than ``AGENT_RETRY_MAX_WAIT``.
+
+The SDKs' own retries are disabled (agents.clients) so this is the only
+retry layer.
+"""
+from django.conf import settings
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from utils.metrics import observe_retry
+
+from .errors import AgentOverloaded, AgentRateLimited, agent_error
+
+
+def agent_failure(label, error, limiter):
+    """
+    Map an SDK exception to an AgentError, pausing ``limiter`` when the
+    provider asked for a wait.
+    """
+    error = agent_error(label, error)
+    if isinstance(error, (AgentRateLimited, AgentOverloaded)) and error.retry_after:
+        limiter.pause(error.retry_after)
+    return error
+
+
+def _wait(backoff):
+    def wait(retry_state):
+        error = retry_state.outcome.exception()
+        if getattr(error, "retry_after", None) is not None:
+            return error.retry_after
+        return backoff(retry_state)
+
+    return wait
+
+
+def _stop(max_retries, max_wait):
+    attempts = stop_after_attempt(max_retries + 1)
+
+    def stop(retry_state):
+        if attempts(retry_state):
+            return True
+        # The wait is known before stop runs; give up rather than wait too long
+        return retry_state.upcoming_sleep > max_wait
+
+    return stop
+
+
+def _log(retry_state):
+    error = retry_state.outcome.exception()
+    observe_retry(error.provider, error)
+    print(
+        f"🔁 {type(error).__name__}: {error} - retrying in "
+        f"{retry_state.upcoming_sleep:.2f}s (attempt {retry_state.attempt_number + 1})"
+    )
+
+
+def _policy(max_retries):
+    if max_retries is None:
+        max_retries = getattr(settings, "AGENT_MAX_RETRIES", 3)
+    backoff = wait_random_exponential(
+        multiplier=getattr(settings, "AGENT_RETRY_BASE", 0.5),
+        max=getattr(settings, "AGENT_RETRY_MAX_BACKOFF", 30),
+    )
+    return {
+        "stop": _stop(max_retries, getattr(settings, "AGENT_RETRY_MAX_WAIT", 60)),
+        "wait": _wait(backoff),
+        "retry": retry_if_exception(lambda error: getattr(error, "retryable", False)),
+        "before_sleep": _log,
+        "reraise": True,
+    }
+
+
+def retrying(max_retries=None):
+    """Retry loop for blocking calls: ``for attempt in retrying(): with attempt: ...``"""
+    return Retrying(**_policy(max_retries))
+
+
+def aretrying(max_retries=None):
+    """Retry loop for async calls: ``async for attempt in aretrying(): with attempt: ...``"""
+    return AsyncRetrying(**_policy(max_retries))
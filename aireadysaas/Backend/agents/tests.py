@@ -0,0 +1,477 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from support_agent.stub_llm import StubConfig, make_server
+from utils.tokens import (
+    TRUNCATION_MARK,
+    PromptPart,
+    TokenLedger,
+    count_static,
+    count_tokens,
+    fit_parts,
+    fit_prompt,
+    truncate_tokens,
+)
+
+from . import claude_agent, clients, openai_agent
+from .claude_agent import stream_claude
+from .errors import AgentBadRequest, AgentOverloaded, AgentRateLimited, agent_error
+from .memo import MemoCache
+from .openai_agent import stream_openai
+from .personas import PERSONAS
+from .rate_limit import RateLimiter, RateLimitExceeded, SQLiteStore
+from .retry import agent_failure, retrying
+
+
+class MemoCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "memo.sqlite3")
+
+    def cache(self, max_bytes=1024 * 1024):
+        cache = MemoCache(self.path, max_bytes)
+        self.addCleanup(lambda: cache._connection().close())
+        return cache
+
+    def stored_bytes(self, cache):
+        return cache._connection().execute("SELECT SUM(size) FROM memo").fetchone()[0] or 0
+
+    def test_round_trip_from_many_threads(self):
+        cache = self.cache()
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(50):
+                    key = f"{n}-{i}"
+                    text = f"reply {key} " * (i + 1)
+                    cache.set(key, text)
+                    if cache.get(key) != text:
+                        errors.append(key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(cache.stats()["entries"], 400)
+
+    def test_running_size_matches_the_table(self):
+        cache = self.cache()
+        cache.set("a", "short")
+        cache.set("b", "x" * 500)
+        cache.set("a", "a much longer replacement reply " * 20)
+        self.assertEqual(cache.stats()["bytes"], self.stored_bytes(cache))
+        # A second process opening the file sees the same total
+        self.assertEqual(self.cache().stats()["bytes"], self.stored_bytes(cache))
+        cache.clear()
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = self.cache(max_bytes=2000)
+        texts = {key: os.urandom(300).hex() for key in "abcdefgh"}
+        for key, text in texts.items():
+            cache.set(key, text)
+            # Keep "a" fresh
+            self.assertEqual(cache.get("a"), texts["a"])
+            cache._flush_touches(cache._connection())
+        self.assertLessEqual(cache.stats()["bytes"], 2000)
+        self.assertEqual(cache.stats()["bytes"], self.stored_bytes(cache))
+        self.assertGreater(cache.evictions, 0)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), texts["a"])
+
+    def test_evictions_are_logged_once_per_write_outside_the_transaction(self):
+        cache = self.cache(max_bytes=1000)
+        for key in "abc":
+            cache.set(key, os.urandom(300).hex())
+        connection = cache._connection()
+        logged = []
+
+        def log(message):
+            logged.append((message, connection.in_transaction))
+
+        with mock.patch("builtins.print", side_effect=log):
+            cache.set("d", os.urandom(300).hex())
+        self.assertEqual(len(logged), 1)
+        self.assertIn("Evicted", logged[0][0])
+        self.assertFalse(logged[0][1])
+
+
+class StreamRefundTests(SimpleTestCase):
+    """Streams settle their token reservation however they end (against the stub LLM)."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        config = StubConfig(latency="fixed:0", token_latency="fixed:0", reply_tokens=20, seed=1)
+        cls.server = make_server("127.0.0.1", 0, config)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%d" % cls.server.server_address[1]
+        cls.settings_override = override_settings(
+            ANTHROPIC_API_KEY="test",
+            OPENAI_API_KEY="test",
+            CLAUDE_BASE_URL=url,
+            OPENAI_BASE_URL=f"{url}/v1",
+            METRICS_ENABLED=False,
+        )
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def stream(self, stream_function, prompt):
+        limiter = mock.Mock()
+        module = stream_function.__module__
+        with mock.patch(f"{module}.get_limiter", return_value=limiter):
+            yield limiter, stream_function(prompt, max_tokens=100, estimated_tokens=10)
+
+    # Each stream function with its default model
+    STREAMS = ((stream_openai, "gpt-3.5-turbo"), (stream_claude, "claude-3-sonnet-20240229"))
+
+    def refunded(self, limiter):
+        limiter.refund.assert_called_once()
+        return limiter.refund.call_args[0][0]
+
+    def test_finished_stream_refunds_what_the_provider_did_not_use(self):
+        for stream_function, model in self.STREAMS:
+            for limiter, stream in self.stream(stream_function, "hello"):
+                parts = list(stream)
+            self.assertEqual(len(parts), 20)
+            # The stub reports the prompt as it counts it
+            prompt_tokens = count_tokens("hello", model)
+            self.assertEqual(self.refunded(limiter), 110 - prompt_tokens - 20, stream_function)
+
+    def test_stream_closed_early_refunds_the_unused_part(self):
+        for stream_function, model in self.STREAMS:
+            for limiter, stream in self.stream(stream_function, "hello"):
+                first = next(stream)
+                stream.close()
+            used = 10 + count_tokens(first, model)
+            self.assertEqual(self.refunded(limiter), 110 - used, stream_function)
+
+    def test_stream_failing_before_output_refunds_everything(self):
+        for stream_function, _ in self.STREAMS:
+            for limiter, stream in self.stream(stream_function, "hello [stub:500]"):
+                with self.assertRaises(AgentOverloaded):
+                    list(stream)
+            self.assertEqual(self.refunded(limiter), 110, stream_function)
+
+
+class TokenBudgetTests(SimpleTestCase):
+    MODEL = "claude-3-sonnet-20240229"
+
+    def setUp(self):
+        patcher = mock.patch("builtins.print")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lowest_priority_part_is_trimmed_first(self):
+        parts = [
+            PromptPart("question", "where is my order " * 5, priority=2),
+            PromptPart("knowledge", "shipping policy text " * 200),
+            PromptPart("history", "earlier turn " * 10, priority=1),
+        ]
+        texts, estimated = fit_parts(parts, 150, self.MODEL, overhead=20)
+        self.assertLessEqual(estimated, 150)
+        self.assertEqual(texts["question"], parts[0].text)
+        self.assertEqual(texts["history"], parts[2].text)
+        self.assertTrue(texts["knowledge"].endswith(TRUNCATION_MARK))
+        self.assertTrue(parts[1].text.startswith(texts["knowledge"][:-1]))
+
+    def test_parts_are_dropped_once_trimming_is_not_enough(self):
+        parts = [PromptPart("question", "why " * 40, priority=1), PromptPart("knowledge", "x" * 400)]
+        texts, estimated = fit_parts(parts, 40, self.MODEL)
+        self.assertEqual(texts["knowledge"], "")
+        self.assertTrue(texts["question"].endswith(TRUNCATION_MARK))
+        self.assertLessEqual(estimated, 40)
+
+    def test_prompts_within_the_budget_are_untouched(self):
+        parts = [PromptPart("question", "hello")]
+        self.assertEqual(fit_parts(parts, 100, self.MODEL), ({"question": "hello"}, 1))
+        self.assertEqual(fit_parts(parts, None, self.MODEL)[0], {"question": "hello"})
+
+    def test_fit_prompt_keeps_the_system_prompt_and_cuts_the_prompt(self):
+        system_prompt = "You are a support agent."
+        full, estimated = fit_prompt(system_prompt, "tell me " * 500, self.MODEL, budget=100)
+        self.assertTrue(full.startswith(f"{system_prompt}\n\n"))
+        self.assertTrue(full.endswith(TRUNCATION_MARK))
+        self.assertLessEqual(estimated, 100)
+
+    def test_default_budget_is_the_context_window_minus_the_reply(self):
+        _, estimated = fit_prompt("system", "prompt", "gpt-4", max_tokens=100)
+        full, trimmed = fit_prompt("system", "word " * 40_000, "gpt-4", max_tokens=100)
+        self.assertLess(estimated, 10)
+        self.assertLessEqual(trimmed, 8_192 - 100)
+
+    def test_truncation_can_keep_the_tail(self):
+        text = "first " + "middle " * 100 + "last"
+        kept = truncate_tokens(text, 10, self.MODEL, keep="tail")
+        self.assertTrue(kept.startswith(TRUNCATION_MARK))
+        self.assertTrue(kept.endswith("last"))
+        self.assertEqual(truncate_tokens(text, 0, self.MODEL), "")
+
+    def test_static_text_is_counted_once_per_model(self):
+        text = "A system prompt only this test uses."
+        before = count_static.cache_info()
+        for _ in range(3):
+            self.assertEqual(count_static(text, self.MODEL), count_tokens(text, self.MODEL))
+        after = count_static.cache_info()
+        self.assertEqual(after.misses - before.misses, 1)
+        self.assertEqual(after.hits - before.hits, 2)
+
+    def test_ledger_totals_estimated_and_actual_tokens_per_call(self):
+        ledger = TokenLedger(recent=2)
+        ledger.record("claude_dev", self.MODEL, 100, 90)
+        ledger.record("claude_dev", self.MODEL, 50)
+        ledger.record("support", "gpt-4", 10, 12)
+        self.assertEqual(
+            ledger.stats(),
+            {
+                "claude_dev": {"calls": 2, "estimated": 150, "actual": 90, "measured_calls": 1},
+                "support": {"calls": 1, "estimated": 10, "actual": 12, "measured_calls": 1},
+            },
+        )
+        self.assertEqual([entry["call"] for entry in ledger.recent()], ["claude_dev", "support"])
+
+
+@override_settings(CLAUDE_BASE_URL="", OPENAI_BASE_URL="")
+class ClientRegistryTests(SimpleTestCase):
+    def setUp(self):
+        # Keys of these tests only, so the shared clients of other tests survive
+        self.addCleanup(self.forget, "registry-a", "registry-b")
+
+    def forget(self, *api_keys):
+        for key in [key for key in clients._clients if key[1] in api_keys]:
+            clients._clients.pop(key).close()
+
+    def test_one_client_per_provider_key_and_base_url(self):
+        claude = clients.get_client("claude", "registry-a")
+        self.assertIs(clients.get_client("claude", "registry-a"), claude)
+        self.assertIsNot(clients.get_client("claude", "registry-b"), claude)
+        self.assertIsNot(clients.get_client("openai", "registry-a"), claude)
+        other = clients.get_client("claude", "registry-a", "http://127.0.0.1:9/")
+        self.assertIsNot(other, claude)
+        self.assertEqual(str(other.base_url), "http://127.0.0.1:9/")
+
+    def test_base_url_defaults_to_the_setting(self):
+        url = "http://127.0.0.1:9/v1"
+        with override_settings(OPENAI_BASE_URL=url):
+            client = clients.get_client("openai", "registry-a")
+            self.assertIs(clients.get_client("openai", "registry-a", url), client)
+        self.assertEqual(str(client.base_url), "http://127.0.0.1:9/v1/")
+        self.assertIsNot(clients.get_client("openai", "registry-a"), client)
+
+    def test_concurrent_first_use_builds_one_client(self):
+        build = mock.Mock(side_effect=lambda *args: (time.sleep(0.01), object())[1])
+        barrier = threading.Barrier(8)
+        seen = []
+
+        def worker():
+            barrier.wait()
+            seen.append(clients.get_client("claude", "registry-a"))
+
+        with mock.patch.object(clients, "_build", build):
+            threads = [threading.Thread(target=worker) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        clients._clients.pop(("claude", "registry-a", None))
+        build.assert_called_once()
+        self.assertEqual(len({id(client) for client in seen}), 1)
+
+    def test_sdk_retries_are_left_to_agents_retry(self):
+        self.assertEqual(clients.get_client("openai", "registry-a").max_retries, 0)
+        self.assertEqual(clients.get_client("claude", "registry-a").max_retries, 0)
+
+    def test_async_clients_are_shared_per_event_loop(self):
+        async def shared():
+            first = clients.get_async_client("openai", "registry-a")
+            second = clients.get_async_client("openai", "registry-a")
+            await clients.aclose_clients()
+            return first, second
+
+        first, second = asyncio.run(shared())
+        self.assertIs(first, second)
+        self.assertIsNot(asyncio.run(shared())[0], first)
+
+
+class PersonaTests(SimpleTestCase):
+    def test_every_persona_calls_its_provider_with_its_model_prompt_and_name(self):
+        for name, persona in PERSONAS.items():
+            module = {"claude": claude_agent, "openai": openai_agent}[persona.provider]
+            with self.subTest(name), mock.patch.object(
+                module, f"ask_{persona.provider}", return_value="reply"
+            ) as ask:
+                self.assertEqual(getattr(module, f"ask_{name}")("Fix the login view"), "reply")
+            kwargs = ask.call_args.kwargs
+            self.assertEqual(kwargs["model"], persona.model)
+            self.assertEqual(kwargs["call"], name)
+            self.assertEqual(kwargs["temperature"], persona.temperature)
+            self.assertEqual(kwargs["max_tokens"], persona.max_tokens)
+            self.assertIn(persona.system_prompt, kwargs["prompt"])
+            self.assertIn("Fix the login view", kwargs["prompt"])
+
+    def test_explicit_settings_override_the_persona_defaults(self):
+        with mock.patch.object(openai_agent, "ask_openai", return_value="reply") as ask:
+            openai_agent.ask_openai_dev("hi", temperature=0.9, max_tokens=64)
+        self.assertEqual(ask.call_args.kwargs["temperature"], 0.9)
+        self.assertEqual(ask.call_args.kwargs["max_tokens"], 64)
+
+    def test_async_persona_uses_the_memo_cache_off_the_event_loop(self):
+        threads = {}
+
+        def lookup(*args):
+            threads["lookup"] = threading.get_ident()
+            return "key", None
+
+        def store(key, text):
+            threads["store"] = threading.get_ident()
+
+        async def run():
+            threads["loop"] = threading.get_ident()
+            return await claude_agent.aask_claude_throttle("Summarize this")
+
+        with mock.patch("agents.personas.memo_lookup", lookup), mock.patch(
+            "agents.personas.memo_store", store
+        ), mock.patch.object(
+            claude_agent, "aask_claude", mock.AsyncMock(return_value="summary")
+        ) as aask:
+            self.assertEqual(asyncio.run(run()), "summary")
+        self.assertEqual(aask.call_args.kwargs["call"], "claude_throttle")
+        self.assertNotEqual(threads["lookup"], threads["loop"])
+        self.assertNotEqual(threads["store"], threads["loop"])
+
+
+@override_settings(METRICS_ENABLED=False)
+class AsyncRateLimiterTests(SimpleTestCase):
+    def test_aacquire_and_arefund_touch_the_store_off_the_event_loop(self):
+        limiter = RateLimiter("test", 60, 1000)
+        transact = limiter.store.transact
+        threads = []
+
+        def recording(keys, fn):
+            threads.append(threading.get_ident())
+            return transact(keys, fn)
+
+        limiter.store.transact = recording
+
+        async def run():
+            await limiter.aacquire(tokens=600)
+            await limiter.arefund(400)
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(run())
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+        granted, _ = limiter.try_acquire(tokens=800)
+        self.assertTrue(granted)
+
+
+@override_settings(METRICS_ENABLED=False)
+class RateLimiterTests(SimpleTestCase):
+    def test_a_call_takes_from_both_buckets_or_neither(self):
+        limiter = RateLimiter("test", 2, 1000)
+        self.assertTrue(limiter.try_acquire(tokens=900)[0])
+        # Too many tokens: the request bucket is left alone
+        granted, retry_after = limiter.try_acquire(tokens=900)
+        self.assertFalse(granted)
+        self.assertGreater(retry_after, 0)
+        self.assertTrue(limiter.try_acquire(tokens=100)[0])
+        # Request bucket empty now, whatever the tokens
+        self.assertFalse(limiter.try_acquire(tokens=0)[0])
+
+    def test_refund_returns_unused_tokens(self):
+        limiter = RateLimiter("test", 60, 1000)
+        limiter.acquire(tokens=1000)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(tokens=500, block=False)
+        limiter.refund(600)
+        self.assertTrue(limiter.try_acquire(tokens=500)[0])
+
+    def test_pause_holds_every_caller(self):
+        limiter = RateLimiter("test", 60, 1000)
+        limiter.pause(30)
+        granted, retry_after = limiter.try_acquire(tokens=1)
+        self.assertFalse(granted)
+        self.assertGreater(retry_after, 25)
+
+    def test_processes_sharing_a_sqlite_store_share_one_budget(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "limits.sqlite3")
+        first = RateLimiter("test", 3, store=SQLiteStore(path))
+        second = RateLimiter("test", 3, store=SQLiteStore(path))
+        self.assertTrue(first.try_acquire()[0])
+        self.assertTrue(second.try_acquire()[0])
+        self.assertTrue(first.try_acquire()[0])
+        self.assertFalse(second.try_acquire()[0])
+
+
+class _SDKError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = mock.Mock(headers=headers or {})
+
+
+@override_settings(
+    METRICS_ENABLED=False, AGENT_RETRY_BASE=0.001, AGENT_RETRY_MAX_BACKOFF=0.01
+)
+class RetryTests(SimpleTestCase):
+    def run_with_failures(self, failures, max_retries=3):
+        calls = []
+        for attempt in retrying(max_retries):
+            with attempt:
+                calls.append(1)
+                if len(calls) <= len(failures):
+                    raise failures[len(calls) - 1]
+                return len(calls)
+
+    def test_sdk_errors_are_mapped_by_status(self):
+        self.assertIsInstance(agent_error("OpenAI", _SDKError(429)), AgentRateLimited)
+        self.assertIsInstance(agent_error("OpenAI", _SDKError(503)), AgentOverloaded)
+        self.assertIsInstance(agent_error("OpenAI", _SDKError(400)), AgentBadRequest)
+        error = agent_error("Claude", _SDKError(429, {"retry-after": "7"}))
+        self.assertEqual(error.retry_after, 7)
+        self.assertEqual(str(error), "Claude API error: status 429")
+
+    def test_transient_failures_are_retried(self):
+        failures = [AgentOverloaded("busy", "openai"), AgentRateLimited("slow down", "openai")]
+        self.assertEqual(self.run_with_failures(failures), 3)
+
+    def test_bad_requests_are_not_retried(self):
+        with self.assertRaises(AgentBadRequest):
+            self.run_with_failures([AgentBadRequest("bad", "openai")] * 2)
+
+    def test_gives_up_after_max_retries(self):
+        with self.assertRaises(AgentOverloaded):
+            self.run_with_failures([AgentOverloaded("busy", "openai")] * 3, max_retries=2)
+
+    @override_settings(AGENT_RETRY_MAX_WAIT=5)
+    def test_retry_after_longer_than_the_max_wait_gives_up_at_once(self):
+        failures = [AgentRateLimited("slow down", "openai", retry_after=60)]
+        started = time.monotonic()
+        with self.assertRaises(AgentRateLimited):
+            self.run_with_failures(failures)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_provider_wait_pauses_the_shared_limiter(self):
+        limiter = mock.Mock()
+        error = agent_failure("OpenAI", _SDKError(429, {"retry-after-ms": "1500"}), limiter)
+        self.assertIsInstance(error, AgentRateLimited)
+        limiter.pause.assert_called_once_with(1.5)
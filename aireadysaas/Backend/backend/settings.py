@@ -182,3 +182,184 @@ AUTH_USER_MODEL = "accounts.User"
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 USE_OLLAMA = os.getenv("USE_OLLAMA", "false").lower() == "true"
+
+# LLM_BACKEND=stub sends every LLM call (support backends and agents) to the
+# local stand-in served by `manage.py run_llm_stub` instead of the real APIs;
+# LLM_BACKENDS (below) still picks which of those APIs support speaks to it
+LLM_BACKEND = os.getenv("LLM_BACKEND", "live").lower()
+LLM_STUB_URL = os.getenv("LLM_STUB_URL", "http://127.0.0.1:8765").rstrip("/")
+if LLM_BACKEND == "stub":
+    # The stand-in accepts any key
+    ANTHROPIC_API_KEY = ANTHROPIC_API_KEY or "stub"
+    OPENAI_API_KEY = OPENAI_API_KEY or "stub"
+
+# Support agent FAQ matching
+# Max FAQ questions scored exactly per query after the n-gram prefilter (0 = score all)
+FAQ_CANDIDATE_LIMIT = int(os.getenv("FAQ_CANDIDATE_LIMIT", "200"))
+# Seconds a worker trusts its FAQ index before re-reading the FAQ version from
+# the database; edits made in other workers show up within this interval
+FAQ_VERSION_CHECK_INTERVAL = float(os.getenv("FAQ_VERSION_CHECK_INTERVAL", "2"))
+
+# Optional semantic FAQ retrieval (faiss + pluggable embedder) for lexical misses
+FAQ_VECTOR_SEARCH = os.getenv("FAQ_VECTOR_SEARCH", "false").lower() == "true"
+FAQ_EMBEDDER = os.getenv("FAQ_EMBEDDER", "support_agent.embeddings.HashingEmbedder")
+FAQ_EMBED_BATCH_SIZE = int(os.getenv("FAQ_EMBED_BATCH_SIZE", "256"))
+FAQ_VECTOR_TOP_K = int(os.getenv("FAQ_VECTOR_TOP_K", "5"))
+FAQ_VECTOR_IVF_THRESHOLD = int(os.getenv("FAQ_VECTOR_IVF_THRESHOLD", "50000"))
+FAQ_VECTOR_NPROBE = int(os.getenv("FAQ_VECTOR_NPROBE", "8"))
+# Share of the hybrid score given to cosine similarity (rest is the rapidfuzz ratio)
+FAQ_HYBRID_WEIGHT = float(os.getenv("FAQ_HYBRID_WEIGHT", "0.6"))
+FAQ_HYBRID_THRESHOLD = float(os.getenv("FAQ_HYBRID_THRESHOLD", "60"))
+
+# Knowledge base retrieval: only the top-k markdown chunks within the token budget go into prompts
+KNOWLEDGE_DIR = Path(os.getenv("KNOWLEDGE_DIR", BASE_DIR / "knowledge"))
+KNOWLEDGE_TOP_K = int(os.getenv("KNOWLEDGE_TOP_K", "4"))
+KNOWLEDGE_TOKEN_BUDGET = int(os.getenv("KNOWLEDGE_TOKEN_BUDGET", "1200"))
+KNOWLEDGE_CHUNK_CHARS = int(os.getenv("KNOWLEDGE_CHUNK_CHARS", "1200"))
+# Seconds between checks of the knowledge directory for changed files (-1 disables hot reload)
+KNOWLEDGE_RELOAD_INTERVAL = float(os.getenv("KNOWLEDGE_RELOAD_INTERVAL", "5"))
+
+# Support answer cache: "memory" (per-process LRU), "django" (shared Django cache alias) or "off".
+# "django" (and SUPPORT_SINGLEFLIGHT_SHARED, AGENT_RATE_LIMIT_STORE=django) only
+# share state between workers if the alias is a shared cache such as Redis or
+# Memcached; the default local-memory cache is per process (`manage.py check` warns)
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")
+LLM_CACHE_ALIAS = os.getenv("LLM_CACHE_ALIAS", "default")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+# Let the frontend read per-request cache status
+CORS_EXPOSE_HEADERS = ["X-LLM-Cache", "X-Coalesced"]
+
+# Single-flight: identical in-flight support queries share one LLM call.
+# Waiters fall back to their own call after the timeout; SHARED extends this
+# across workers through the Django cache (requires LLM_CACHE_BACKEND=django).
+SUPPORT_SINGLEFLIGHT_TIMEOUT = float(os.getenv("SUPPORT_SINGLEFLIGHT_TIMEOUT", "30"))
+SUPPORT_SINGLEFLIGHT_SHARED = os.getenv("SUPPORT_SINGLEFLIGHT_SHARED", "false").lower() == "true"
+
+# Pooled HTTP client used by the async support pipeline (/api/ask/async/)
+LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", "60"))
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "20"))
+
+# Batch support endpoint (/api/ask/batch/)
+SUPPORT_BATCH_MAX_ITEMS = int(os.getenv("SUPPORT_BATCH_MAX_ITEMS", "1000"))
+# Max concurrent LLM calls per batch (also the cap for a client-requested value)
+SUPPORT_BATCH_CONCURRENCY = int(os.getenv("SUPPORT_BATCH_CONCURRENCY", "8"))
+
+# Write-behind chat history: queue rows in memory and bulk insert them from a
+# background thread every FLUSH_SIZE rows or FLUSH_INTERVAL seconds
+CHAT_HISTORY_WRITE_BEHIND = os.getenv("CHAT_HISTORY_WRITE_BEHIND", "false").lower() == "true"
+CHAT_HISTORY_FLUSH_SIZE = int(os.getenv("CHAT_HISTORY_FLUSH_SIZE", "100"))
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL", "1.0"))
+# Flushes a row that fails to insert is tried in before it is dropped (and logged)
+CHAT_HISTORY_WRITE_ATTEMPTS = int(os.getenv("CHAT_HISTORY_WRITE_ATTEMPTS", "3"))
+
+# Chat history API page sizes (keyset pagination)
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "50"))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", "200"))
+
+# Chat history retention: rows older than CHAT_ARCHIVE_AFTER_DAYS are moved
+# into zstd-compressed ChatArchive segments by `manage.py archive_chat_history`
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "90"))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.getenv("CHAT_ARCHIVE_BATCH_SIZE", "1000"))
+CHAT_ARCHIVE_SEGMENT_ROWS = int(os.getenv("CHAT_ARCHIVE_SEGMENT_ROWS", "5000"))
+CHAT_ARCHIVE_ZSTD_LEVEL = int(os.getenv("CHAT_ARCHIVE_ZSTD_LEVEL", "10"))
+
+# Multi-turn conversation context: recent turns within a token budget plus a
+# rolling summary of older turns, refreshed every SUMMARY_EVERY turns
+CONVERSATION_CONTEXT = os.getenv("CONVERSATION_CONTEXT", "false").lower() == "true"
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "6"))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "600"))
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "200"))
+CONVERSATION_SUMMARY_EVERY = int(os.getenv("CONVERSATION_SUMMARY_EVERY", "4"))
+CONVERSATION_SUMMARY_MAX_FOLD = int(os.getenv("CONVERSATION_SUMMARY_MAX_FOLD", "20"))
+# Background threads that fold turns into summaries off the request path
+CONVERSATION_SUMMARY_WORKERS = int(os.getenv("CONVERSATION_SUMMARY_WORKERS", "2"))
+
+# Prompt token budgets (utils/tokens.py). Agent prompts default to the model's
+# context window minus max_tokens when AGENT_PROMPT_TOKEN_BUDGET is unset
+SUPPORT_PROMPT_TOKEN_BUDGET = int(os.getenv("SUPPORT_PROMPT_TOKEN_BUDGET", "3000"))
+AGENT_PROMPT_TOKEN_BUDGET = int(os.getenv("AGENT_PROMPT_TOKEN_BUDGET", "0")) or None
+
+# Latency budget for one /api/ask/ request; the LLM call only gets the time
+# left after FAQ search, then the FAQ answer (or a canned message) is returned
+SUPPORT_REQUEST_BUDGET = float(os.getenv("SUPPORT_REQUEST_BUDGET", "20"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "3"))
+
+# LLM provider router: ordered backends (openai, ollama, claude, openai_agent),
+# hedged requests past the primary's latency percentile, circuit breakers
+LLM_BACKENDS = [
+    name.strip()
+    for name in os.getenv("LLM_BACKENDS", "ollama" if USE_OLLAMA else "openai").split(",")
+    if name.strip()
+]
+LLM_HEDGE = os.getenv("LLM_HEDGE", "true").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "2.0"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+LLM_ROUTER_WORKERS = int(os.getenv("LLM_ROUTER_WORKERS", "32"))
+# Sync hedge losers keep their worker until they time out; stop hedging while
+# this many are still running
+LLM_HEDGE_MAX_ABANDONED = int(os.getenv("LLM_HEDGE_MAX_ABANDONED", "8"))
+
+# Agent rate limits (agents/rate_limit.py): token buckets shared by all worker
+# processes through AGENT_RATE_LIMIT_STORE ("sqlite" file per host, "django"
+# cache alias for multi-host setups, or per-process "memory")
+AGENT_RATE_LIMIT_STORE = os.getenv("AGENT_RATE_LIMIT_STORE", "sqlite")
+AGENT_RATE_LIMIT_PATH = os.getenv("AGENT_RATE_LIMIT_PATH", "")
+AGENT_RATE_LIMIT_CACHE_ALIAS = os.getenv("AGENT_RATE_LIMIT_CACHE_ALIAS", "default")
+CLAUDE_REQUESTS_PER_MINUTE = int(os.getenv("CLAUDE_REQUESTS_PER_MINUTE", "45"))
+CLAUDE_TOKENS_PER_MINUTE = int(os.getenv("CLAUDE_TOKENS_PER_MINUTE", "40000"))
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "90000"))
+
+# Agent SDK base URLs (agents/clients.py); empty uses the SDK default
+# (LLM_BACKEND=stub defaults both to the local stand-in)
+CLAUDE_BASE_URL = os.getenv(
+    "CLAUDE_BASE_URL", LLM_STUB_URL if LLM_BACKEND == "stub" else ""
+)
+OPENAI_BASE_URL = os.getenv(
+    "OPENAI_BASE_URL", f"{LLM_STUB_URL}/v1" if LLM_BACKEND == "stub" else ""
+)
+
+# Calls in flight at once for agents.batch.ask_many
+AGENT_CONCURRENCY = int(os.getenv("AGENT_CONCURRENCY", "8"))
+
+# Opt-in on-disk memo cache for agent replies (agents/memo.py); callers can
+# bypass it per call with use_memo=False
+AGENT_MEMO = os.getenv("AGENT_MEMO", "false").lower() == "true"
+AGENT_MEMO_PATH = os.getenv("AGENT_MEMO_PATH", "")
+AGENT_MEMO_MAX_MB = int(os.getenv("AGENT_MEMO_MAX_MB", "256"))
+AGENT_MEMO_ZSTD_LEVEL = int(os.getenv("AGENT_MEMO_ZSTD_LEVEL", "3"))
+
+# Agent retries (agents/retry.py): transient errors are retried with jittered
+# exponential backoff, or exactly the provider's Retry-After when it sends one
+AGENT_MAX_RETRIES = int(os.getenv("AGENT_MAX_RETRIES", "3"))
+AGENT_RETRY_BASE = float(os.getenv("AGENT_RETRY_BASE", "0.5"))
+AGENT_RETRY_MAX_BACKOFF = float(os.getenv("AGENT_RETRY_MAX_BACKOFF", "30"))
+AGENT_RETRY_MAX_WAIT = float(os.getenv("AGENT_RETRY_MAX_WAIT", "60"))
+
+# LLM call metrics (utils/metrics.py), served at /metrics. A thread in each worker
+# flushes its values to METRICS_PATH (default: llm_metrics.sqlite3 in the temp
+# dir) every METRICS_FLUSH_INTERVAL seconds and the endpoint sums all workers.
+# Workers that exit or go METRICS_RETIRE_AFTER seconds without flushing are
+# folded into a single retired total. The endpoint is off until METRICS_TOKEN
+# is set; scrapers then send it as a bearer token
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+METRICS_RETIRE_AFTER = float(os.getenv("METRICS_RETIRE_AFTER", "600"))
+
+# Stub LLM behaviour (support_agent/stub_llm.py): latencies in ms as
+# "fixed:200", "uniform:100,400", "normal:300,80" or "lognormal:400,0.5";
+# failures as "429:0.05,500:0.01,timeout:0.005"
+LLM_STUB_LATENCY = os.getenv("LLM_STUB_LATENCY", "lognormal:400,0.5")
+LLM_STUB_TOKEN_LATENCY = os.getenv("LLM_STUB_TOKEN_LATENCY", "fixed:20")
+LLM_STUB_REPLY_TOKENS = int(os.getenv("LLM_STUB_REPLY_TOKENS", "60"))
+LLM_STUB_FAILURES = os.getenv("LLM_STUB_FAILURES", "")
+LLM_STUB_RETRY_AFTER = float(os.getenv("LLM_STUB_RETRY_AFTER", "1"))
+LLM_STUB_HANG = float(os.getenv("LLM_STUB_HANG", "300"))
+LLM_STUB_SEED = int(os.getenv("LLM_STUB_SEED")) if os.getenv("LLM_STUB_SEED") else None
@@ -2,11 +2,13 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from custom_admin.admin import custom_admin_site  # Import your custom admin site
+from support_agent.views import metrics
 
 urlpatterns = [
     path("admin/", custom_admin_site.urls),  # Use the custom admin
     path("api/", include("accounts.urls")),
     path("api/", include("support_agent.urls")),
+    path("metrics", metrics),  # Prometheus scrape endpoint
 ]
 
 # ✅ Serve media files only in development
@@ -3,7 +3,7 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.staticfiles.storage import staticfiles_storage
 from accounts.models import User, UserProfile, Contact  # Import your models
-from support_agent.models import FAQ, ChatHistory
+from support_agent.models import FAQ, ChatArchive, ChatHistory
 
 
 class CustomAdminSite(admin.AdminSite):
@@ -81,10 +81,20 @@ class ChatHistoryAdmin(admin.ModelAdmin):
     )  # Shows chat details
     search_fields = ("user_id", "question", "response")  # Enables search bar
     list_filter = ("timestamp",)  # Allows filtering by date
-    ordering = ("-timestamp",)  # Orders by newest first
+    ordering = ("-timestamp", "-id")  # Orders by newest first (indexed)
     list_per_page = 20  # Shows 20 records per page
+    show_full_result_count = False  # Skip a second COUNT(*) over the whole table
     readonly_fields = ("user_id", "question", "response", "timestamp")
 
 
+class ChatArchiveAdmin(admin.ModelAdmin):
+    list_display = ("user_id", "first_timestamp", "last_timestamp", "row_count")
+    search_fields = ("user_id",)
+    ordering = ("-last_timestamp", "-id")
+    exclude = ("data",)  # Compressed segment; read it through the archive API
+    readonly_fields = ("user_id", "first_timestamp", "last_timestamp", "row_count")
+
+
 custom_admin_site.register(FAQ, FAQAdmin)
 custom_admin_site.register(ChatHistory, ChatHistoryAdmin)
+custom_admin_site.register(ChatArchive, ChatArchiveAdmin)
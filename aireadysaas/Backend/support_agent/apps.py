@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class SupportAgentConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'support_agent'
+
+    def ready(self):
+        import support_agent.signals  # noqa: F401  # Ensure signals are loaded
+        import support_agent.checks  # noqa: F401  # Register the shared-cache checks
@@ -0,0 +1,184 @@
+"""
+Retention for ChatHistory: move old rows into compressed archive segments.
+
+Rows older than a cutoff are read in windows of ``segment_rows`` ordered by
+(user_id, timestamp, id), streamed with ``iterator(chunk_size=...)``, and
+written as one zstd-compressed JSONL ``ChatArchive`` segment per user per
+window. Each window's archive insert and the matching deletes (in batches of
+``batch_size`` ids) run in one transaction, so an interrupted run never
+loses or duplicates rows. Archived chats are read back with
+``load_archived`` / ``archived_page``.
+"""
+import json
+from datetime import datetime, timedelta
+
+import zstandard
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ChatArchive, ChatHistory
+
+ARCHIVE_FIELDS = ("uuid", "user_id", "question", "response", "timestamp")
+
+
+def default_cutoff():
+    days = getattr(settings, "CHAT_ARCHIVE_AFTER_DAYS", 90)
+    return timezone.now() - timedelta(days=days)
+
+
+def compress_rows(rows, level=None):
+    """Encode rows as JSONL and compress them with zstd."""
+    level = level or getattr(settings, "CHAT_ARCHIVE_ZSTD_LEVEL", 10)
+    payload = "".join(json.dumps(row, default=str) + "\n" for row in rows)
+    return zstandard.ZstdCompressor(level=level).compress(payload.encode("utf-8"))
+
+
+def decompress_rows(data):
+    """Decode one archive segment back into a list of row dicts (oldest first)."""
+    payload = zstandard.ZstdDecompressor().decompress(bytes(data)).decode("utf-8")
+    rows = [json.loads(line) for line in payload.splitlines() if line]
+    for row in rows:
+        row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+    return rows
+
+
+def _write_window(segments, batch_size, level):
+    """Store one window's segments and delete their source rows atomically."""
+    archives = []
+    ids = []
+    for user_id, rows in segments.items():
+        archives.append(
+            ChatArchive(
+                user_id=user_id,
+                first_timestamp=rows[0]["timestamp"],
+                last_timestamp=rows[-1]["timestamp"],
+                row_count=len(rows),
+                data=compress_rows(
+                    [{field: row[field] for field in ARCHIVE_FIELDS} for row in rows], level
+                ),
+            )
+        )
+        ids.extend(row["id"] for row in rows)
+
+    with transaction.atomic():
+        ChatArchive.objects.bulk_create(archives)
+        for start in range(0, len(ids), batch_size):
+            ChatHistory.objects.filter(id__in=ids[start:start + batch_size]).delete()
+    return archives
+
+
+def archive_chat_history(
+    cutoff=None,
+    batch_size=None,
+    segment_rows=None,
+    chunk_size=2000,
+    limit=None,
+    level=None,
+    dry_run=False,
+):
+    """
+    Archive every ChatHistory row older than cutoff; returns run statistics.
+
+    ``limit`` caps the number of rows moved in this run so a scheduled job
+    can work through a large backlog a slice at a time.
+    """
+    cutoff = cutoff or default_cutoff()
+    batch_size = batch_size or getattr(settings, "CHAT_ARCHIVE_BATCH_SIZE", 1000)
+    segment_rows = segment_rows or getattr(settings, "CHAT_ARCHIVE_SEGMENT_ROWS", 5000)
+
+    stats = {"rows": 0, "segments": 0, "raw_bytes": 0, "compressed_bytes": 0}
+    if dry_run:
+        old = ChatHistory.objects.filter(timestamp__lt=cutoff)
+        stats["rows"] = old.count() if limit is None else min(old.count(), limit)
+        stats["users"] = old.values("user_id").distinct().count()
+        return stats
+
+    last_user = ""
+    while limit is None or stats["rows"] < limit:
+        window = segment_rows if limit is None else min(segment_rows, limit - stats["rows"])
+        # Keyset on user_id so each window starts where the last one ended
+        # instead of rescanning users that are already done
+        queryset = (
+            ChatHistory.objects.filter(timestamp__lt=cutoff, user_id__gte=last_user)
+            .order_by("user_id", "timestamp", "id")
+            .values("id", *ARCHIVE_FIELDS)[:window]
+        )
+
+        segments = {}
+        count = 0
+        for row in queryset.iterator(chunk_size=chunk_size):
+            row["uuid"] = str(row["uuid"])
+            row["timestamp"] = row["timestamp"].isoformat()
+            segments.setdefault(row["user_id"], []).append(row)
+            stats["raw_bytes"] += len(row["question"]) + len(row["response"])
+            count += 1
+        if not count:
+            break
+
+        archives = _write_window(segments, batch_size, level)
+        stats["rows"] += count
+        stats["segments"] += len(archives)
+        stats["compressed_bytes"] += sum(len(archive.data) for archive in archives)
+        last_user = max(segments)
+        print(f"🗄️ Archived {count} chats into {len(archives)} segments")
+    return stats
+
+
+def load_archived(user_id, before=None, after=None):
+    """Yield a user's archived chats newest first, optionally within a time range."""
+    segments = ChatArchive.objects.filter(user_id=user_id).order_by("-last_timestamp", "-id")
+    if before:
+        segments = segments.filter(first_timestamp__lt=before)
+    if after:
+        segments = segments.filter(last_timestamp__gt=after)
+
+    for segment in segments.iterator():
+        for row in reversed(decompress_rows(segment.data)):
+            if before and row["timestamp"] >= before:
+                continue
+            if after and row["timestamp"] <= after:
+                continue
+            yield row
+
+
+def archived_page(user_id, cursor=None, limit=None):
+    """
+    Return ``(rows, next_cursor)`` for one page of a user's archived chats.
+
+    Pages hold at most ``limit`` rows (default ``CHAT_HISTORY_PAGE_SIZE``) and
+    never span two segments. Segments and the rows in them are paged newest
+    first. ``cursor`` is the previous page's ``next_cursor``: an opaque
+    "<segment id>:<offset>" string (a bare segment id starts at its newest
+    row); ``next_cursor`` is None after the oldest row.
+
+    Raises ValueError for a malformed cursor.
+    """
+    limit = limit or getattr(settings, "CHAT_HISTORY_PAGE_SIZE", 50)
+    segment_id = offset = None
+    if cursor:
+        segment, _, offset = str(cursor).partition(":")
+        segment_id, offset = int(segment), int(offset or 0)
+        if offset < 0:
+            raise ValueError(f"Invalid cursor: {cursor!r}")
+
+    segments = ChatArchive.objects.filter(user_id=user_id).order_by("-last_timestamp", "-id")
+    if segment_id is not None:
+        current = segments.filter(id=segment_id).values("last_timestamp").first()
+        if current is None:
+            return [], None
+        # Start at segment_id and continue with older segments
+        segments = segments.filter(last_timestamp__lte=current["last_timestamp"]).exclude(
+            last_timestamp=current["last_timestamp"], id__gt=segment_id
+        )
+
+    ids = list(segments.values_list("id", flat=True)[:2])
+    if not ids:
+        return [], None
+    data = ChatArchive.objects.values_list("data", flat=True).get(id=ids[0])
+    rows = list(reversed(decompress_rows(data)))
+    offset = offset or 0
+    page = rows[offset : offset + limit]
+    if offset + limit < len(rows):
+        return page, f"{ids[0]}:{offset + limit}"
+    return page, f"{ids[1]}:0" if len(ids) > 1 else None
@@ -0,0 +1,193 @@
+"""
+Async implementation of the support agent pipeline.
+
+Mirrors ``utils.answer_query`` for ASGI deployments: the FAQ lookup uses the
+async ORM, LLM calls go through the provider router and one pooled
+``httpx.AsyncClient`` per event loop (keep-alive connections are reused
+instead of a new TCP+TLS handshake per request), and identical in-flight
+queries are coalesced on the loop. Blocking steps (cache keys read the FAQ
+version and reload the knowledge index, cache backends and prompt building
+do I/O) run in worker threads so the loop never waits on them.
+"""
+import asyncio
+import weakref
+from dataclasses import replace
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from utils.tokens import token_ledger
+
+from .conversation import conversation_context, enabled as conversation_enabled
+from .deadline import Deadline, DeadlineExceeded
+from .faq_index import faq_index
+from .response_cache import response_cache, normalize_query
+from .singleflight import AsyncSingleFlight, SingleFlightTimeout
+from .providers import BackendError, NoBackendConfigured, provider_router
+from .utils import (
+    LLMResponse,
+    SUPPORT_SYSTEM_PROMPT,
+    NOT_CONFIGURED_MESSAGE,
+    CONNECTION_ERROR_MESSAGE,
+    GENERIC_ERROR_MESSAGE,
+    TIMEOUT_MESSAGE,
+    build_prompt_with_estimate,
+    _cache_key,
+)
+
+# httpx clients are bound to the loop they were first used on
+_clients = weakref.WeakKeyDictionary()
+_inflight = AsyncSingleFlight()
+
+
+def _off_loop(fn):
+    """fn as a coroutine function that runs in a worker thread."""
+    return sync_to_async(fn, thread_sensitive=False)
+
+
+def get_async_client():
+    """Return the pooled AsyncClient for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(
+            max_connections=getattr(settings, "LLM_HTTP_MAX_CONNECTIONS", 100),
+            max_keepalive_connections=getattr(settings, "LLM_HTTP_MAX_KEEPALIVE", 20),
+        )
+        client = httpx.AsyncClient(
+            limits=limits, timeout=getattr(settings, "LLM_HTTP_TIMEOUT", 60)
+        )
+        _clients[loop] = client
+    return client
+
+
+async def aclose_clients():
+    """Close the pooled client of the running loop (e.g. on ASGI shutdown)."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def asearch_faq(query):
+    """Async variant of search_faq."""
+    try:
+        await faq_index.aensure_loaded()
+
+        if not len(faq_index):
+            print("🛑 No FAQs found in the database.")
+            return None
+
+        match = await faq_index.asearch(query, threshold=60)
+        if match:
+            matched_question, matched_answer, similarity_score = match
+            print(
+                f"✅ Best Match Found: {matched_question} (Similarity: {similarity_score}%)"
+            )
+            return matched_answer
+
+        print("🛑 No sufficiently similar FAQ found.")
+        return None
+
+    except Exception as e:
+        print(f"❌ Error in FAQ matching: {e}")
+        return None
+
+
+async def _agenerate_response(query, faq_answer=None, context=None, deadline=None):
+    """Async variant of utils._generate_response; returns (answer, ok)."""
+    deadline = deadline or Deadline()
+    try:
+        if deadline.expired:
+            raise asyncio.TimeoutError()
+        prompt, estimated = await _off_loop(build_prompt_with_estimate)(
+            query, faq_answer, context
+        )
+
+        try:
+            # The router bounds the whole call by the deadline and cancels
+            # the losing request of a hedged pair
+            answer, prompt_tokens, backend = await provider_router.acomplete(
+                prompt, SUPPORT_SYSTEM_PROMPT, deadline
+            )
+        except NoBackendConfigured:
+            print("❌ No LLM backend is configured (missing API key?)")
+            return NOT_CONFIGURED_MESSAGE, False
+        except BackendError as e:
+            print(f"❌ {e}")
+            return CONNECTION_ERROR_MESSAGE, False
+
+        if not backend.records_usage:
+            token_ledger.record("support", backend.model, estimated, prompt_tokens)
+        return answer, True
+
+    except (asyncio.TimeoutError, httpx.TimeoutException, DeadlineExceeded):
+        print("⏱️ LLM call ran out of time; answering with the fallback")
+        return (faq_answer if faq_answer else TIMEOUT_MESSAGE), False
+    except Exception as e:
+        print(f"❌ Error generating response: {e}")
+        return (faq_answer if faq_answer else GENERIC_ERROR_MESSAGE), False
+
+
+async def aget_llm_response(query, faq_answer=None, context=None, deadline=None):
+    """Async variant of get_llm_response, including the shared in-flight markers."""
+    key = await _off_loop(_cache_key)(query, faq_answer, context)
+    if key:
+        cached = await _off_loop(response_cache.get)(key)
+        if cached is not None:
+            print(f"⚡ LLM cache hit for Query: {query}")
+            return LLMResponse(cached, cache_hit=True)
+
+    holds_flight = False
+    if key and response_cache.shared_flights:
+        timeout = getattr(settings, "SUPPORT_SINGLEFLIGHT_TIMEOUT", 30)
+        holds_flight = await _off_loop(response_cache.acquire_flight)(key, timeout)
+        if not holds_flight:
+            # Another worker is already asking the LLM the same thing
+            wait = deadline.cap(timeout) if deadline else timeout
+            cached = await response_cache.await_for(key, wait)
+            if cached is not None:
+                print(f"🔗 Shared in-flight answer for Query: {query}")
+                return LLMResponse(cached, cache_hit=True, coalesced=True)
+
+    try:
+        answer, ok = await _agenerate_response(query, faq_answer, context, deadline)
+        if ok and key:
+            # Fallback/error messages are never cached
+            await _off_loop(response_cache.set)(key, answer)
+    finally:
+        if holds_flight:
+            await _off_loop(response_cache.release_flight)(key)
+    return LLMResponse(answer, degraded=not ok)
+
+
+async def agenerate_response_with_llm(query, faq_answer=None, context=None):
+    """Async variant of generate_response_with_llm."""
+    return (await aget_llm_response(query, faq_answer, context)).text
+
+
+async def aanswer_query(query, user_id=None, deadline=None):
+    """Async variant of answer_query, coalescing identical queries on the event loop."""
+    deadline = deadline or Deadline()
+    context = None
+    if conversation_enabled():
+        context = await _off_loop(conversation_context)(user_id, deadline)
+
+    async def run():
+        return await aget_llm_response(query, await asearch_faq(query), context, deadline)
+
+    timeout = deadline.cap(getattr(settings, "SUPPORT_SINGLEFLIGHT_TIMEOUT", 30))
+    try:
+        result, shared = await _inflight.do(
+            (normalize_query(query), context), run, timeout=timeout
+        )
+    except SingleFlightTimeout:
+        if deadline.expired:
+            print(f"⏱️ Deadline passed waiting for in-flight Query: {query}")
+            faq_answer = await asearch_faq(query)
+            return LLMResponse(faq_answer or TIMEOUT_MESSAGE, degraded=True)
+        print(f"⏱️ Timed out waiting for in-flight Query: {query}. Running it directly.")
+        return await run()
+    if shared:
+        return replace(result, coalesced=True)
+    return result
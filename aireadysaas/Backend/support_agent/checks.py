@@ -0,0 +1,64 @@
+"""
+System checks for settings that only work with a cache shared by every worker.
+
+The "django" response cache, cross-worker single flight and the "django"
+agent rate-limit store keep their state in a Django cache alias. A
+local-memory or dummy cache is private to one process (or stores nothing), so
+each worker would silently cache, coalesce and rate limit on its own.
+"""
+from django.conf import settings
+from django.core.checks import Warning, register
+
+# Cache backends whose contents no other worker can see
+PROCESS_LOCAL_CACHES = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+def _process_local(alias):
+    backend = settings.CACHES.get(alias, {}).get("BACKEND", "")
+    return backend in PROCESS_LOCAL_CACHES
+
+
+@register()
+def check_shared_caches(app_configs, **kwargs):
+    """Warn when a feature that needs a shared cache points at a per-process one."""
+    messages = []
+    cache_alias = getattr(settings, "LLM_CACHE_ALIAS", "default")
+    if getattr(settings, "LLM_CACHE_BACKEND", "memory") == "django" and _process_local(
+        cache_alias
+    ):
+        messages.append(
+            Warning(
+                f"LLM_CACHE_BACKEND is 'django' but the '{cache_alias}' cache is local to "
+                "each process, so workers do not share cached answers.",
+                hint="Point LLM_CACHE_ALIAS at a Redis, Memcached or database cache, "
+                "or use LLM_CACHE_BACKEND=memory.",
+                id="support_agent.W001",
+            )
+        )
+        if getattr(settings, "SUPPORT_SINGLEFLIGHT_SHARED", False):
+            messages.append(
+                Warning(
+                    "SUPPORT_SINGLEFLIGHT_SHARED is on but the in-flight markers live in a "
+                    f"per-process '{cache_alias}' cache, so identical queries are only "
+                    "coalesced within one worker.",
+                    hint="Configure a shared cache for LLM_CACHE_ALIAS.",
+                    id="support_agent.W002",
+                )
+            )
+    limit_alias = getattr(settings, "AGENT_RATE_LIMIT_CACHE_ALIAS", "default")
+    if getattr(settings, "AGENT_RATE_LIMIT_STORE", "sqlite") == "django" and _process_local(
+        limit_alias
+    ):
+        messages.append(
+            Warning(
+                f"AGENT_RATE_LIMIT_STORE is 'django' but the '{limit_alias}' cache is local "
+                "to each process, so every worker gets the full rate limit.",
+                hint="Point AGENT_RATE_LIMIT_CACHE_ALIAS at a shared cache, or use the "
+                "'sqlite' store on a single host.",
+                id="support_agent.W003",
+            )
+        )
+    return messages
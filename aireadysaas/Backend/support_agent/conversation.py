@@ -0,0 +1,248 @@
+"""
+Multi-turn conversation context for support prompts.
+
+A prompt gets at most ``CONVERSATION_MAX_TURNS`` of the user's latest turns,
+newest first until ``CONVERSATION_TOKEN_BUDGET`` is spent, plus a rolling
+summary of everything older. The summary lives in ``ConversationSummary`` and
+is refreshed incrementally: once ``CONVERSATION_SUMMARY_EVERY`` turns have
+slid out of the recent window, only those turns are folded into the existing
+summary (capped at ``CONVERSATION_SUMMARY_TOKENS``). Prompt size therefore
+stays flat however long the conversation gets.
+
+The request path only reads the stored summary. Folding new turns in costs an
+LLM call, so it runs on a background thread (``summary_refresher``) and the
+refreshed summary is used from the next request on.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from utils.tokens import count_tokens, truncate_tokens
+
+from .models import ChatHistory, ConversationSummary
+
+# ChatHistory.user_id prefix of anonymous callers, and the id of those who gave
+# none (see views.chat_owner)
+GUEST_PREFIX = "guest:"
+ANONYMOUS_USER = f"{GUEST_PREFIX}anonymous"
+TURN_FIELDS = ("id", "question", "response", "timestamp")
+
+SUMMARY_PROMPT = """Summarize this customer support conversation for the support agent.
+Keep facts about the customer, their products, open problems and anything already promised.
+Write at most {words} words.
+
+Earlier summary:
+{summary}
+
+New turns:
+{turns}"""
+
+
+def enabled():
+    return getattr(settings, "CONVERSATION_CONTEXT", False)
+
+
+def format_turns(turns):
+    return "\n".join(
+        f"Customer: {turn['question']}\nAgent: {turn['response']}" for turn in turns
+    )
+
+
+def recent_turns(user_id, max_turns=None, token_budget=None):
+    """
+    The user's latest turns (oldest first) that fit in the token budget.
+
+    Served by the (user_id, -timestamp, -id) index; at most ``max_turns``
+    rows are read.
+    """
+    max_turns = max_turns or getattr(settings, "CONVERSATION_MAX_TURNS", 6)
+    token_budget = token_budget or getattr(settings, "CONVERSATION_TOKEN_BUDGET", 600)
+
+    rows = (
+        ChatHistory.objects.filter(user_id=user_id)
+        .order_by("-timestamp", "-id")
+        .values(*TURN_FIELDS)[:max_turns]
+    )
+    kept = []
+    used = 0
+    for row in rows:
+        cost = count_tokens(row["question"]) + count_tokens(row["response"])
+        if kept and used + cost > token_budget:
+            break
+        if not kept and cost > token_budget:
+            # A single oversized turn still goes in, shortened
+            row["response"] = truncate_tokens(
+                row["response"], max(token_budget - count_tokens(row["question"]), 1)
+            )
+            cost = token_budget
+        kept.append(row)
+        used += cost
+    kept.reverse()
+    return kept
+
+
+def _extractive_summary(summary, turns, budget):
+    """Fallback summary: one line per question, newest lines kept within budget."""
+    lines = [line for line in summary.splitlines() if line.strip()]
+    lines += [f"- Customer asked: {truncate_tokens(turn['question'], 40)}" for turn in turns]
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        used += count_tokens(line)
+        if used > budget:
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+
+def summarize(summary, turns, budget=None):
+    """Fold turns into an existing summary, with the LLM when it is available."""
+    budget = budget or getattr(settings, "CONVERSATION_SUMMARY_TOKENS", 200)
+    # Imported here: utils imports this module to build prompts
+    from .utils import complete_prompt
+
+    prompt = SUMMARY_PROMPT.format(
+        words=budget * 3 // 4, summary=summary or "(none)", turns=format_turns(turns)
+    )
+    try:
+        text, ok = complete_prompt(prompt, call="conversation_summary")
+    except Exception as e:
+        print(f"❌ Error summarizing conversation: {e}")
+        ok = False
+    if not ok:
+        return _extractive_summary(summary, turns, budget)
+    return truncate_tokens(text.strip(), budget)
+
+
+def refresh_summary(user_id, window):
+    """
+    Fold turns that slid out of the recent window into the rolling summary.
+
+    Returns the current summary text. Nothing is summarized until at least
+    ``CONVERSATION_SUMMARY_EVERY`` turns are pending. At most
+    ``CONVERSATION_SUMMARY_MAX_FOLD`` of the oldest pending turns are folded
+    per call; the rest are carried over to the next refresh.
+
+    Blocks on an LLM call; request handlers go through summary_refresher.
+    """
+    state, _ = ConversationSummary.objects.get_or_create(user_id=user_id)
+    if not window:
+        return state.summary
+
+    every = getattr(settings, "CONVERSATION_SUMMARY_EVERY", 4)
+    max_fold = getattr(settings, "CONVERSATION_SUMMARY_MAX_FOLD", 20)
+    oldest = window[0]
+
+    pending = ChatHistory.objects.filter(user_id=user_id).filter(
+        Q(timestamp__lt=oldest["timestamp"])
+        | Q(timestamp=oldest["timestamp"], id__lt=oldest["id"])
+    )
+    if state.last_chat_id is not None:
+        pending = pending.filter(
+            Q(timestamp__gt=state.last_timestamp)
+            | Q(timestamp=state.last_timestamp, id__gt=state.last_chat_id)
+        )
+    # Oldest first, so the summary never skips turns
+    turns = list(pending.order_by("timestamp", "id").values(*TURN_FIELDS)[:max_fold])
+    if len(turns) < every:
+        return state.summary
+
+    print(f"🧾 Folding {len(turns)} turns into the conversation summary for {user_id}")
+    summary = summarize(state.summary, turns)
+    # Only commit if no other worker folded the same turns in the meantime
+    updated = ConversationSummary.objects.filter(
+        pk=state.pk, last_chat_id=state.last_chat_id
+    ).update(
+        summary=summary,
+        last_timestamp=turns[-1]["timestamp"],
+        last_chat_id=turns[-1]["id"],
+        turns=state.turns + len(turns),
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        state.refresh_from_db()
+        return state.summary
+    return summary
+
+
+class SummaryRefresher:
+    """Runs refresh_summary on background threads, one pending refresh per user."""
+
+    def __init__(self, max_workers=None):
+        self._max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self._max_workers
+                        or getattr(settings, "CONVERSATION_SUMMARY_WORKERS", 2),
+                        thread_name_prefix="conversation-summary",
+                    )
+        return self._executor
+
+    def schedule(self, user_id, window):
+        """Queue a refresh for user_id; False if one is already pending."""
+        with self._lock:
+            if user_id in self._pending:
+                return False
+            self._pending.add(user_id)
+        self.executor.submit(self._refresh, user_id, window)
+        return True
+
+    def _refresh(self, user_id, window):
+        close_old_connections()
+        try:
+            refresh_summary(user_id, window)
+        except Exception as e:
+            print(f"❌ Error refreshing conversation summary for {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(user_id)
+            close_old_connections()
+
+
+# Shared per-process refresher
+summary_refresher = SummaryRefresher()
+
+
+def conversation_context(user_id, deadline=None):
+    """
+    Prompt-ready conversation context for user_id, or None if there is none.
+
+    Only signed-in owners get context: a guest id is whatever the caller sent,
+    so anyone could claim another visitor's turns with it. Skipped once
+    ``deadline`` has passed; the answer is late enough already.
+    """
+    if not enabled() or not user_id or user_id.startswith(GUEST_PREFIX):
+        return None
+    if deadline is not None and deadline.expired:
+        return None
+    try:
+        window = recent_turns(user_id)
+        summary = (
+            ConversationSummary.objects.filter(user_id=user_id)
+            .values_list("summary", flat=True)
+            .first()
+        )
+        if window:
+            summary_refresher.schedule(user_id, window)
+    except Exception as e:
+        print(f"❌ Error loading conversation context: {e}")
+        return None
+
+    parts = []
+    if summary:
+        parts.append(f"Summary of the earlier conversation:\n{summary}")
+    if window:
+        parts.append(f"Most recent turns:\n{format_turns(window)}")
+    return "\n\n".join(parts) or None
@@ -0,0 +1,67 @@
+"""
+Per-request latency budgets.
+
+A ``Deadline`` is started when a request arrives; every later step (FAQ
+search, waiting on a coalesced call, the LLM request itself) only gets the
+time that is left. Once it has passed, the pipeline stops waiting on the
+provider and answers with the matched FAQ text or a canned message, so the
+response time is bounded by SUPPORT_REQUEST_BUDGET rather than by upstream.
+"""
+import time
+
+import requests
+from django.conf import settings
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The request's budget ran out before an LLM call could be made."""
+
+
+class Deadline:
+    """A monotonic point in time by which a request should be answered."""
+
+    def __init__(self, seconds=None):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds if seconds else None
+
+    @classmethod
+    def for_request(cls):
+        """Start the deadline for one support request (SUPPORT_REQUEST_BUDGET)."""
+        return cls(getattr(settings, "SUPPORT_REQUEST_BUDGET", 20))
+
+    def remaining(self):
+        """Seconds left, or None for an unbounded deadline."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cap(self, seconds):
+        """The smaller of seconds and the time left (seconds itself if unbounded)."""
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        if seconds is None:
+            return remaining
+        return min(seconds, remaining)
+
+
+def http_timeout(deadline=None):
+    """
+    ``requests``-style (connect, read) timeout for one LLM call.
+
+    Without a deadline the read timeout is LLM_HTTP_TIMEOUT, so a stalled
+    provider can never hold a worker indefinitely. Raises DeadlineExceeded
+    once the deadline has passed: HTTP clients reject a zero timeout.
+    """
+    read = getattr(settings, "LLM_HTTP_TIMEOUT", 60)
+    connect = getattr(settings, "LLM_CONNECT_TIMEOUT", 3)
+    if deadline is not None:
+        read = deadline.cap(read)
+        if read <= 0:
+            raise DeadlineExceeded("Deadline passed before the LLM call")
+    return (min(connect, read), read)
@@ -0,0 +1,161 @@
+"""
+Embedders and the optional vector index used for semantic FAQ retrieval.
+
+The default ``HashingEmbedder`` is deterministic and fully local (signed
+feature hashing of word and character n-grams, IDF-weighted over the indexed
+questions), so the vector path works offline. Any object with ``dim`` and
+``embed(texts) -> np.ndarray`` (and optionally ``fit(texts)``) can be plugged
+in through the ``FAQ_EMBEDDER`` setting.
+"""
+import re
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu is optional; fall back to numpy search
+    faiss = None
+
+_WORD_RE = re.compile(r"\w+")
+_SUFFIXES = ("ing", "ed", "es", "s")
+_STOPWORDS = frozenset(
+    "a an and are at be can do does for from how i in is it me my of on or so "
+    "the there this to we what when where which who why will with you your".split()
+)
+
+
+def stem(word):
+    """Very light suffix stripping so 'resetting'/'resets' share features."""
+    for suffix in _SUFFIXES:
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            return word[: -len(suffix)]
+    return word
+
+
+class HashingEmbedder:
+    """Deterministic bag-of-n-grams embedder using signed feature hashing."""
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.idf = None
+
+    def _features(self, text):
+        words = [
+            stem(w) for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS
+        ]
+        features = [f"w:{w}" for w in words]
+        features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"<{word}>"
+            features += [f"c:{padded[i : i + 4]}" for i in range(len(padded) - 3)]
+        return features
+
+    def _hashed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                # crc32 is stable across processes, unlike hash()
+                h = zlib.crc32(feature.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return vectors
+
+    def fit(self, texts, batch_size=1024):
+        """Learn per-bucket IDF weights from the corpus being indexed."""
+        if not texts:
+            self.idf = None
+            return self
+        df = np.zeros(self.dim, dtype=np.int64)
+        for i in range(0, len(texts), batch_size):
+            df += np.count_nonzero(self._hashed(texts[i : i + batch_size]), axis=0)
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        return self
+
+    def embed(self, texts):
+        """Return an L2-normalised float32 matrix with one row per text."""
+        vectors = self._hashed(texts)
+        if self.idf is not None:
+            vectors *= self.idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+def get_embedder():
+    """Instantiate the embedder configured by ``FAQ_EMBEDDER``."""
+    path = getattr(settings, "FAQ_EMBEDDER", "support_agent.embeddings.HashingEmbedder")
+    return import_string(path)()
+
+
+class VectorIndex:
+    """Inner-product index over normalised vectors (faiss flat/IVF, or numpy)."""
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self._index = None
+        self._quantizer = None
+        self._vectors = None
+
+    @classmethod
+    def build(cls, texts, embedder=None, batch_size=None):
+        """Embed texts in batches and build the most suitable index for their count."""
+        index = cls(embedder or get_embedder())
+        if hasattr(index.embedder, "fit"):
+            index.embedder.fit(texts)
+        batch_size = batch_size or getattr(settings, "FAQ_EMBED_BATCH_SIZE", 256)
+        batches = [
+            index.embedder.embed(texts[i : i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ]
+        vectors = (
+            np.vstack(batches).astype(np.float32)
+            if batches
+            else np.zeros((0, index.embedder.dim), dtype=np.float32)
+        )
+
+        if faiss is None:
+            index._vectors = vectors
+            return index
+
+        dim = vectors.shape[1]
+        ivf_threshold = getattr(settings, "FAQ_VECTOR_IVF_THRESHOLD", 50000)
+        if len(vectors) >= ivf_threshold:
+            nlist = max(1, int(np.sqrt(len(vectors))))
+            quantizer = faiss.IndexFlatIP(dim)
+            faiss_index = faiss.IndexIVFFlat(
+                quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT
+            )
+            faiss_index.train(vectors)
+            faiss_index.nprobe = getattr(settings, "FAQ_VECTOR_NPROBE", 8)
+            # The quantizer must outlive the IVF index wrapper
+            index._quantizer = quantizer
+        else:
+            faiss_index = faiss.IndexFlatIP(dim)
+        faiss_index.add(vectors)
+        index._index = faiss_index
+        return index
+
+    def __len__(self):
+        if self._index is not None:
+            return self._index.ntotal
+        return 0 if self._vectors is None else len(self._vectors)
+
+    def search(self, query, k=5):
+        """Return [(position, cosine similarity)] for the k nearest questions."""
+        if not len(self):
+            return []
+        k = min(k, len(self))
+        vector = self.embedder.embed([query]).astype(np.float32)
+
+        if self._index is not None:
+            scores, positions = self._index.search(vector, k)
+            return [
+                (int(p), float(s)) for p, s in zip(positions[0], scores[0]) if p >= 0
+            ]
+
+        scores = self._vectors @ vector[0]
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(p), float(scores[p])) for p in top]
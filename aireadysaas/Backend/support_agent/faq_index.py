@@ -0,0 +1,393 @@
+"""
+In-process FAQ match index.
+
+The FAQ table is loaded once per process into two parallel lists (questions
+and answers) so a fuzzy match only costs one rapidfuzz pass and an O(1)
+answer lookup by position. The index is rebuilt lazily after a change to the
+FAQ table. Every change through the ORM (post_save/post_delete, and
+``update``/``bulk_create``/``bulk_update`` on FAQ querysets) bumps a version
+counter stored in the database (``FAQVersion``); each worker re-reads it at
+most every ``FAQ_VERSION_CHECK_INTERVAL`` seconds and rebuilds when it
+moved, so other workers pick up an edit within that interval. Edits made
+with raw SQL bypass the counter and are only seen after a restart.
+
+For large FAQ tables a character-trigram / word-token inverted index picks a
+bounded candidate set (``FAQ_CANDIDATE_LIMIT``) before the exact
+``fuzz.ratio`` scoring, so latency no longer grows with every FAQ row.
+
+With ``FAQ_VECTOR_SEARCH`` enabled, questions that miss the lexical
+threshold get a second chance through a vector index (see ``embeddings``):
+the nearest questions are re-ranked by a hybrid of cosine similarity and the
+rapidfuzz score, so paraphrases are answered from the FAQ instead of falling
+through to the full knowledge-base prompt.
+"""
+import re
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from rapidfuzz import process, fuzz
+
+from .embeddings import VectorIndex
+
+_WORD_RE = re.compile(r"\w+")
+
+# (version, monotonic time it was read) of the last FAQVersion lookup
+_version_seen = (None, 0.0)
+
+
+def _version_is_fresh():
+    version, read_at = _version_seen
+    interval = getattr(settings, "FAQ_VERSION_CHECK_INTERVAL", 2.0)
+    return version is not None and time.monotonic() - read_at < interval
+
+
+def _remember_version(version):
+    global _version_seen
+    _version_seen = (version or 0, time.monotonic())
+    return version or 0
+
+
+def get_faq_version():
+    """Return the FAQ version counter, re-read from the database at most every interval."""
+    if _version_is_fresh():
+        return _version_seen[0]
+    from .models import FAQVersion
+
+    return _remember_version(
+        FAQVersion.objects.filter(pk=1).values_list("version", flat=True).first()
+    )
+
+
+async def aget_faq_version():
+    """Async variant of get_faq_version."""
+    if _version_is_fresh():
+        return _version_seen[0]
+    from .models import FAQVersion
+
+    return _remember_version(
+        await FAQVersion.objects.filter(pk=1).values_list("version", flat=True).afirst()
+    )
+
+
+def bump_faq_version():
+    """Increment the FAQ version counter so every worker rebuilds."""
+    from .models import FAQVersion
+
+    if not FAQVersion.objects.filter(pk=1).update(version=F("version") + 1):
+        # The row is created by a migration; recreate it if it went missing
+        FAQVersion.objects.get_or_create(pk=1, defaults={"version": 1})
+    # This worker sees its own change at once
+    return _remember_version(FAQVersion.objects.values_list("version", flat=True).get(pk=1))
+
+
+def text_grams(text):
+    """Character trigrams plus whole word tokens used by the candidate prefilter."""
+    normalized = " ".join(_WORD_RE.findall(text.lower()))
+    padded = f"  {normalized} "
+    grams = {padded[i : i + 3] for i in range(len(padded) - 2)}
+    grams.update(f"w:{word}" for word in normalized.split())
+    return grams
+
+
+class FAQIndex:
+    """Lazily-built, signal-invalidated snapshot of the FAQ table."""
+
+    def __init__(self, candidate_limit=None):
+        self._lock = threading.Lock()
+        self._candidate_limit = candidate_limit
+        # (questions, answers, postings, vectors) swapped as one tuple so
+        # readers never see a mix of two builds
+        self._snapshot = ([], [], {}, None)
+        self._loaded = False
+        self._stale = True
+        self._version = None
+        # Counters are bumped from every request thread
+        self._stats_lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.invalidations = 0
+        self.prefiltered = 0
+        self.semantic_hits = 0
+
+    @property
+    def candidate_limit(self):
+        """Maximum questions scored exactly per lookup (0 disables the prefilter)."""
+        if self._candidate_limit is not None:
+            return self._candidate_limit
+        return getattr(settings, "FAQ_CANDIDATE_LIMIT", 200)
+
+    def _count(self, **increments):
+        with self._stats_lock:
+            for name, amount in increments.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    def invalidate(self):
+        """Mark the index stale; it is rebuilt on the next lookup."""
+        self._stale = True
+        self._count(invalidations=1)
+
+    def _needs_rebuild(self, version):
+        return self._stale or not self._loaded or self._version != version
+
+    @staticmethod
+    def _build_postings(questions):
+        postings = defaultdict(list)
+        for position, question in enumerate(questions):
+            for gram in text_grams(question):
+                postings[gram].append(position)
+        return {
+            gram: np.asarray(positions, dtype=np.int32)
+            for gram, positions in postings.items()
+        }
+
+    @staticmethod
+    def _rows():
+        # Imported here so the module can be imported before apps are ready
+        from .models import FAQ
+
+        return FAQ.objects.order_by("pk").values_list("question", "answer")
+
+    def _install(self, rows, version):
+        questions = [question for question, _ in rows]
+        answers = [answer for _, answer in rows]
+        vectors = None
+        if getattr(settings, "FAQ_VECTOR_SEARCH", False):
+            vectors = VectorIndex.build(questions)
+        self._snapshot = (
+            questions,
+            answers,
+            self._build_postings(questions),
+            vectors,
+        )
+        self._version = version
+        self._loaded = True
+        self._stale = False
+        self._count(rebuilds=1)
+        print(f"🔄 FAQ index rebuilt ({len(rows)} entries, version {version})")
+
+    def ensure_loaded(self):
+        """Rebuild the index if it was never loaded or has been invalidated."""
+        if self._needs_rebuild(get_faq_version()):
+            with self._lock:
+                version = get_faq_version()
+                if self._needs_rebuild(version):
+                    self._install(list(self._rows()), version)
+
+    async def aensure_loaded(self):
+        """
+        Async variant of ensure_loaded that reads the FAQ table with the async ORM.
+
+        Building the postings (and vector index) is CPU-bound and happens under
+        the rebuild lock, so it runs in a worker thread rather than on the loop.
+        """
+        version = await aget_faq_version()
+        if self._needs_rebuild(version):
+            rows = [row async for row in self._rows()]
+            await sync_to_async(self._install_if_stale, thread_sensitive=False)(rows, version)
+
+    def _install_if_stale(self, rows, version):
+        with self._lock:
+            if self._needs_rebuild(version):
+                self._install(rows, version)
+
+    def __len__(self):
+        return len(self._snapshot[0])
+
+    @property
+    def questions(self):
+        """Questions of the current snapshot, in index order."""
+        return self._snapshot[0]
+
+    def candidates(self, query, limit=None):
+        """
+        Return positions of the questions sharing the most n-grams with the query.
+
+        Returns None when the table is small enough to score every question.
+        """
+        questions, _, postings, _ = self._snapshot
+        limit = self.candidate_limit if limit is None else limit
+        if not limit or len(questions) <= limit:
+            return None
+
+        hits = [postings[gram] for gram in text_grams(query) if gram in postings]
+        if not hits:
+            return np.empty(0, dtype=np.intp)
+        # Shared n-gram count per question in a single C pass
+        counts = np.bincount(np.concatenate(hits), minlength=len(questions))
+        top = np.argpartition(counts, -limit)[-limit:]
+        return top[counts[top] > 0]
+
+    def best_match(self, query, limit=None):
+        """
+        Return the best (question, answer, score) for the query, or None.
+
+        The score is the rapidfuzz ``fuzz.ratio`` similarity (0-100). Pass
+        ``limit=0`` to force the brute-force path over every question.
+        """
+        self.ensure_loaded()
+        self._count(lookups=1)
+        questions, answers, _, _ = self._snapshot
+        if not questions:
+            return None
+
+        positions = self.candidates(query, limit)
+        if positions is None:
+            result = process.extractOne(query, questions, scorer=fuzz.ratio)
+            if result is None:
+                return None
+            matched_question, score, position = result
+            return matched_question, answers[position], score
+
+        self._count(prefiltered=1)
+        if not len(positions):
+            return None
+        result = process.extractOne(
+            query, [questions[p] for p in positions], scorer=fuzz.ratio
+        )
+        if result is None:
+            return None
+        matched_question, score, candidate = result
+        return matched_question, answers[positions[candidate]], score
+
+    def semantic_match(self, query, k=None):
+        """
+        Return the best (question, answer, hybrid score) among the vector neighbours.
+
+        The hybrid score blends cosine similarity (scaled to 0-100) with the
+        rapidfuzz ratio using ``FAQ_HYBRID_WEIGHT`` for the vector part.
+        Returns None when vector search is disabled.
+        """
+        questions, answers, _, vectors = self._snapshot
+        if vectors is None:
+            return None
+
+        k = k or getattr(settings, "FAQ_VECTOR_TOP_K", 5)
+        weight = getattr(settings, "FAQ_HYBRID_WEIGHT", 0.6)
+        best = None
+        for position, similarity in vectors.search(query, k=k):
+            question = questions[position]
+            score = weight * max(similarity, 0.0) * 100 + (1 - weight) * fuzz.ratio(
+                query, question
+            )
+            if best is None or score > best[2]:
+                best = (question, answers[position], score)
+        return best
+
+    def search(self, query, threshold=60):
+        """Return the FAQ answer if the best match scores above the threshold."""
+        match = self.best_match(query)
+        if match and match[2] > threshold:
+            self._count(hits=1)
+            return match
+
+        semantic = self.semantic_match(query)
+        if semantic and semantic[2] > getattr(settings, "FAQ_HYBRID_THRESHOLD", 60):
+            self._count(hits=1, semantic_hits=1)
+            return semantic
+
+        self._count(misses=1)
+        return None
+
+    async def asearch(self, query, threshold=60):
+        """Async variant of search; scoring runs in a worker thread off the event loop."""
+        await self.aensure_loaded()
+        return await sync_to_async(self.search, thread_sensitive=False)(query, threshold)
+
+    def search_many(self, queries, threshold=60, max_cells=10_000_000):
+        """
+        Batch variant of search: one result (or None) per query, in order.
+
+        Queries are scored against every question with ``process.cdist``
+        (vectorized, all cores), in row blocks of at most ``max_cells`` scores
+        to bound memory. Lexical misses still get the semantic second chance.
+        """
+        self.ensure_loaded()
+        questions, answers, _, _ = self._snapshot
+        results = [None] * len(queries)
+        if not questions or not queries:
+            self._count(misses=len(queries))
+            return results
+
+        rows_per_block = max(1, max_cells // len(questions))
+        for start in range(0, len(queries), rows_per_block):
+            block = queries[start : start + rows_per_block]
+            scores = process.cdist(
+                block, questions, scorer=fuzz.ratio, dtype=np.float32, workers=-1
+            )
+            best = scores.argmax(axis=1)
+            for offset, position in enumerate(best):
+                score = float(scores[offset, position])
+                if score > threshold:
+                    results[start + offset] = (questions[position], answers[position], score)
+
+        semantic_hits = 0
+        for i, query in enumerate(queries):
+            if results[i] is None:
+                semantic = self.semantic_match(query)
+                if semantic and semantic[2] > getattr(settings, "FAQ_HYBRID_THRESHOLD", 60):
+                    semantic_hits += 1
+                    results[i] = semantic
+        misses = results.count(None)
+        self._count(
+            lookups=len(queries),
+            hits=len(queries) - misses,
+            semantic_hits=semantic_hits,
+            misses=misses,
+        )
+        return results
+
+    def measure_recall(self, queries, threshold=60, limit=None):
+        """
+        Compare prefiltered matching against the brute-force path.
+
+        A query counts as recalled when the brute-force match clears the
+        threshold and the prefilter found an equally good match. Returns a
+        dict with the totals, the recall ratio and the missed queries.
+        """
+        self.ensure_loaded()
+        total = recalled = 0
+        missed = []
+        for query in queries:
+            exact = self.best_match(query, limit=0)
+            if not exact or exact[2] <= threshold:
+                continue
+            total += 1
+            filtered = self.best_match(query, limit=limit)
+            if filtered and filtered[2] >= exact[2]:
+                recalled += 1
+            else:
+                missed.append(query)
+        return {
+            "queries": total,
+            "recalled": recalled,
+            "recall": recalled / total if total else 1.0,
+            "missed": missed,
+        }
+
+    def stats(self):
+        """Counters used to confirm the index is not reloaded on every request."""
+        with self._stats_lock:
+            return {
+                "entries": len(self),
+                "version": self._version,
+                "candidate_limit": self.candidate_limit,
+                "lookups": self.lookups,
+                "prefiltered": self.prefiltered,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "vector_search": self._snapshot[3] is not None,
+                "misses": self.misses,
+                "rebuilds": self.rebuilds,
+                "invalidations": self.invalidations,
+            }
+
+
+# Shared per-process index
+faq_index = FAQIndex()
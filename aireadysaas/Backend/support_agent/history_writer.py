@@ -0,0 +1,206 @@
+"""
+ChatHistory persistence, optionally write-behind.
+
+By default every chat turn is inserted synchronously. With
+``CHAT_HISTORY_WRITE_BEHIND`` enabled, rows are queued in memory and a
+background thread inserts them with ``bulk_create`` once
+``CHAT_HISTORY_FLUSH_SIZE`` rows are pending or ``CHAT_HISTORY_FLUSH_INTERVAL``
+seconds have passed. Pending rows are flushed when the worker exits. Queued
+rows have no primary key yet, so callers should reference them by ``uuid``.
+
+If a bulk insert fails, its rows are inserted one by one so a single bad row
+cannot take the rest of the batch with it. A row that still fails is queued
+again for the next flush, up to ``CHAT_HISTORY_WRITE_ATTEMPTS`` flushes in
+all (a database restart need not lose anything), then dropped and logged.
+"""
+import atexit
+import queue
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import ChatHistory
+
+
+class HistoryWriter:
+    """Queues ChatHistory rows and bulk-inserts them from a daemon thread."""
+
+    def __init__(self, flush_size=None, flush_interval=None):
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = False
+        self.flushed = 0
+        self.flushes = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def flush_size(self):
+        return self._flush_size or getattr(settings, "CHAT_HISTORY_FLUSH_SIZE", 100)
+
+    @property
+    def flush_interval(self):
+        return self._flush_interval or getattr(settings, "CHAT_HISTORY_FLUSH_INTERVAL", 1.0)
+
+    @property
+    def write_attempts(self):
+        return getattr(settings, "CHAT_HISTORY_WRITE_ATTEMPTS", 3)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="chat-history-writer", daemon=True
+                    )
+                    self._thread.start()
+                    atexit.register(self.shutdown)
+
+    def submit(self, entry):
+        """Queue an unsaved ChatHistory instance for insertion."""
+        self._ensure_started()
+        self._queue.put(entry)
+        if self._queue.qsize() >= self.flush_size:
+            self._wakeup.set()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Insert everything queued so far; returns the number of rows written."""
+        with self._flush_lock:
+            written = 0
+            retry = []
+            while True:
+                batch = []
+                try:
+                    while len(batch) < self.flush_size:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if not batch:
+                    break
+
+                close_old_connections()
+                try:
+                    # All or nothing, so the rows can safely be written again
+                    with transaction.atomic():
+                        ChatHistory.objects.bulk_create(batch)
+                except Exception as e:
+                    print(
+                        f"⚠️ Bulk insert of {len(batch)} chat history rows failed ({e}); "
+                        "inserting them one by one"
+                    )
+                    saved = self._insert_each(batch, retry)
+                else:
+                    saved = len(batch)
+                written += saved
+                self.flushed += saved
+                self.flushes += 1
+            # Failed rows wait for the next flush rather than spinning on this one
+            for entry in retry:
+                self._queue.put(entry)
+            return written
+
+    def _insert_each(self, batch, retry):
+        """Insert rows one at a time; failed rows go to retry or are dropped."""
+        saved = 0
+        for entry in batch:
+            # A rolled-back bulk insert may have assigned ids already
+            entry.pk = None
+            try:
+                with transaction.atomic():
+                    entry.save(force_insert=True)
+            except Exception as e:
+                attempts = getattr(entry, "_write_attempts", 1)
+                if attempts < self.write_attempts:
+                    entry._write_attempts = attempts + 1
+                    self.retried += 1
+                    retry.append(entry)
+                else:
+                    self._drop(entry, e)
+                continue
+            saved += 1
+        return saved
+
+    def _drop(self, entry, error):
+        self.failed += 1
+        print(
+            f"❌ Dropped chat history row {entry.uuid} (user {entry.user_id}, "
+            f"{entry.timestamp:%Y-%m-%d %H:%M:%S}): {error}"
+        )
+
+    def shutdown(self):
+        """Stop the background thread and write any pending rows."""
+        self._stopping = True
+        self._wakeup.set()
+        written = self.flush()
+        if written:
+            print(f"💾 Flushed {written} pending chat history rows on shutdown")
+        # Rows that failed once more get no further flush
+        while True:
+            try:
+                self._drop(self._queue.get_nowait(), "worker is shutting down")
+            except queue.Empty:
+                break
+        close_old_connections()
+
+    def stats(self):
+        return {
+            "pending": self.pending(),
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+# Shared per-process writer
+history_writer = HistoryWriter()
+
+
+def save_chat_history(user_id, question, response, degraded=False):
+    """
+    Persist one chat turn and return its ChatHistory instance.
+
+    In write-behind mode the instance is returned unsaved (``id`` is None) but
+    with its ``uuid`` and ``timestamp`` already set.
+    """
+    if not getattr(settings, "CHAT_HISTORY_WRITE_BEHIND", False):
+        return ChatHistory.objects.create(
+            user_id=user_id, question=question, response=response, degraded=degraded
+        )
+
+    entry = ChatHistory(
+        uuid=uuid.uuid4(),
+        user_id=user_id,
+        question=question,
+        response=response,
+        timestamp=timezone.now(),
+        degraded=degraded,
+    )
+    history_writer.submit(entry)
+    return entry
+
+
+async def asave_chat_history(user_id, question, response, degraded=False):
+    """Async variant of save_chat_history (queueing never blocks the event loop)."""
+    if getattr(settings, "CHAT_HISTORY_WRITE_BEHIND", False):
+        return save_chat_history(user_id, question, response, degraded)
+    return await ChatHistory.objects.acreate(
+        user_id=user_id, question=question, response=response, degraded=degraded
+    )
@@ -0,0 +1,326 @@
+"""
+Chunked retrieval over the markdown knowledge base.
+
+Every ``*.md`` file under ``KNOWLEDGE_DIR`` is split by heading and paragraph
+into chunks, which are indexed with BM25. A prompt then includes only the
+top-k chunks for the question, capped by a token budget, instead of the whole
+knowledge base.
+
+The store hot-reloads: at most every ``KNOWLEDGE_RELOAD_INTERVAL`` seconds it
+stats the files, re-reads only those whose mtime/size changed, re-tokenizes
+only chunks whose content hash is new, and swaps the rebuilt index in with a
+single reference assignment so in-flight requests keep a consistent snapshot.
+"""
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from pathlib import Path
+
+from django.conf import settings
+
+from utils.tokens import count_tokens
+
+from .embeddings import stem
+
+_WORD_RE = re.compile(r"\w+")
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in is "
+    "it me my of on or our so that the their there this to was we what when "
+    "where which who why will with you your".split()
+)
+
+Chunk = namedtuple("Chunk", ["source", "heading", "text", "tokens", "digest"])
+FileState = namedtuple("FileState", ["mtime_ns", "size", "digest", "chunks"])
+Snapshot = namedtuple("Snapshot", ["index", "version"])
+
+
+def estimate_tokens(text):
+    """Token count of a chunk (see utils.tokens)."""
+    return max(1, count_tokens(text))
+
+
+def terms(text):
+    """Lower-cased, lightly stemmed word terms (minus stopwords) used for BM25 scoring."""
+    return [stem(w) for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS]
+
+
+def split_markdown(text, source="", max_chars=None):
+    """
+    Split a markdown document into heading-scoped chunks.
+
+    Paragraphs (blocks separated by blank lines) under the same heading are
+    merged until ``max_chars`` is reached. Each chunk keeps its heading path
+    (e.g. "Our Services > Pricing Plans") so it still reads well on its own.
+    """
+    max_chars = max_chars or getattr(settings, "KNOWLEDGE_CHUNK_CHARS", 1200)
+    chunks = []
+    headings = []
+    paragraphs = []
+    block = []
+
+    def flush_block():
+        if block:
+            paragraphs.append("\n".join(block).strip())
+            block.clear()
+
+    def flush_section():
+        flush_block()
+        heading = " > ".join(title for _, title in headings)
+        current = ""
+        for paragraph in filter(None, paragraphs):
+            if current and len(current) + len(paragraph) + 2 > max_chars:
+                chunks.append(_make_chunk(source, heading, current))
+                current = ""
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+        if current:
+            chunks.append(_make_chunk(source, heading, current))
+        paragraphs.clear()
+
+    for line in text.splitlines():
+        match = _HEADING_RE.match(line)
+        if match:
+            flush_section()
+            level = len(match.group(1))
+            while headings and headings[-1][0] >= level:
+                headings.pop()
+            headings.append((level, match.group(2).strip()))
+        elif line.strip():
+            block.append(line)
+        else:
+            flush_block()
+    flush_section()
+    return chunks
+
+
+def _make_chunk(source, heading, text):
+    body = f"## {heading}\n{text}" if heading else text
+    return Chunk(
+        source=source,
+        heading=heading,
+        text=body,
+        tokens=estimate_tokens(body),
+        digest=hashlib.sha256(body.encode("utf-8")).hexdigest(),
+    )
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of chunks and their term frequencies."""
+
+    def __init__(self, chunks, frequencies=None, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.lengths = []
+        if frequencies is None:
+            frequencies = [Counter(terms(chunk.text)) for chunk in chunks]
+        for position, chunk_frequencies in enumerate(frequencies):
+            self.lengths.append(sum(chunk_frequencies.values()))
+            for term, frequency in chunk_frequencies.items():
+                self.postings[term].append((position, frequency))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        count = len(chunks)
+        self.idf = {
+            term: math.log(1 + (count - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self.postings.items()
+        }
+
+    def search(self, query, k):
+        """Return [(chunk, score)] for the k best-scoring chunks with any match."""
+        scores = defaultdict(float)
+        for term in set(terms(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, frequency in self.postings[term]:
+                norm = 1 - self.b + self.b * self.lengths[position] / self.avg_length
+                scores[position] += idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * norm
+                )
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        if best:
+            # Drop weak tail matches that only share an incidental term
+            floor = best[0][1] * getattr(settings, "KNOWLEDGE_MIN_SCORE_RATIO", 0.3)
+            best = [item for item in best if item[1] >= floor]
+        return [(self.chunks[position], score) for position, score in best]
+
+
+class KnowledgeStore:
+    """Hot-reloading BM25 index over every markdown file in the knowledge directory."""
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._files = {}  # path -> FileState
+        self._term_cache = {}  # chunk digest -> Counter of terms
+        self._last_check = 0.0
+        self.reloads = 0
+
+    @property
+    def directory(self):
+        if self._directory is not None:
+            return Path(self._directory)
+        return Path(
+            getattr(settings, "KNOWLEDGE_DIR", Path(settings.BASE_DIR) / "knowledge")
+        )
+
+    @property
+    def version(self):
+        """Content version of the live snapshot (changes whenever any file does)."""
+        snapshot = self._snapshot
+        return snapshot.version if snapshot else None
+
+    def _paths(self):
+        if not self.directory.is_dir():
+            return []
+        return sorted(self.directory.rglob("*.md"))
+
+    def refresh(self, force=False):
+        """
+        Re-index changed files and swap in a new snapshot if anything changed.
+
+        Returns a dict describing what was done and how long each phase took.
+        """
+        with self._lock:
+            return self._refresh(force)
+
+    def _refresh(self, force):
+        timings = {}
+        started = time.perf_counter()
+        stats = {
+            "files": 0,
+            "files_changed": 0,
+            "files_removed": 0,
+            "chunks": 0,
+            "chunks_tokenized": 0,
+            "swapped": False,
+        }
+
+        files = {}
+        changed = force or self._snapshot is None
+        for path in self._paths():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            stats["files"] += 1
+            previous = self._files.get(path)
+            if (
+                not force
+                and previous
+                and previous.mtime_ns == stat.st_mtime_ns
+                and previous.size == stat.st_size
+            ):
+                files[path] = previous
+                continue
+
+            try:
+                raw = path.read_bytes()
+            except OSError as e:
+                print(f"Error reading knowledge file {path}: {e}")
+                continue
+            digest = hashlib.sha256(raw).hexdigest()
+            if previous and previous.digest == digest and not force:
+                # Touched but not modified: keep the chunks, remember the new mtime
+                files[path] = previous._replace(mtime_ns=stat.st_mtime_ns)
+                continue
+
+            source = str(path.relative_to(self.directory))
+            chunks = split_markdown(raw.decode("utf-8", errors="replace"), source=source)
+            files[path] = FileState(stat.st_mtime_ns, stat.st_size, digest, chunks)
+            stats["files_changed"] += 1
+            changed = True
+
+        removed = set(self._files) - set(files)
+        stats["files_removed"] = len(removed)
+        changed = changed or bool(removed)
+        timings["scan"] = time.perf_counter() - started
+
+        if not changed:
+            self._files = files
+            stats["timings"] = timings
+            return stats
+
+        phase = time.perf_counter()
+        chunks = [chunk for state in files.values() for chunk in state.chunks]
+        term_cache = {}
+        frequencies = []
+        for chunk in chunks:
+            counter = term_cache.get(chunk.digest) or self._term_cache.get(chunk.digest)
+            if counter is None:
+                counter = Counter(terms(chunk.text))
+                stats["chunks_tokenized"] += 1
+            term_cache[chunk.digest] = counter
+            frequencies.append(counter)
+        timings["tokenize"] = time.perf_counter() - phase
+
+        phase = time.perf_counter()
+        index = BM25Index(chunks, frequencies)
+        version_digest = hashlib.sha256()
+        for path, state in files.items():
+            version_digest.update(str(path).encode("utf-8"))
+            version_digest.update(state.digest.encode("ascii"))
+        timings["index"] = time.perf_counter() - phase
+
+        # Single reference swap: readers see either the old or the new snapshot
+        self._snapshot = Snapshot(index=index, version=version_digest.hexdigest()[:16])
+        self._files = files
+        self._term_cache = term_cache
+        self.reloads += 1
+        stats["chunks"] = len(chunks)
+        stats["swapped"] = True
+        timings["total"] = time.perf_counter() - started
+        stats["timings"] = timings
+        print(
+            f"📚 Knowledge index built ({len(chunks)} chunks, "
+            f"{stats['chunks_tokenized']} re-tokenized, version {self.version})"
+        )
+        return stats
+
+    def ensure_loaded(self):
+        """Return the live index, reloading changed files at most once per interval."""
+        now = time.monotonic()
+        interval = getattr(settings, "KNOWLEDGE_RELOAD_INTERVAL", 5)
+        if self._snapshot is None:
+            self.refresh()
+            self._last_check = now
+        elif interval >= 0 and now - self._last_check >= interval:
+            self._last_check = now
+            # Skip if another thread is already reloading; keep serving the old snapshot
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._refresh(force=False)
+                finally:
+                    self._lock.release()
+        return self._snapshot.index
+
+    def retrieve(self, query, top_k=None, token_budget=None):
+        """Return the best chunks for the query that fit within the token budget."""
+        index = self.ensure_loaded()
+        top_k = top_k or getattr(settings, "KNOWLEDGE_TOP_K", 4)
+        token_budget = token_budget or getattr(settings, "KNOWLEDGE_TOKEN_BUDGET", 1200)
+
+        selected = []
+        used = 0
+        for chunk, _score in index.search(query, top_k):
+            if used + chunk.tokens > token_budget:
+                continue
+            selected.append(chunk)
+            used += chunk.tokens
+        return selected
+
+    def build_context(self, query, top_k=None, token_budget=None):
+        """Join the retrieved chunks into prompt-ready text, or None if nothing matched."""
+        chunks = self.retrieve(query, top_k=top_k, token_budget=token_budget)
+        if not chunks:
+            return None
+        return "\n\n".join(chunk.text for chunk in chunks)
+
+
+# Shared per-process store
+knowledge_store = KnowledgeStore()
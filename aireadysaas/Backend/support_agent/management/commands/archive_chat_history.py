@@ -0,0 +1,89 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from support_agent.archive import archive_chat_history
+
+
+class Command(BaseCommand):
+    help = (
+        "Move ChatHistory rows older than CHAT_ARCHIVE_AFTER_DAYS into compressed "
+        "ChatArchive segments. Run it from cron, or keep it running with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=getattr(settings, "CHAT_ARCHIVE_AFTER_DAYS", 90),
+            help="Archive chats older than this many days",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=getattr(settings, "CHAT_ARCHIVE_BATCH_SIZE", 1000),
+            help="Rows deleted per DELETE statement",
+        )
+        parser.add_argument(
+            "--segment-rows",
+            type=int,
+            default=getattr(settings, "CHAT_ARCHIVE_SEGMENT_ROWS", 5000),
+            help="Rows read per window (and at most per archive segment)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Rows fetched per database round trip while streaming",
+        )
+        parser.add_argument(
+            "--limit", type=int, help="Stop after archiving this many rows"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many rows would be archived",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Keep running, archiving again every this many seconds",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            cutoff = timezone.now() - timedelta(days=options["days"])
+            started = time.perf_counter()
+            stats = archive_chat_history(
+                cutoff=cutoff,
+                batch_size=options["batch_size"],
+                segment_rows=options["segment_rows"],
+                chunk_size=options["chunk_size"],
+                limit=options["limit"],
+                dry_run=options["dry_run"],
+            )
+            elapsed = time.perf_counter() - started
+
+            if options["dry_run"]:
+                self.stdout.write(
+                    f"Would archive {stats['rows']} chats from {stats['users']} users "
+                    f"older than {cutoff:%Y-%m-%d %H:%M}"
+                )
+            else:
+                ratio = (
+                    stats["raw_bytes"] / stats["compressed_bytes"]
+                    if stats["compressed_bytes"]
+                    else 0.0
+                )
+                self.stdout.write(
+                    f"Archived {stats['rows']} chats into {stats['segments']} segments "
+                    f"({stats['raw_bytes']} → {stats['compressed_bytes']} bytes, "
+                    f"{ratio:.1f}x) in {elapsed:.2f}s"
+                )
+
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
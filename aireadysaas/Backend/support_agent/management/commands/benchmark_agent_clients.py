@@ -0,0 +1,124 @@
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from anthropic import Anthropic, DefaultHttpxClient as AnthropicHttpxClient
+from django.core.management.base import BaseCommand
+from openai import DefaultHttpxClient as OpenAIHttpxClient, OpenAI
+
+from agents.clients import close_clients, get_client
+
+OPENAI_REPLY = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-3.5-turbo",
+    "choices": [
+        {"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}
+    ],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+CLAUDE_REPLY = {
+    "id": "msg_bench",
+    "type": "message",
+    "role": "assistant",
+    "model": "claude-3-sonnet-20240229",
+    "content": [{"type": "text", "text": "ok"}],
+    "stop_reason": "end_turn",
+    "usage": {"input_tokens": 1, "output_tokens": 1},
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real APIs
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps(
+            CLAUDE_REPLY if self.path.endswith("/messages") else OPENAI_REPLY
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _call(provider, client):
+    if provider == "claude":
+        client.messages.create(
+            model="claude-3-sonnet-20240229",
+            max_tokens=16,
+            messages=[{"role": "user", "content": "ping"}],
+        )
+    else:
+        client.chat.completions.create(
+            model="gpt-3.5-turbo", max_tokens=16, messages=[{"role": "user", "content": "ping"}]
+        )
+
+
+class Command(BaseCommand):
+    help = "Compare a new agent SDK client per call with the shared client registry"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=200, help="Calls per mode")
+        parser.add_argument(
+            "--provider", choices=["claude", "openai"], action="append", help="Default: both"
+        )
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        server.daemon_threads = True
+        server.connections = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        try:
+            for provider in options["provider"] or ["claude", "openai"]:
+                url = base_url if provider == "claude" else f"{base_url}/v1"
+                sdk, http_client = (
+                    (Anthropic, AnthropicHttpxClient)
+                    if provider == "claude"
+                    else (OpenAI, OpenAIHttpxClient)
+                )
+
+                def fresh():
+                    started = time.perf_counter()
+                    client = sdk(api_key="bench", base_url=url, http_client=http_client())
+                    return client, time.perf_counter() - started
+
+                def pooled():
+                    started = time.perf_counter()
+                    client = get_client(provider, "bench", url)
+                    return client, time.perf_counter() - started
+
+                _call(provider, get_client(provider, "bench", url))  # warm up
+                for mode, factory in (("new client per call", fresh), ("shared client", pooled)):
+                    server.connections = 0
+                    build, total = [], []
+                    for _ in range(options["calls"]):
+                        started = time.perf_counter()
+                        client, built = factory()
+                        _call(provider, client)
+                        build.append(built)
+                        total.append(time.perf_counter() - started)
+                        if mode == "new client per call":
+                            client.close()
+                    self.stdout.write(
+                        f"{provider:6} {mode:20} construct {statistics.mean(build) * 1000:7.3f}ms  "
+                        f"call p50 {statistics.median(total) * 1000:6.2f}ms  "
+                        f"mean {statistics.mean(total) * 1000:6.2f}ms  "
+                        f"connections {server.connections}"
+                    )
+        finally:
+            close_clients()
+            server.shutdown()
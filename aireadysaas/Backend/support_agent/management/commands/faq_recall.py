@@ -0,0 +1,63 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from support_agent.faq_index import faq_index
+from support_agent.models import ChatHistory
+
+
+class Command(BaseCommand):
+    help = "Check FAQ candidate prefilter recall against brute-force matching"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sample", type=int, default=500, help="Number of queries")
+        parser.add_argument(
+            "--limit", type=int, default=None, help="Candidate cap (default: FAQ_CANDIDATE_LIMIT)"
+        )
+        parser.add_argument(
+            "--from-faq",
+            action="store_true",
+            help="Use perturbed FAQ questions instead of recent chat history",
+        )
+
+    def handle(self, *args, **options):
+        faq_index.ensure_loaded()
+        sample = options["sample"]
+
+        if options["from_faq"]:
+            questions = faq_index.questions
+            queries = [_perturb(q) for q in random.sample(questions, min(sample, len(questions)))]
+        else:
+            queries = list(
+                ChatHistory.objects.order_by("-timestamp").values_list("question", flat=True)[:sample]
+            )
+
+        started = time.perf_counter()
+        report = faq_index.measure_recall(queries, limit=options["limit"])
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"FAQ entries: {len(faq_index)}, candidate limit: "
+            f"{options['limit'] if options['limit'] is not None else faq_index.candidate_limit}"
+        )
+        self.stdout.write(
+            f"Matched queries: {report['queries']}, recalled: {report['recalled']}, "
+            f"recall: {report['recall']:.2%} ({elapsed:.2f}s)"
+        )
+        for query in report["missed"][:10]:
+            self.stdout.write(self.style.WARNING(f"  missed: {query}"))
+
+        stats = faq_index.stats()
+        self.stdout.write(
+            "Index: "
+            + ", ".join(f"{name} {value}" for name, value in stats.items() if name != "entries")
+        )
+
+
+def _perturb(question):
+    """Drop one random character so the query is close to, but not exactly, the FAQ."""
+    if len(question) < 2:
+        return question
+    i = random.randrange(len(question))
+    return question[:i] + question[i + 1 :]
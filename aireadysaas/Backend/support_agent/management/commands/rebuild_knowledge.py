@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from support_agent.knowledge import knowledge_store
+
+
+class Command(BaseCommand):
+    help = "Re-index the knowledge directory and report what changed and how long it took"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-read and re-tokenize every file, ignoring mtimes and hashes",
+        )
+
+    def handle(self, *args, **options):
+        # Load the current state first so the second pass shows incremental cost
+        if not options["force"]:
+            knowledge_store.ensure_loaded()
+        stats = knowledge_store.refresh(force=options["force"])
+
+        self.stdout.write(f"Directory: {knowledge_store.directory}")
+        self.stdout.write(
+            f"Files: {stats['files']} ({stats['files_changed']} changed, "
+            f"{stats['files_removed']} removed)"
+        )
+        if stats["swapped"]:
+            self.stdout.write(
+                f"Chunks: {stats['chunks']} ({stats['chunks_tokenized']} re-tokenized), "
+                f"version {knowledge_store.version}"
+            )
+        else:
+            self.stdout.write("No changes; index left as is")
+        for phase, seconds in stats["timings"].items():
+            self.stdout.write(f"  {phase}: {seconds * 1000:.1f} ms")
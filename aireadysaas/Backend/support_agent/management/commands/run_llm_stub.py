@@ -0,0 +1,82 @@
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from support_agent.stub_llm import StubConfig, make_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve OpenAI-, Ollama- and Anthropic-compatible stand-in LLM APIs locally "
+        "(use with LLM_BACKEND=stub)"
+    )
+
+    def add_arguments(self, parser):
+        address = urlsplit(settings.LLM_STUB_URL)
+        parser.add_argument("--host", default=address.hostname or "127.0.0.1")
+        parser.add_argument("--port", type=int, default=address.port or 8765)
+        parser.add_argument(
+            "--latency",
+            default=settings.LLM_STUB_LATENCY,
+            help='Time to first token in ms, e.g. "fixed:200" or "lognormal:400,0.5"',
+        )
+        parser.add_argument(
+            "--token-latency",
+            default=settings.LLM_STUB_TOKEN_LATENCY,
+            help="Delay between streamed tokens in ms (same format)",
+        )
+        parser.add_argument(
+            "--reply-tokens",
+            type=int,
+            default=settings.LLM_STUB_REPLY_TOKENS,
+            help="Reply length in tokens, capped by the request's max_tokens",
+        )
+        parser.add_argument(
+            "--failures",
+            default=settings.LLM_STUB_FAILURES,
+            help='Injected failure rates, e.g. "429:0.05,500:0.01,timeout:0.005"',
+        )
+        parser.add_argument(
+            "--retry-after",
+            type=float,
+            default=settings.LLM_STUB_RETRY_AFTER,
+            help="Retry-After seconds sent with 429s",
+        )
+        parser.add_argument(
+            "--hang",
+            type=float,
+            default=settings.LLM_STUB_HANG,
+            help="Seconds an injected timeout holds the request open",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=settings.LLM_STUB_SEED, help="Seed for latency and failures"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            config = StubConfig(
+                latency=options["latency"],
+                token_latency=options["token_latency"],
+                reply_tokens=options["reply_tokens"],
+                failures=options["failures"],
+                retry_after=options["retry_after"],
+                hang=options["hang"],
+                seed=options["seed"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        server = make_server(options["host"], options["port"], config)
+        host, port = server.server_address[:2]
+        self.stdout.write(f"🧪 Stub LLM listening on http://{host}:{port}")
+        self.stdout.write(
+            f"   latency {options['latency']}, per token {options['token_latency']}, "
+            f"failures {options['failures'] or 'none'}"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.5 on 2026-10-18 14:40
+
+import uuid
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def populate_uuids(apps, schema_editor):
+    ChatHistory = apps.get_model("support_agent", "ChatHistory")
+    batch = []
+    for entry in ChatHistory.objects.only("pk").iterator(chunk_size=2000):
+        entry.uuid = uuid.uuid4()
+        batch.append(entry)
+        if len(batch) >= 2000:
+            ChatHistory.objects.bulk_update(batch, ["uuid"])
+            batch = []
+    if batch:
+        ChatHistory.objects.bulk_update(batch, ["uuid"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support_agent', '0004_delete_seodata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_uuids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chathistory',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='chathistory',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.5 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support_agent', '0005_chathistory_uuid'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['user_id', '-timestamp', '-id'], name='chathistory_user_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['-timestamp', '-id'], name='chathistory_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.5 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support_agent', '0007_chatarchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=255, unique=True)),
+                ('summary', models.TextField(blank=True, default='')),
+                ('last_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('last_chat_id', models.BigIntegerField(blank=True, null=True)),
+                ('turns', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-18 14:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support_agent', '0008_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='degraded',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,19 +1,128 @@
+import uuid
 from django.db import models
+from django.utils import timezone
+
+
+class FAQQuerySet(models.QuerySet):
+    """Bulk writes send no post_save, so they bump the FAQ version themselves."""
+
+    def _changed(self):
+        # Imported here so models stay importable without the index's dependencies
+        from .faq_index import bump_faq_version
+
+        bump_faq_version()
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        if rows:
+            self._changed()
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        if created:
+            self._changed()
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        if rows:
+            self._changed()
+        return rows
 
 
 class FAQ(models.Model):
     question = models.TextField(unique=True)
     answer = models.TextField()
 
+    objects = FAQQuerySet.as_manager()
+
     def __str__(self):
         return self.question
 
 
+class FAQVersion(models.Model):
+    """
+    Single-row counter bumped on every FAQ change.
+
+    Workers compare it with the version their in-process FAQ index was built
+    from (support_agent.faq_index), so an edit made in one worker reaches all
+    of them without a shared cache.
+    """
+
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"FAQ version {self.version}"
+
+
 class ChatHistory(models.Model):
+    # Client-generated id, so a row queued for write-behind can be referenced
+    # before it has a database primary key
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     user_id = models.CharField(max_length=255)
     question = models.TextField()
     response = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Defaulted rather than auto_now_add so queued (write-behind) rows keep the
+    # time the chat happened, not the time they were flushed
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # The answer is a fallback (FAQ text or canned message), not a generated one
+    degraded = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Per-user history pages, newest first (id breaks timestamp ties)
+            models.Index(
+                fields=["user_id", "-timestamp", "-id"], name="chathistory_user_ts_idx"
+            ),
+            # Admin listing and time-based archiving
+            models.Index(fields=["-timestamp", "-id"], name="chathistory_ts_idx"),
+        ]
 
     def __str__(self):
         return f"Chat with {self.user_id} at {self.timestamp}"
+
+
+class ChatArchive(models.Model):
+    """
+    A zstd-compressed JSONL segment of one user's archived ChatHistory rows.
+
+    Rows are moved here by the ``archive_chat_history`` command once they are
+    older than CHAT_ARCHIVE_AFTER_DAYS; see support_agent.archive.
+    """
+
+    user_id = models.CharField(max_length=255)
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    row_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user_id", "-last_timestamp", "-id"], name="chatarchive_user_ts_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Archive of {self.row_count} chats with {self.user_id}"
+
+
+class ConversationSummary(models.Model):
+    """
+    Rolling summary of a user's older chat turns, used as prompt context.
+
+    ``last_timestamp``/``last_chat_id`` mark the newest ChatHistory row folded
+    in, so each refresh only summarizes turns added since then.
+    """
+
+    user_id = models.CharField(max_length=255, unique=True)
+    summary = models.TextField(blank=True, default="")
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    last_chat_id = models.BigIntegerField(null=True, blank=True)
+    turns = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summary of {self.turns} turns with {self.user_id}"
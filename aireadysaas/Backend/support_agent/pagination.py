@@ -0,0 +1,55 @@
+"""
+Keyset (cursor) pagination for chat history.
+
+Pages are ordered newest first by ``(timestamp, id)`` and the cursor carries
+the last row's position, so fetching page N is an index range scan that
+costs the same as fetching page 1 (no OFFSET). Cursors are opaque
+URL-safe base64 strings.
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor cannot be decoded."""
+
+
+def encode_cursor(timestamp, pk):
+    raw = f"{timestamp.isoformat()}|{pk}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the (timestamp, id) position encoded in cursor."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, pk = base64.urlsafe_b64decode(padded).decode("utf-8").split("|")
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def keyset_page(queryset, cursor=None, limit=50):
+    """
+    Return ``(rows, next_cursor)`` for the page after ``cursor``.
+
+    ``next_cursor`` is None on the last page. One extra row is fetched to
+    know whether another page exists, so no COUNT query is needed.
+    """
+    queryset = queryset.order_by("-timestamp", "-id")
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        # The redundant timestamp__lte bounds the index range scan; the OR
+        # only resolves ties on the boundary timestamp
+        queryset = queryset.filter(timestamp__lte=timestamp).filter(
+            Q(timestamp__lt=timestamp) | Q(id__lt=pk)
+        )
+
+    rows = list(queryset[: limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last.timestamp, last.pk)
@@ -0,0 +1,674 @@
+"""
+Routing of support prompts across several LLM backends.
+
+``LLM_BACKENDS`` is an ordered list of backend names:
+    "openai"       - OpenAI chat completions over HTTP
+    "ollama"       - a local Ollama server
+    "claude"       - agents.claude_agent.ask_claude
+    "openai_agent" - agents.openai_agent.ask_openai
+
+The router sends the prompt to the first backend whose circuit breaker is
+closed. If no answer has arrived once that backend's
+``LLM_HEDGE_PERCENTILE`` latency has passed, a hedged request goes to the
+next backend and whichever answers first wins; the loser is cancelled.
+Only the async path can really cancel it. On the sync path a request that has
+started cannot be interrupted: the loser keeps its router worker until it
+answers or hits its read timeout, which is capped by the request deadline.
+Hedging pauses while ``LLM_HEDGE_MAX_ABANDONED`` such losers are still
+running, so they cannot take over the worker pool. A backend that fails ``LLM_BREAKER_FAILURES`` times in a row
+is skipped for ``LLM_BREAKER_RESET`` seconds, then a single trial request
+decides whether it is used again.
+
+Streamed answers (``ProviderRouter.stream``) take the same backends and
+breakers, without hedging: a failed stream fails over to the next backend
+only until its first delta has reached the caller.
+
+A backend that turns a call down because of our own rate limits (an agent
+backend's ``RateLimitExceeded``) is not unhealthy; that never counts
+against its breaker.
+
+With ``LLM_BACKEND=stub`` the HTTP backends talk to the local stand-in
+(support_agent.stub_llm) instead of OpenAI and Ollama.
+"""
+import asyncio
+import importlib
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing
+from functools import partial
+
+import requests
+from agents.rate_limit import RateLimitExceeded
+from django.conf import settings
+from utils.metrics import observe_llm_call, observe_llm_tokens
+
+from .deadline import Deadline, http_timeout
+
+if settings.LLM_BACKEND == "stub":
+    # Local stand-in for load testing (manage.py run_llm_stub)
+    OLLAMA_URL = f"{settings.LLM_STUB_URL}/api/generate"
+    OPENAI_URL = f"{settings.LLM_STUB_URL}/v1/chat/completions"
+else:
+    OLLAMA_URL = "http://localhost:11434/api/generate"
+    OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+
+class BackendError(Exception):
+    """A backend answered with an error or an unusable response."""
+
+
+class NoBackendAvailable(BackendError):
+    """Every configured backend has an open circuit breaker."""
+
+
+class NoBackendConfigured(NoBackendAvailable):
+    """None of the LLM_BACKENDS has the credentials it needs."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a half-open trial after a cool-down."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """True if a request may be sent now (claims the trial when half-open)."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            trial_failed = self._trial_running
+            self._trial_running = False
+            if trial_failed or (
+                self.opened_at is None and self.failures >= self.failure_threshold
+            ):
+                print(f"🚫 Circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """Hand back a claimed trial request without judging the backend."""
+        with self._lock:
+            self._trial_running = False
+
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies."""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class Backend:
+    """One LLM endpoint; ``complete`` returns (text, prompt_tokens) or raises."""
+
+    name = ""
+    model = ""
+    # Agent helpers record their own token usage in the ledger
+    records_usage = False
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            getattr(settings, "LLM_BREAKER_FAILURES", 5),
+            getattr(settings, "LLM_BREAKER_RESET", 30.0),
+        )
+        self.latency = LatencyTracker()
+
+    def configured(self):
+        return True
+
+    def complete(self, prompt, system_prompt, timeout, max_tokens=300):
+        raise NotImplementedError
+
+    async def acomplete(self, prompt, system_prompt, timeout, max_tokens=300):
+        return await asyncio.to_thread(
+            self.complete, prompt, system_prompt, timeout, max_tokens
+        )
+
+    def stream(self, prompt, system_prompt, timeout, max_tokens=300):
+        """Yield the answer as text deltas (in one piece unless overridden)."""
+        yield self.complete(prompt, system_prompt, timeout, max_tokens)[0]
+
+
+class OpenAIBackend(Backend):
+    name = "openai"
+    model = "gpt-4"
+
+    def configured(self):
+        return bool(settings.OPENAI_API_KEY)
+
+    def _request(self, prompt, system_prompt, max_tokens):
+        headers = {"Authorization": f"Bearer {settings.OPENAI_API_KEY}"}
+        data = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            "max_tokens": max_tokens,
+        }
+        return headers, data
+
+    def _parse(self, status_code, response_json):
+        if status_code != 200:
+            raise BackendError(f"OpenAI Error: {response_json}")
+        answer = response_json["choices"][0]["message"]["content"].strip()
+        usage = response_json.get("usage", {})
+        observe_llm_tokens(
+            self.name, self.model, "support", usage.get("prompt_tokens"), usage.get("completion_tokens")
+        )
+        return answer, usage.get("prompt_tokens")
+
+    def complete(self, prompt, system_prompt, timeout, max_tokens=300):
+        headers, data = self._request(prompt, system_prompt, max_tokens)
+        response = requests.post(OPENAI_URL, json=data, headers=headers, timeout=timeout)
+        return self._parse(response.status_code, response.json())
+
+    async def acomplete(self, prompt, system_prompt, timeout, max_tokens=300):
+        # Imported here: async_utils imports utils, which imports this module
+        from .async_utils import get_async_client
+
+        headers, data = self._request(prompt, system_prompt, max_tokens)
+        response = await get_async_client().post(
+            OPENAI_URL, json=data, headers=headers, timeout=timeout[1]
+        )
+        return self._parse(response.status_code, response.json())
+
+    def stream(self, prompt, system_prompt, timeout, max_tokens=300):
+        headers, data = self._request(prompt, system_prompt, max_tokens)
+        data["stream"] = True
+        with requests.post(
+            OPENAI_URL, json=data, headers=headers, stream=True, timeout=timeout
+        ) as response:
+            if response.status_code != 200:
+                raise BackendError(f"OpenAI Error {response.status_code}: {response.text}")
+            # OpenAI streams server-sent events: "data: {json}" ... "data: [DONE]"
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                choices = json.loads(payload).get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+
+class OllamaBackend(Backend):
+    name = "ollama"
+    model = "mistral"
+
+    def _parse(self, response_json):
+        if "response" not in response_json:
+            raise BackendError(f"Ollama Error: {response_json}")
+        observe_llm_tokens(
+            self.name,
+            self.model,
+            "support",
+            response_json.get("prompt_eval_count"),
+            response_json.get("eval_count"),
+        )
+        return response_json["response"].strip(), response_json.get("prompt_eval_count")
+
+    def complete(self, prompt, system_prompt, timeout, max_tokens=300):
+        data = {"model": self.model, "prompt": prompt, "stream": False}
+        return self._parse(requests.post(OLLAMA_URL, json=data, timeout=timeout).json())
+
+    async def acomplete(self, prompt, system_prompt, timeout, max_tokens=300):
+        from .async_utils import get_async_client
+
+        data = {"model": self.model, "prompt": prompt, "stream": False}
+        response = await get_async_client().post(OLLAMA_URL, json=data, timeout=timeout[1])
+        return self._parse(response.json())
+
+    def stream(self, prompt, system_prompt, timeout, max_tokens=300):
+        data = {"model": self.model, "prompt": prompt, "stream": True}
+        with requests.post(OLLAMA_URL, json=data, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            # Ollama streams newline-delimited JSON objects
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise BackendError(f"Ollama Error: {chunk['error']}")
+                if chunk.get("response"):
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    break
+
+
+class AgentBackend(Backend):
+    """Adapter for the ``agents`` helpers (ask_claude / ask_openai)."""
+
+    records_usage = True
+
+    def __init__(self, name, model, module, function, api_key_setting):
+        super().__init__()
+        self.name = name
+        self.model = model
+        self._module = module
+        self._function = function
+        self._api_key_setting = api_key_setting
+
+    def configured(self):
+        return bool(getattr(settings, self._api_key_setting, ""))
+
+    def complete(self, prompt, system_prompt, timeout, max_tokens=300):
+        # Imported on first use so the SDKs load only when the backend is enabled
+        ask = getattr(importlib.import_module(self._module), self._function)
+        text = ask(
+            f"{system_prompt}\n\n{prompt}",
+            model=self.model,
+            max_tokens=max_tokens,
+            call="support",
+            timeout=timeout[1],
+            # A throttled agent fails over to the next backend instead of waiting
+            block=False,
+            # Support answers have their own response cache
+            use_memo=False,
+            # The router fails over instead; retries would outlive the deadline
+            max_retries=0,
+        )
+        return text.strip(), None
+
+    def stream(self, prompt, system_prompt, timeout, max_tokens=300):
+        stream = getattr(
+            importlib.import_module(self._module), self._function.replace("ask_", "stream_")
+        )
+        yield from stream(
+            f"{system_prompt}\n\n{prompt}",
+            model=self.model,
+            max_tokens=max_tokens,
+            call="support_stream",
+            timeout=timeout[1],
+            block=False,
+        )
+
+
+BACKEND_FACTORIES = {
+    "openai": OpenAIBackend,
+    "ollama": OllamaBackend,
+    "claude": lambda: AgentBackend(
+        "claude",
+        "claude-3-sonnet-20240229",
+        "agents.claude_agent",
+        "ask_claude",
+        "ANTHROPIC_API_KEY",
+    ),
+    "openai_agent": lambda: AgentBackend(
+        "openai_agent",
+        "gpt-3.5-turbo",
+        "agents.openai_agent",
+        "ask_openai",
+        "OPENAI_API_KEY",
+    ),
+}
+
+
+class ProviderRouter:
+    """Ordered backends with hedged requests and per-backend circuit breakers."""
+
+    def __init__(self):
+        self._backends = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        # Sync requests cancelled while already running (see _cancel)
+        self.abandoned = 0
+
+    @property
+    def backends(self):
+        if self._backends is None:
+            with self._lock:
+                if self._backends is None:
+                    names = getattr(settings, "LLM_BACKENDS", None) or [
+                        "ollama" if settings.USE_OLLAMA else "openai"
+                    ]
+                    self._backends = [BACKEND_FACTORIES[name]() for name in names]
+        return self._backends
+
+    @property
+    def primary(self):
+        return self.backends[0]
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=getattr(settings, "LLM_ROUTER_WORKERS", 32),
+                        thread_name_prefix="llm-router",
+                    )
+        return self._executor
+
+    def candidates(self):
+        """Configured backends in order, minus those whose breaker is open."""
+        configured = [backend for backend in self.backends if backend.configured()]
+        if not configured:
+            raise NoBackendConfigured("No LLM backend is configured")
+        allowed = [backend for backend in configured if backend.breaker.state != "open"]
+        if not allowed:
+            raise NoBackendAvailable("Every LLM backend has an open circuit breaker")
+        return allowed
+
+    def hedge_delay(self, backend):
+        """Seconds to wait on backend before hedging, or None to never hedge."""
+        if not getattr(settings, "LLM_HEDGE", True):
+            return None
+        if len(backend.latency) < getattr(settings, "LLM_HEDGE_MIN_SAMPLES", 20):
+            return getattr(settings, "LLM_HEDGE_DELAY", 2.0)
+        return backend.latency.percentile(getattr(settings, "LLM_HEDGE_PERCENTILE", 95))
+
+    def _record(self, backend, started, error, deadline, call="support"):
+        elapsed = time.monotonic() - started
+        if isinstance(error, RateLimitExceeded):
+            # Throttled by our own limiter: the backend was never asked
+            backend.breaker.release()
+            return
+        if not backend.records_usage:
+            # Agent backends report their own calls
+            observe_llm_call(backend.name, backend.model, call, elapsed, error)
+        if error is None:
+            if call == "support":
+                # Only whole answers feed the hedging percentiles
+                backend.latency.add(elapsed)
+            backend.breaker.record_success()
+        elif deadline.expired and isinstance(error, requests.Timeout):
+            # Running out of the caller's budget is not the backend's fault
+            backend.breaker.release()
+        else:
+            backend.breaker.record_failure()
+
+    def _attempt(self, backend, prompt, system_prompt, deadline, max_tokens):
+        started = time.monotonic()
+        try:
+            result = backend.complete(prompt, system_prompt, http_timeout(deadline), max_tokens)
+        except Exception as e:
+            self._record(backend, started, e, deadline)
+            raise
+        self._record(backend, started, None, deadline)
+        return result
+
+    def _cancel(self, pending):
+        """
+        Cancel sync requests, handing back any half-open trial they claimed.
+
+        Requests already running cannot be stopped; they are counted in
+        ``abandoned`` until they finish.
+        """
+        for future, backend in pending.items():
+            if future.cancel():
+                # Never ran, so _attempt will not report back to the breaker
+                backend.breaker.release()
+                continue
+            with self._lock:
+                self.abandoned += 1
+            future.add_done_callback(self._forget_abandoned)
+
+    def _forget_abandoned(self, future):
+        with self._lock:
+            self.abandoned -= 1
+
+    def can_hedge(self):
+        """False while too many abandoned sync requests still hold router workers."""
+        return self.abandoned < getattr(settings, "LLM_HEDGE_MAX_ABANDONED", 8)
+
+    @staticmethod
+    def _release_if_cancelled(backend, task):
+        """
+        Hand back the half-open trial of a cancelled async attempt.
+
+        Done callback rather than an except clause: a task cancelled before
+        its first step never runs its body.
+        """
+        if task.cancelled():
+            backend.breaker.release()
+
+    def complete(self, prompt, system_prompt, deadline=None, max_tokens=300):
+        """
+        Answer prompt from the fastest healthy backend; returns (text, tokens, backend).
+
+        Raises requests.Timeout once the deadline passes, NoBackendAvailable
+        when every backend is skipped, or the last backend's error.
+        """
+        deadline = deadline or Deadline()
+        candidates = self.candidates()
+        pending = {}
+        error = None
+        launched = 0
+
+        def launch():
+            """Start the next backend whose breaker lets a request through."""
+            nonlocal launched
+            while launched < len(candidates):
+                backend = candidates[launched]
+                launched += 1
+                # Claims the single trial request of a half-open breaker
+                if backend.breaker.allow():
+                    future = self.executor.submit(
+                        self._attempt, backend, prompt, system_prompt, deadline, max_tokens
+                    )
+                    pending[future] = backend
+                    return True
+            return False
+
+        if not launch():
+            raise NoBackendAvailable("Every LLM backend has an open circuit breaker")
+        first = next(iter(pending.values()))
+        hedged = False
+        while pending:
+            can_hedge = launched < len(candidates) and self.can_hedge()
+            delay = self.hedge_delay(first) if can_hedge else None
+            done, _ = wait(pending, timeout=deadline.cap(delay), return_when=FIRST_COMPLETED)
+
+            if not done:
+                if deadline.expired:
+                    self._cancel(pending)
+                    raise requests.Timeout("Deadline passed waiting for the LLM")
+                if can_hedge and launch():
+                    hedged = True
+                    self.hedges += 1
+                    print(f"🏁 Hedged to {list(pending.values())[-1].name} after {delay:.2f}s")
+                continue
+
+            for future in done:
+                backend = pending.pop(future)
+                try:
+                    text, tokens = future.result()
+                except Exception as e:
+                    print(f"❌ LLM backend {backend.name} failed: {e}")
+                    error = e
+                    if not pending and launch():
+                        self.failovers += 1
+                    continue
+                # First answer wins; the slower request is abandoned
+                self._cancel(pending)
+                if hedged and backend is not first:
+                    self.hedge_wins += 1
+                return text, tokens, backend
+        raise error
+
+    async def acomplete(self, prompt, system_prompt, deadline=None, max_tokens=300):
+        """Async variant of complete; losing requests are cancelled outright."""
+        deadline = deadline or Deadline()
+        candidates = self.candidates()
+        pending = {}
+        error = None
+        launched = 0
+
+        async def attempt(backend):
+            started = time.monotonic()
+            try:
+                result = await backend.acomplete(
+                    prompt, system_prompt, http_timeout(deadline), max_tokens
+                )
+            except asyncio.CancelledError:
+                # A hedge loser or a missed deadline; see _release_if_cancelled
+                raise
+            except Exception as e:
+                self._record(backend, started, e, deadline)
+                raise
+            self._record(backend, started, None, deadline)
+            return result
+
+        def launch():
+            nonlocal launched
+            while launched < len(candidates):
+                backend = candidates[launched]
+                launched += 1
+                if backend.breaker.allow():
+                    task = asyncio.ensure_future(attempt(backend))
+                    task.add_done_callback(partial(self._release_if_cancelled, backend))
+                    pending[task] = backend
+                    return True
+            return False
+
+        if not launch():
+            raise NoBackendAvailable("Every LLM backend has an open circuit breaker")
+        first = next(iter(pending.values()))
+        hedged = False
+        try:
+            while pending:
+                can_hedge = launched < len(candidates)
+                delay = self.hedge_delay(first) if can_hedge else None
+                done, _ = await asyncio.wait(
+                    pending, timeout=deadline.cap(delay), return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if not done:
+                    if deadline.expired:
+                        raise asyncio.TimeoutError()
+                    if can_hedge and launch():
+                        hedged = True
+                        self.hedges += 1
+                        print(f"🏁 Hedged to {list(pending.values())[-1].name} after {delay:.2f}s")
+                    continue
+
+                for task in done:
+                    backend = pending.pop(task)
+                    try:
+                        text, tokens = task.result()
+                    except Exception as e:
+                        print(f"❌ LLM backend {backend.name} failed: {e}")
+                        error = e
+                        if not pending and launch():
+                            self.failovers += 1
+                        continue
+                    if hedged and backend is not first:
+                        self.hedge_wins += 1
+                    return text, tokens, backend
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stream(self, prompt, system_prompt, deadline=None, max_tokens=300):
+        """
+        Stream prompt from the first healthy backend; yields (backend, delta).
+
+        A backend that fails before its first delta is skipped for the next
+        one; after that its error reaches the caller, since the text already
+        sent cannot be taken back. Raises like complete.
+        """
+        deadline = deadline or Deadline()
+        error = None
+        for backend in self.candidates():
+            if not backend.breaker.allow():
+                continue
+            if error is not None:
+                self.failovers += 1
+            started = time.monotonic()
+            streamed = False
+            try:
+                timeout = http_timeout(deadline)
+                # Closed right away if the caller stops reading, so the
+                # backend's own cleanup (e.g. refunding its rate limit) runs
+                with closing(backend.stream(prompt, system_prompt, timeout, max_tokens)) as deltas:
+                    for delta in deltas:
+                        streamed = True
+                        yield backend, delta
+            except GeneratorExit:
+                # The caller stopped reading; that says nothing about the backend
+                backend.breaker.release()
+                raise
+            except Exception as e:
+                self._record(backend, started, e, deadline, call="support_stream")
+                if streamed:
+                    raise
+                print(f"❌ LLM backend {backend.name} failed: {e}")
+                error = e
+                continue
+            self._record(backend, started, None, deadline, call="support_stream")
+            return
+        if error is None:
+            raise NoBackendAvailable("Every LLM backend has an open circuit breaker")
+        raise error
+
+    def stats(self):
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "abandoned": self.abandoned,
+            "backends": {
+                backend.name: {
+                    "breaker": backend.breaker.state,
+                    "failures": backend.breaker.failures,
+                    "samples": len(backend.latency),
+                    "p50": backend.latency.percentile(50),
+                    "p95": backend.latency.percentile(95),
+                }
+                for backend in self.backends
+            },
+        }
+
+
+# Shared per-process router
+provider_router = ProviderRouter()
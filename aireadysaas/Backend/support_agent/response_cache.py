@@ -0,0 +1,233 @@
+"""
+Cache for generated support answers.
+
+Support traffic is repetitive, so answers are cached under a key built from
+the normalized query text, the matched FAQ answer (or the knowledge-base
+version), the FAQ version counter, the provider/model and any conversation
+context. Changing an FAQ or
+a knowledge file therefore changes the key and old answers are never served.
+
+Backends (``LLM_CACHE_BACKEND``):
+    "memory" - per-process LRU with TTL (default)
+    "django" - a Django cache alias, shared by every worker
+    "off"    - no caching
+
+With the "django" backend and ``SUPPORT_SINGLEFLIGHT_SHARED`` enabled, a
+short-lived in-flight marker in the same cache lets one worker compute an
+answer while the others poll for it (cross-worker single flight).
+"""
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = "?!.,;: "
+
+
+def normalize_query(query):
+    """Case-fold, collapse whitespace and drop trailing punctuation."""
+    return _SPACE_RE.sub(" ", query.casefold()).strip().rstrip(_TRAILING_PUNCTUATION)
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DjangoCacheBackend:
+    """Adapter storing entries in a Django cache alias so workers share them."""
+
+    def __init__(self, alias="default", ttl=3600):
+        self.alias = alias
+        self.ttl = ttl
+
+    def get(self, key):
+        return caches[self.alias].get(key)
+
+    def set(self, key, value):
+        caches[self.alias].set(key, value, timeout=self.ttl or None)
+
+    def clear(self):
+        # Entries are keyed by FAQ/knowledge version, so stale ones simply expire
+        pass
+
+
+class ResponseCache:
+    """Front-end that builds keys, picks a backend from settings and counts hits."""
+
+    def __init__(self):
+        self._backend = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return getattr(settings, "LLM_CACHE_BACKEND", "memory") != "off"
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    kind = getattr(settings, "LLM_CACHE_BACKEND", "memory")
+                    ttl = getattr(settings, "LLM_CACHE_TTL", 3600)
+                    if kind == "django":
+                        self._backend = DjangoCacheBackend(
+                            getattr(settings, "LLM_CACHE_ALIAS", "default"), ttl
+                        )
+                    else:
+                        self._backend = LRUCache(
+                            getattr(settings, "LLM_CACHE_MAX_ENTRIES", 1000), ttl
+                        )
+        return self._backend
+
+    @staticmethod
+    def make_key(
+        query,
+        faq_answer,
+        provider,
+        model,
+        faq_version=None,
+        knowledge_version=None,
+        context=None,
+    ):
+        """Stable cache key for one answer; any version or context change yields a new key."""
+        payload = json.dumps(
+            [
+                normalize_query(query),
+                faq_answer,
+                faq_version,
+                None if faq_answer else knowledge_version,
+                provider,
+                model,
+                context,
+            ]
+        )
+        return "support_agent:llm:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.enabled:
+            self.backend.set(key, value)
+
+    @property
+    def shared_flights(self):
+        """True when in-flight markers can be shared between workers."""
+        return (
+            getattr(settings, "SUPPORT_SINGLEFLIGHT_SHARED", False)
+            and getattr(settings, "LLM_CACHE_BACKEND", "memory") == "django"
+        )
+
+    def _flight_cache(self):
+        return caches[getattr(settings, "LLM_CACHE_ALIAS", "default")]
+
+    def acquire_flight(self, key, timeout):
+        """Claim the shared in-flight marker for key; False if another worker holds it."""
+        return self._flight_cache().add(f"{key}:inflight", 1, timeout=timeout)
+
+    def release_flight(self, key):
+        self._flight_cache().delete(f"{key}:inflight")
+
+    def wait_for(self, key, timeout, interval=0.05):
+        """Poll for a value another worker is computing; None if it never appears."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            value = self.backend.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            if not self._flight_cache().get(f"{key}:inflight"):
+                # The other worker finished; re-check once in case it cached
+                # between our two reads, otherwise it failed without caching
+                value = self.backend.get(key)
+                if value is not None:
+                    self.hits += 1
+                return value
+            time.sleep(interval)
+        return None
+
+    async def await_for(self, key, timeout, interval=0.05):
+        """Async variant of wait_for; polls on the event loop, reads in worker threads."""
+        get = sync_to_async(self.backend.get, thread_sensitive=False)
+        in_flight = sync_to_async(self._flight_cache().get, thread_sensitive=False)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            value = await get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            if not await in_flight(f"{key}:inflight"):
+                value = await get(key)
+                if value is not None:
+                    self.hits += 1
+                return value
+            await asyncio.sleep(interval)
+        return None
+
+    def clear(self):
+        """Drop local entries (shared entries are invalidated through their keys)."""
+        if self._backend is not None:
+            self._backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": getattr(settings, "LLM_CACHE_BACKEND", "memory"),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# Shared per-process cache
+response_cache = ResponseCache()
@@ -6,3 +6,11 @@ class ChatHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatHistory
         fields = "__all__"
+
+
+class ChatHistoryListSerializer(serializers.ModelSerializer):
+    """History list rows without the (large) response text."""
+
+    class Meta:
+        model = ChatHistory
+        fields = ("id", "uuid", "user_id", "question", "timestamp", "degraded")
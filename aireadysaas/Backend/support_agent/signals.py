@@ -0,0 +1,15 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import FAQ
+from .faq_index import faq_index, bump_faq_version
+from .response_cache import response_cache
+
+
+@receiver(post_save, sender=FAQ)
+@receiver(post_delete, sender=FAQ)
+def invalidate_faq_index(sender, instance, **kwargs):
+    """Rebuild the FAQ index here and, via the version counter, in other workers."""
+    faq_index.invalidate()
+    bump_faq_version()
+    # Cached answers are keyed by FAQ version; drop the now-unreachable local ones
+    response_cache.clear()
@@ -0,0 +1,124 @@
+"""
+Single-flight coalescing of identical in-flight work.
+
+While a call for a key is running, concurrent callers with the same key wait
+for its result instead of starting their own. Waiters give up after a
+timeout (raising ``SingleFlightTimeout``) so they can fall back to doing the
+work themselves. ``AsyncSingleFlight`` does the same for coroutines.
+"""
+import asyncio
+import threading
+
+
+class SingleFlightTimeout(Exception):
+    """Raised to a waiter when the in-flight call did not finish in time."""
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Per-process, thread-safe call coalescing keyed by an arbitrary hashable."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run ``fn()`` once for all concurrent callers using ``key``.
+
+        Returns ``(result, shared)`` where ``shared`` is True for callers that
+        received another caller's result. Exceptions raised by ``fn`` are
+        re-raised to every caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise SingleFlightTimeout(f"Timed out waiting for in-flight call {key!r}")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+
+    def in_flight(self):
+        """Number of keys currently being computed."""
+        return len(self._calls)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight(),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+class AsyncSingleFlight:
+    """Coalescing for coroutines running on the same event loop."""
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn, timeout=None):
+        """Await ``coro_fn()`` once for all concurrent callers; returns (result, shared)."""
+        loop = asyncio.get_running_loop()
+        # Futures belong to one loop, so in-flight calls are tracked per loop
+        calls = self._calls.setdefault(loop, {})
+        future = calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                raise SingleFlightTimeout(f"Timed out waiting for in-flight call {key!r}")
+            return result, True
+
+        future = calls[key] = loop.create_future()
+        self.leaders += 1
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an un-awaited failure is not logged as a warning
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            calls.pop(key, None)
+            if not calls:
+                self._calls.pop(loop, None)
@@ -0,0 +1,341 @@
+"""
+Local stand-in for the LLM APIs, for load and resilience testing.
+
+One HTTP server speaks the three wire formats this project uses:
+    POST /v1/chat/completions - OpenAI chat completions (support backend, agents)
+    POST /api/generate        - Ollama generate (the "ollama" support backend)
+    POST /v1/messages         - Anthropic messages (agents)
+each with and without streaming. Start it with ``manage.py run_llm_stub`` and
+set ``LLM_BACKEND=stub`` to point every LLM call at it.
+
+Replies are deterministic: the same prompt always gets the same text, so
+response caches and memoization behave as they do against a real model.
+Latency is sampled per request from configurable distributions (time to first
+token, then a delay per token, streamed token by token), and a fraction of
+requests can fail with 429 (with Retry-After), 5xx, or by hanging until the
+client times out.
+
+Latency specs are in milliseconds:
+    "fixed:200"          always 200ms
+    "uniform:100,400"    between 100 and 400ms
+    "normal:300,80"      mean 300ms, standard deviation 80ms (clipped at 0)
+    "lognormal:300,0.5"  median 300ms, sigma 0.5 (a realistic long tail)
+
+Failure specs map a status code (or "timeout") to a probability, e.g.
+"429:0.05,500:0.01,timeout:0.005". A prompt containing "[stub:429]",
+"[stub:500]" or "[stub:timeout]" fails that way every time.
+"""
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.tokens import count_tokens
+
+WORDS = (
+    "the account billing order refund password reset email support team request "
+    "update settings invoice payment plan subscription access login issue steps "
+    "please check your dashboard within minutes we can help you with this today "
+    "follow these simple instructions and contact us if anything is unclear"
+).split()
+
+FORCED_FAILURE = re.compile(r"\[stub:(\d{3}|timeout)\]")
+
+
+def parse_latency(spec):
+    """Parse a latency spec into a function of a Random returning seconds."""
+    kind, _, args = spec.strip().partition(":")
+    try:
+        values = [float(value) for value in args.split(",")]
+    except ValueError:
+        raise ValueError(f"Invalid latency spec: {spec!r}") from None
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1])) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: values[0] * rng.lognormvariate(0, values[1]) / 1000
+    raise ValueError(f"Invalid latency spec: {spec!r}")
+
+
+def parse_failures(spec):
+    """Parse a failure spec into [(status or "timeout", probability)]."""
+    failures = []
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, rate = part.partition(":")
+        try:
+            failures.append((kind if kind == "timeout" else int(kind), float(rate)))
+        except ValueError:
+            raise ValueError(f"Invalid failure spec: {part!r}") from None
+    if sum(rate for _, rate in failures) > 1:
+        raise ValueError(f"Failure rates add up to more than 1: {spec!r}")
+    return failures
+
+
+def reply_tokens(prompt, count):
+    """The deterministic reply to prompt, as a list of ``count`` text tokens."""
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+    words = [rng.choice(WORDS) for _ in range(max(1, count))]
+    tokens = [words[0].capitalize()] + [f" {word}" for word in words[1:]]
+    tokens[-1] += "."
+    return tokens
+
+
+def _openai_usage(usage):
+    prompt_tokens, completion_tokens = usage
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class StubConfig:
+    """How the stand-in behaves; see the module docstring for the specs."""
+
+    def __init__(
+        self,
+        latency="lognormal:400,0.5",
+        token_latency="fixed:20",
+        reply_tokens=60,
+        failures="",
+        retry_after=1.0,
+        hang=300.0,
+        seed=None,
+    ):
+        self.latency = parse_latency(latency)
+        self.token_latency = parse_latency(token_latency)
+        self.reply_tokens = reply_tokens
+        self.failures = parse_failures(failures)
+        self.retry_after = retry_after
+        self.hang = hang
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def plan(self, prompt):
+        """Draw one request's (failure or None, first token delay, per-token delay)."""
+        with self._lock:
+            roll = self._rng.random()
+            first = self.latency(self._rng)
+            per_token = self.token_latency(self._rng)
+        forced = FORCED_FAILURE.search(prompt)
+        if forced:
+            kind = forced.group(1)
+            return (kind if kind == "timeout" else int(kind)), first, per_token
+        for kind, rate in self.failures:
+            if roll < rate:
+                return kind, first, per_token
+            roll -= rate
+        return None, first, per_token
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real APIs
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            return self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+        if self.path.endswith("/chat/completions"):
+            api = "openai"
+            prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        elif self.path.endswith("/api/generate"):
+            api = "ollama"
+            prompt = str(body.get("prompt", ""))
+        elif self.path.endswith("/messages"):
+            api = "anthropic"
+            prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        else:
+            return self._send_json(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+
+        config = self.server.config
+        failure, first, per_token = config.plan(prompt)
+        if failure == "timeout":
+            # Hang without answering; the client's timeout fires first
+            time.sleep(config.hang)
+            self.close_connection = True
+            return
+        time.sleep(first)
+        if failure is not None:
+            return self._send_error(api, failure)
+
+        model = body.get("model") or "stub"
+        limit = body.get("max_tokens") or body.get("options", {}).get("num_predict")
+        count = min(config.reply_tokens, limit) if limit else config.reply_tokens
+        tokens = reply_tokens(prompt, count)
+        usage = (count_tokens(prompt, model), len(tokens))
+        # Ollama streams unless told not to; the cloud APIs only when asked
+        stream = body.get("stream", api == "ollama")
+        if not stream:
+            time.sleep(per_token * (len(tokens) - 1))
+            reply = getattr(self, f"_{api}_reply")(model, "".join(tokens), usage)
+            return self._send_json(200, reply)
+        self.send_response(200)
+        self.send_header(
+            "Content-Type", "application/x-ndjson" if api == "ollama" else "text/event-stream"
+        )
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        getattr(self, f"_{api}_stream")(model, tokens, usage, per_token, body)
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    # Replies
+
+    @staticmethod
+    def _openai_reply(model, text, usage):
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": _openai_usage(usage),
+        }
+
+    @staticmethod
+    def _ollama_reply(model, text, usage):
+        return {
+            "model": model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "response": text,
+            "done": True,
+            "prompt_eval_count": usage[0],
+            "eval_count": usage[1],
+        }
+
+    @staticmethod
+    def _anthropic_reply(model, text, usage):
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": usage[0], "output_tokens": usage[1]},
+        }
+
+    # Streams
+
+    def _openai_stream(self, model, tokens, usage, per_token, body):
+        chunk = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+        }
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(per_token)
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            choice = {"index": 0, "delta": delta, "finish_reason": None}
+            self._send_event(None, {**chunk, "choices": [choice]})
+        choice = {"index": 0, "delta": {}, "finish_reason": "stop"}
+        self._send_event(None, {**chunk, "choices": [choice]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._send_event(None, {**chunk, "choices": [], "usage": _openai_usage(usage)})
+        self._send_event(None, "[DONE]")
+
+    def _ollama_stream(self, model, tokens, usage, per_token, body):
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(per_token)
+            self._send_chunk(json.dumps({"model": model, "response": token, "done": False}) + "\n")
+        self._send_chunk(json.dumps(self._ollama_reply(model, "", usage)) + "\n")
+
+    def _anthropic_stream(self, model, tokens, usage, per_token, body):
+        message = self._anthropic_reply(model, "", (usage[0], 1))
+        message.update(content=[], stop_reason=None)
+        self._send_event("message_start", {"type": "message_start", "message": message})
+        text_block = {"type": "text", "text": ""}
+        block = {"type": "content_block_start", "index": 0, "content_block": text_block}
+        self._send_event("content_block_start", block)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(per_token)
+            delta = {"type": "text_delta", "text": token}
+            self._send_event(
+                "content_block_delta", {"type": "content_block_delta", "index": 0, "delta": delta}
+            )
+        self._send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self._send_event(
+            "message_delta",
+            {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": usage[1]},
+            },
+        )
+        self._send_event("message_stop", {"type": "message_stop"})
+
+    # Errors and framing
+
+    def _send_error(self, api, status):
+        message = f"Stub failure {status}"
+        headers = {}
+        if status == 429:
+            headers["Retry-After"] = f"{self.server.config.retry_after:g}"
+        if api == "anthropic":
+            kind = {429: "rate_limit_error", 529: "overloaded_error"}.get(status, "api_error")
+            payload = {"type": "error", "error": {"type": kind, "message": message}}
+        elif api == "ollama":
+            payload = {"error": message}
+        else:
+            kind = "rate_limit_exceeded" if status == 429 else "server_error"
+            payload = {"error": {"message": message, "type": kind, "code": kind}}
+        self._send_json(status, payload, headers)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_event(self, event, data):
+        payload = data if isinstance(data, str) else json.dumps(data)
+        self._send_chunk((f"event: {event}\n" if event else "") + f"data: {payload}\n\n")
+
+    def _send_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading a stream (cancelled, timed out) are expected
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def make_server(host, port, config):
+    """A threaded stand-in server (call serve_forever to run it)."""
+    server = _Server((host, port), _Handler)
+    server.config = config
+    return server
@@ -1,3 +1,1316 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import requests
+from agents.rate_limit import RateLimitExceeded
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from utils.metrics import MetricsStore
+
+from . import faq_index as faq_index_module
+from .archive import compress_rows
+from .async_utils import _agenerate_response, aget_llm_response
+from .checks import check_shared_caches
+from .conversation import (
+    ANONYMOUS_USER,
+    SummaryRefresher,
+    conversation_context,
+    recent_turns,
+    refresh_summary,
+)
+from .deadline import Deadline, DeadlineExceeded, http_timeout
+from .embeddings import VectorIndex
+from .faq_index import FAQIndex, get_faq_version
+from .history_writer import HistoryWriter
+from .knowledge import KnowledgeStore, split_markdown
+from .models import FAQ, ChatArchive, ChatHistory, FAQVersion
+from .providers import (
+    Backend,
+    BackendError,
+    NoBackendConfigured,
+    ProviderRouter,
+    provider_router,
+)
+from .response_cache import LRUCache, response_cache
+from .singleflight import AsyncSingleFlight, SingleFlight, SingleFlightTimeout
+from .stub_llm import StubConfig, make_server, parse_failures, parse_latency
+from .utils import (
+    TIMEOUT_MESSAGE,
+    LLMResponse,
+    _cache_key,
+    _generate_response,
+    answer_query,
+    get_llm_response,
+    stream_llm_response,
+)
+from .views import chat_owner
+
+
+def _user(name):
+    return get_user_model().objects.create_user(
+        username=name, email=f"{name}@example.com", password="pw"
+    )
+
+
+class ChatOwnerTests(TestCase):
+    def test_signed_in_user_owns_their_chats_whatever_the_request_says(self):
+        user = _user("alice")
+        self.assertEqual(chat_owner(user, "someone-else"), str(user.pk))
+
+    def test_anonymous_ids_cannot_collide_with_accounts(self):
+        self.assertEqual(chat_owner(AnonymousUser(), "7"), "guest:7")
+        self.assertEqual(chat_owner(AnonymousUser()), ANONYMOUS_USER)
+
+    @override_settings(CONVERSATION_CONTEXT=True)
+    def test_callers_without_an_id_share_no_conversation_context(self):
+        ChatHistory.objects.create(user_id=chat_owner(AnonymousUser()), question="q", response="a")
+        self.assertIsNone(conversation_context(chat_owner(AnonymousUser())))
+
+    @override_settings(CONVERSATION_CONTEXT=True)
+    def test_guest_ids_never_read_back_turns(self):
+        owner = chat_owner(AnonymousUser(), "bob")
+        ChatHistory.objects.create(user_id=owner, question="my order is 42", response="a")
+        with mock.patch("support_agent.conversation.summary_refresher") as refresher:
+            self.assertIsNone(conversation_context(owner))
+        refresher.schedule.assert_not_called()
+
+
+class ChatHistoryAccessTests(TestCase):
+    def setUp(self):
+        self.alice = _user("alice")
+        self.bob = _user("bob")
+        self.alice_chat = ChatHistory.objects.create(
+            user_id=str(self.alice.pk), question="q1", response="a1"
+        )
+        self.bob_chat = ChatHistory.objects.create(
+            user_id=str(self.bob.pk), question="q2", response="a2"
+        )
+        self.client = APIClient()
+
+    def test_history_requires_authentication(self):
+        for url in ("/api/history/", f"/api/history/{self.alice_chat.uuid}/"):
+            response = self.client.get(url, {"user_id": str(self.alice.pk)})
+            self.assertEqual(response.status_code, 401, url)
+
+    def test_list_is_scoped_to_the_signed_in_user(self):
+        self.client.force_authenticate(self.alice)
+        # A caller-supplied user_id is ignored
+        response = self.client.get("/api/history/", {"user_id": str(self.bob.pk)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row["uuid"] for row in response.data["results"]], [str(self.alice_chat.uuid)]
+        )
+
+    def test_detail_of_another_users_chat_is_not_found(self):
+        self.client.force_authenticate(self.alice)
+        response = self.client.get(f"/api/history/{self.bob_chat.uuid}/")
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(f"/api/history/{self.alice_chat.uuid}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["response"], "a1")
+
+
+def _archive(user_id, *questions, age=timedelta(0)):
+    """One archive segment holding questions, oldest first."""
+    now = timezone.now() - age
+    rows = [
+        {"user_id": user_id, "question": question, "response": "r", "timestamp": now}
+        for question in questions
+    ]
+    return ChatArchive.objects.create(
+        user_id=user_id,
+        first_timestamp=now,
+        last_timestamp=now,
+        row_count=len(rows),
+        data=compress_rows(rows),
+    )
+
+
+class ChatArchiveAccessTests(TestCase):
+    def setUp(self):
+        self.alice = _user("alice")
+        self.bob = _user("bob")
+        _archive(str(self.alice.pk), "alice's question")
+        self.bob_segment = _archive(str(self.bob.pk), "bob's question")
+        self.client = APIClient()
+
+    def test_archive_requires_authentication(self):
+        response = self.client.get("/api/history/archive/", {"user_id": str(self.bob.pk)})
+        self.assertEqual(response.status_code, 401)
+
+    def test_archive_is_scoped_to_the_signed_in_user(self):
+        self.client.force_authenticate(self.alice)
+        response = self.client.get("/api/history/archive/", {"user_id": str(self.bob.pk)})
+        self.assertEqual(response.status_code, 200)
+        questions = [row["question"] for row in response.data["results"]]
+        self.assertEqual(questions, ["alice's question"])
+        # Another user's segment id as cursor yields nothing
+        response = self.client.get("/api/history/archive/", {"cursor": self.bob_segment.id})
+        self.assertEqual(response.data, {"results": [], "next": None})
+
+
+class ChatArchivePagingTests(TestCase):
+    def setUp(self):
+        self.alice = _user("alice")
+        user_id = str(self.alice.pk)
+        _archive(user_id, "q1", "q2", age=timedelta(days=200))
+        _archive(user_id, "q3", "q4", "q5", "q6", "q7", age=timedelta(days=100))
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def pages(self, **params):
+        pages = []
+        cursor = None
+        while True:
+            query = {**params, **({"cursor": cursor} if cursor else {})}
+            response = self.client.get("/api/history/archive/", query)
+            self.assertEqual(response.status_code, 200)
+            pages.append([row["question"] for row in response.data["results"]])
+            cursor = response.data["next"]
+            if cursor is None:
+                return pages
+
+    def test_pages_are_capped_at_the_limit(self):
+        self.assertEqual(self.pages(limit=2), [["q7", "q6"], ["q5", "q4"], ["q3"], ["q2", "q1"]])
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=3, CHAT_HISTORY_MAX_PAGE_SIZE=4)
+    def test_default_and_maximum_page_size_match_the_live_history(self):
+        self.assertEqual(self.pages(), [["q7", "q6", "q5"], ["q4", "q3"], ["q2", "q1"]])
+        self.assertEqual(self.pages(limit=5000)[0], ["q7", "q6", "q5", "q4"])
+
+    def test_malformed_cursor_is_a_bad_request(self):
+        for cursor in ("abc", "1:x", "1:-2"):
+            response = self.client.get("/api/history/archive/", {"cursor": cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+@override_settings(FAQ_VERSION_CHECK_INTERVAL=0)
+class FAQVersionTests(TestCase):
+    def setUp(self):
+        faq_index_module._version_seen = (None, 0.0)
+        self.faq = FAQ.objects.create(question="How do I reset my password?", answer="old")
+        self.index = FAQIndex()
+
+    def answer(self):
+        return self.index.best_match("How do I reset my password?")[1]
+
+    def test_change_made_by_another_worker_is_picked_up(self):
+        self.assertEqual(self.answer(), "old")
+        # Another worker's edit reaches this one only through the database
+        with connection.cursor() as cursor:
+            cursor.execute(f"UPDATE {FAQ._meta.db_table} SET answer = 'new'")
+        FAQVersion.objects.filter(pk=1).update(version=F("version") + 1)
+        self.assertEqual(self.answer(), "new")
+
+    def test_bulk_writes_bump_the_version(self):
+        version = get_faq_version()
+        FAQ.objects.filter(pk=self.faq.pk).update(answer="updated")
+        self.assertEqual(FAQVersion.objects.get(pk=1).version, version + 1)
+        FAQ.objects.bulk_create([FAQ(question="Where is my invoice?", answer="billing")])
+        self.assertEqual(get_faq_version(), version + 2)
+        self.assertEqual(self.answer(), "updated")
+
+    def test_version_is_cached_for_the_check_interval(self):
+        self.assertEqual(self.answer(), "old")
+        with override_settings(FAQ_VERSION_CHECK_INTERVAL=60):
+            version = get_faq_version()
+            FAQVersion.objects.filter(pk=1).update(version=version + 10)
+            self.assertEqual(get_faq_version(), version)
+        self.assertEqual(get_faq_version(), version + 10)
+
+
+class SemanticFAQTests(TestCase):
+    QUESTIONS = [
+        "How do I reset my password?",
+        "Where can I download my invoice?",
+        "How do I cancel my subscription?",
+        "Which payment methods do you accept?",
+    ]
+
+    def setUp(self):
+        faq_index_module._version_seen = (None, 0.0)
+        FAQ.objects.bulk_create(
+            FAQ(question=question, answer=f"answer {n}")
+            for n, question in enumerate(self.QUESTIONS)
+        )
+
+    def test_vector_index_ranks_the_paraphrased_question_first(self):
+        for vectors in (VectorIndex.build(self.QUESTIONS), self.numpy_index()):
+            with self.subTest(faiss=vectors._index is not None):
+                position, similarity = vectors.search("subscription cancel", k=2)[0]
+                self.assertEqual(self.QUESTIONS[position], "How do I cancel my subscription?")
+                self.assertGreater(similarity, 0.5)
+
+    def numpy_index(self):
+        with mock.patch("support_agent.embeddings.faiss", None):
+            return VectorIndex.build(self.QUESTIONS)
+
+    @override_settings(FAQ_VECTOR_SEARCH=True)
+    def test_lexical_miss_is_answered_by_the_hybrid_score(self):
+        index = FAQIndex()
+        # Reordered words score below the lexical threshold on their own
+        self.assertLess(index.best_match("subscription cancel")[2], 60)
+        match = index.search("subscription cancel")
+        self.assertEqual(match[1], "answer 2")
+        self.assertEqual(index.stats()["semantic_hits"], 1)
+        self.assertIsNone(index.search("quantum chromodynamics lecture notes"))
+
+    def test_without_vector_search_the_paraphrase_misses(self):
+        self.assertIsNone(FAQIndex().search("subscription cancel"))
+
+
+
+KNOWLEDGE = """# Our Services
+
+## Pricing Plans
+The Starter plan costs 29 dollars a month and includes five seats.
+
+## Support Hours
+Support is available Monday to Friday, 9am to 6pm CET.
+
+# Security
+All data is encrypted at rest with AES-256 and backed up nightly.
+"""
+
+
+class KnowledgeRetrievalTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        (self.directory / "company.md").write_text(KNOWLEDGE)
+        self.store = KnowledgeStore(self.directory)
+
+    def test_chunks_keep_their_heading_path(self):
+        chunks = split_markdown(KNOWLEDGE, source="company.md")
+        self.assertEqual(
+            [chunk.heading for chunk in chunks],
+            ["Our Services > Pricing Plans", "Our Services > Support Hours", "Security"],
+        )
+        self.assertTrue(chunks[0].text.startswith("## Our Services > Pricing Plans\n"))
+
+    def test_only_the_relevant_chunks_go_into_the_prompt(self):
+        context = self.store.build_context("How much does the starter plan cost?")
+        self.assertIn("29 dollars", context)
+        self.assertNotIn("AES-256", context)
+        self.assertIsNone(self.store.build_context("zebra migration patterns"))
+
+    def test_token_budget_caps_the_context(self):
+        chunks = self.store.retrieve("plan support data encrypted", top_k=3, token_budget=25)
+        self.assertTrue(chunks)
+        self.assertLessEqual(sum(chunk.tokens for chunk in chunks), 25)
+        self.assertLess(len(chunks), 3)
+
+
+
+@override_settings(KNOWLEDGE_RELOAD_INTERVAL=0)
+class KnowledgeReloadTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        (self.directory / "company.md").write_text(KNOWLEDGE)
+        (self.directory / "returns.md").write_text("# Returns\nReturns are accepted for 30 days.\n")
+        self.store = KnowledgeStore(self.directory)
+        self.store.ensure_loaded()
+
+    def edit(self, name, text):
+        path = self.directory / name
+        path.write_text(text)
+        # Make the change visible even on filesystems with coarse mtimes
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    def test_edit_is_served_on_the_next_lookup(self):
+        self.edit("returns.md", "# Returns\nReturns are accepted for 60 days.\n")
+        self.assertIn("60 days", self.store.build_context("how many days to return"))
+
+    def test_only_changed_chunks_are_retokenized(self):
+        self.edit("company.md", KNOWLEDGE.replace("29 dollars", "39 dollars"))
+        stats = self.store.refresh()
+        self.assertEqual(stats["files_changed"], 1)
+        self.assertEqual(stats["chunks_tokenized"], 1)
+        self.assertTrue(stats["swapped"])
+
+    def test_touched_but_unchanged_files_keep_the_snapshot(self):
+        version = self.store.version
+        self.edit("company.md", KNOWLEDGE)
+        stats = self.store.refresh()
+        self.assertFalse(stats["swapped"])
+        self.assertEqual(self.store.version, version)
+
+    def test_removed_files_leave_the_index(self):
+        (self.directory / "returns.md").unlink()
+        stats = self.store.refresh()
+        self.assertEqual(stats["files_removed"], 1)
+        self.assertIsNone(self.store.build_context("how many days to return"))
+
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        faq_index_module._version_seen = (None, 0.0)
+        response_cache.clear()
+        self.addCleanup(response_cache.clear)
+        patcher = mock.patch(
+            "support_agent.utils._generate_response", return_value=("generated", True)
+        )
+        self.generate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_equivalent_questions_share_one_answer(self):
+        first = get_llm_response("Where is my order?", "FAQ answer")
+        second = get_llm_response("  where IS my order ", "FAQ answer")
+        self.assertFalse(first.cache_hit)
+        self.assertTrue(second.cache_hit)
+        self.assertEqual(second.text, "generated")
+        self.assertEqual(self.generate.call_count, 1)
+
+    def test_an_faq_change_invalidates_the_cached_answer(self):
+        get_llm_response("Where is my order?", "FAQ answer")
+        FAQ.objects.create(question="Where is my parcel?", answer="tracking")
+        self.assertFalse(get_llm_response("Where is my order?", "FAQ answer").cache_hit)
+        self.assertEqual(self.generate.call_count, 2)
+
+    def test_fallback_answers_are_not_cached(self):
+        self.generate.return_value = (TIMEOUT_MESSAGE, False)
+        self.assertTrue(get_llm_response("Where is my order?", "FAQ answer").degraded)
+        self.assertFalse(get_llm_response("Where is my order?", "FAQ answer").cache_hit)
+
+    @override_settings(LLM_CACHE_BACKEND="off")
+    def test_disabled_cache_always_generates(self):
+        get_llm_response("Where is my order?", "FAQ answer")
+        get_llm_response("Where is my order?", "FAQ answer")
+        self.assertEqual(self.generate.call_count, 2)
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_entries=2, ttl=None)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+
+    def test_expired_entries_are_not_served(self):
+        cache = LRUCache(ttl=60)
+        cache.set("a", 1)
+        with mock.patch("support_agent.response_cache.time.monotonic", return_value=1e12):
+            self.assertIsNone(cache.get("a"))
+
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, fn, callers=5, timeout=5):
+        results = []
+
+        def caller():
+            try:
+                results.append(flight.do("key", fn, timeout=timeout))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=caller) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return "answer"
+
+        threads, results = self.run_concurrently(flight, fn)
+        while flight.stats()["coalesced"] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False] + [True] * 4)
+        self.assertEqual({answer for answer, _ in results}, {"answer"})
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_the_leaders_error_reaches_every_waiter(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fn():
+            release.wait(5)
+            raise ValueError("provider down")
+
+        threads, results = self.run_concurrently(flight, fn, callers=3)
+        while flight.stats()["coalesced"] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([type(result) for result in results], [ValueError] * 3)
+
+    def test_waiters_give_up_after_the_timeout(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        threads, results = self.run_concurrently(flight, lambda: release.wait(5), callers=1)
+        while not flight.in_flight():
+            time.sleep(0.01)
+        with self.assertRaises(SingleFlightTimeout):
+            flight.do("key", lambda: "never run", timeout=0.05)
+        release.set()
+        threads[0].join()
+        self.assertEqual(results, [(True, False)])
+
+    def test_async_callers_share_one_call(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        async def run():
+            return await asyncio.gather(*(flight.do("key", fn) for _ in range(5)))
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([shared for _, shared in results].count(False), 1)
+
+
+
+def _sse_events(response):
+    events = []
+    for block in b"".join(response.streaming_content).decode().strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event[len("event: ") :], json.loads(data[len("data: ") :])))
+    return events
+
+
+class StreamEndpointTests(TestCase):
+    def post(self, query="Where is my order?"):
+        return APIClient().post(
+            "/api/ask/stream/", {"query": query, "user_id": "7"}, format="json"
+        )
+
+    @mock.patch("support_agent.views.stream_llm_response", return_value=iter(["Hel", "lo "]))
+    def test_tokens_are_streamed_then_the_saved_chat(self, stream):
+        response = self.post()
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        events = _sse_events(response)
+        self.assertEqual(events[:2], [("token", {"text": "Hel"}), ("token", {"text": "lo "})])
+        self.assertEqual(events[2][0], "done")
+        self.assertEqual(events[2][1]["response"], "Hello")
+        chat = ChatHistory.objects.get()
+        self.assertEqual((chat.user_id, chat.response), ("guest:7", "Hello"))
+
+    def test_cached_answers_are_sent_in_one_piece(self):
+        response_cache.clear()
+        self.addCleanup(response_cache.clear)
+        response_cache.set(_cache_key("Where is my order?"), "It has shipped.")
+        with mock.patch("support_agent.views.search_faq", return_value=None):
+            events = _sse_events(self.post())
+        self.assertEqual(events[0], ("token", {"text": "It has shipped."}))
+        self.assertEqual(len(events), 2)
+
+
+
+@mock.patch(
+    "support_agent.views.aanswer_query", mock.AsyncMock(return_value=LLMResponse("answer"))
+)
+class AsyncEndpointAuthTests(TestCase):
+    def setUp(self):
+        self.user = _user("alice")
+
+    def post(self, client=None, **headers):
+        client = client or Client()
+        return client.post(
+            "/api/ask/async/",
+            {"query": "Where is my order?", "user_id": "7"},
+            content_type="application/json",
+            **headers,
+        )
+
+    def test_jwt_users_own_their_chats(self):
+        token = AccessToken.for_user(self.user)
+        response = self.post(HTTP_AUTHORIZATION=f"Bearer {token}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["user_id"], str(self.user.pk))
+        api = APIClient()
+        api.force_authenticate(self.user)
+        self.assertEqual(len(api.get("/api/history/").data["results"]), 1)
+
+    def test_session_cookies_do_not_authenticate(self):
+        client = Client()
+        client.force_login(self.user)
+        self.assertEqual(self.post(client).json()["user_id"], "guest:7")
+
+    def test_invalid_token_is_rejected(self):
+        response = self.post(HTTP_AUTHORIZATION="Bearer not-a-token")
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(ChatHistory.objects.exists())
+
+    def test_cross_site_posts_need_a_csrf_token(self):
+        response = self.post(Client(enforce_csrf_checks=True))
+        self.assertEqual(response.status_code, 403)
+
+
+
+class AsyncPipelineTests(TestCase):
+    def setUp(self):
+        faq_index_module._version_seen = (None, 0.0)
+        response_cache.clear()
+        self.addCleanup(response_cache.clear)
+        self.threads = {}
+
+    def recording(self, name, result):
+        def fn(*args, **kwargs):
+            self.threads[name] = threading.get_ident()
+            return result
+
+        return fn
+
+    async def test_blocking_steps_run_off_the_event_loop(self):
+        generate = mock.AsyncMock(return_value=("answer", True))
+        with mock.patch(
+            "support_agent.async_utils._cache_key", self.recording("key", "key")
+        ), mock.patch("support_agent.async_utils._agenerate_response", generate):
+            response = await aget_llm_response("Where is my order?", "FAQ answer")
+        self.assertEqual(response.text, "answer")
+        self.assertNotEqual(self.threads["key"], threading.get_ident())
+
+        with mock.patch(
+            "support_agent.async_utils.build_prompt_with_estimate",
+            self.recording("prompt", ("prompt", 10)),
+        ), mock.patch.object(
+            provider_router, "acomplete", mock.AsyncMock(side_effect=NoBackendConfigured())
+        ):
+            await _agenerate_response("Where is my order?")
+        self.assertNotEqual(self.threads["prompt"], threading.get_ident())
+
+    async def test_faq_index_is_built_off_the_event_loop(self):
+        await FAQ.objects.acreate(question="How do I reset my password?", answer="reset")
+        index = FAQIndex()
+        install = index._install
+
+        def recording_install(rows, version):
+            self.threads["install"] = threading.get_ident()
+            install(rows, version)
+
+        with mock.patch.object(index, "_install", recording_install):
+            await index.aensure_loaded()
+        self.assertEqual(len(index), 1)
+        self.assertNotEqual(self.threads["install"], threading.get_ident())
+
+    @override_settings(LLM_CACHE_BACKEND="django", SUPPORT_SINGLEFLIGHT_SHARED=True)
+    async def test_waits_for_another_workers_in_flight_answer(self):
+        response_cache._backend = None
+        self.addCleanup(setattr, response_cache, "_backend", None)
+        cache = caches["default"]
+        self.addCleanup(cache.clear)
+        cache.add("key:inflight", 1, timeout=30)
+
+        def other_worker():
+            time.sleep(0.1)
+            response_cache.set("key", "their answer")
+            cache.delete("key:inflight")
+
+        generate = mock.AsyncMock(return_value=("mine", True))
+        with mock.patch("support_agent.async_utils._cache_key", return_value="key"), mock.patch(
+            "support_agent.async_utils._agenerate_response", generate
+        ):
+            threading.Thread(target=other_worker).start()
+            response = await aget_llm_response("Where is my order?", "FAQ answer")
+        self.assertEqual((response.text, response.coalesced), ("their answer", True))
+        generate.assert_not_called()
+
+
+
+class BatchEndpointTests(TestCase):
+    def setUp(self):
+        faq_index_module._version_seen = (None, 0.0)
+        FAQ.objects.create(question="How do I reset my password?", answer="reset")
+        patcher = mock.patch(
+            "support_agent.utils.get_llm_response",
+            side_effect=lambda query, faq_answer: LLMResponse(f"answer to {query}"),
+        )
+        self.get_llm_response = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def post(self, items, **data):
+        return self.client.post("/api/ask/batch/", {"items": items, **data}, format="json")
+
+    def test_repeated_questions_cost_one_llm_call(self):
+        items = [
+            {"user_id": "1", "query": "Where is my order?"},
+            {"user_id": "2", "query": "where is my order"},
+            {"user_id": "3", "query": "How do I reset my password?"},
+        ]
+        response = self.post(items, concurrency=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_llm_response.call_count, 2)
+        self.assertEqual(
+            [row["user_id"] for row in response.data], ["guest:1", "guest:2", "guest:3"]
+        )
+        self.assertEqual(response.data[1]["response"], "answer to Where is my order?")
+        faq_answers = {call.args[1] for call in self.get_llm_response.call_args_list}
+        self.assertEqual(faq_answers, {None, "reset"})
+        self.assertEqual(ChatHistory.objects.count(), 3)
+
+    def test_malformed_batches_are_rejected(self):
+        self.assertEqual(self.post("not a list").status_code, 400)
+        self.assertEqual(self.post(["not an object"]).status_code, 400)
+        with override_settings(SUPPORT_BATCH_MAX_ITEMS=2):
+            self.assertEqual(self.post([{"query": "q"}] * 3).status_code, 400)
+        self.get_llm_response.assert_not_called()
+
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = _user("alice")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        now = timezone.now()
+        # Several rows share a timestamp, so ties must be broken by id
+        self.chats = [
+            ChatHistory.objects.create(
+                user_id=str(self.user.pk),
+                question=f"q{n}",
+                response="a",
+                timestamp=now - timedelta(minutes=n // 3),
+            )
+            for n in range(8)
+        ]
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+            response = self.client.get("/api/history/", params)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data["results"]), 3)
+            seen += [row["question"] for row in response.data["results"]]
+            cursor = response.data["next"]
+            if cursor is None:
+                break
+        expected = sorted(self.chats, key=lambda chat: (chat.timestamp, chat.id), reverse=True)
+        self.assertEqual(seen, [chat.question for chat in expected])
+
+    def test_rows_added_meanwhile_do_not_shift_later_pages(self):
+        first = self.client.get("/api/history/", {"limit": 4}).data
+        ChatHistory.objects.create(user_id=str(self.user.pk), question="new", response="a")
+        second = self.client.get("/api/history/", {"limit": 4, "cursor": first["next"]}).data
+        questions = [row["question"] for row in first["results"] + second["results"]]
+        self.assertNotIn("new", questions)
+        self.assertEqual(len(set(questions)), 8)
+
+    def test_invalid_cursor_is_a_bad_request(self):
+        response = self.client.get("/api/history/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+
+class FAQIndexTests(TestCase):
+    def setUp(self):
+        faq_index_module._version_seen = (None, 0.0)
+        FAQ.objects.bulk_create(
+            [FAQ(question=f"How do I configure feature {n}?", answer=f"a{n}") for n in range(40)]
+            + [
+                FAQ(question="How do I reset my password?", answer="password"),
+                FAQ(question="Where can I download my invoice?", answer="invoice"),
+            ]
+        )
+        self.index = FAQIndex(candidate_limit=5)
+
+    def test_search_only_answers_above_the_threshold(self):
+        self.assertEqual(self.index.search("How do I reset my password")[1], "password")
+        self.assertIsNone(self.index.search("Do you ship to the moon?"))
+
+    @override_settings(FAQ_VERSION_CHECK_INTERVAL=60)
+    def test_counters_add_up_under_concurrent_lookups(self):
+        self.index.ensure_loaded()
+
+        def worker():
+            for _ in range(200):
+                self.index.search("How do I reset my password")
+                self.index.search("Do you ship to the moon?")
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.index.stats()
+        self.assertEqual(stats["lookups"], 3200)
+        self.assertEqual((stats["hits"], stats["misses"]), (1600, 1600))
+        self.assertEqual(stats["rebuilds"], 1)
+
+
+    def test_prefiltered_match_agrees_with_scoring_every_question(self):
+        for query in ("how do i reset my pasword", "download invoice", "configure feature 17"):
+            with self.subTest(query):
+                self.assertEqual(
+                    self.index.best_match(query), self.index.best_match(query, limit=0)
+                )
+        self.assertGreater(self.index.stats()["prefiltered"], 0)
+
+    def test_recall_report_counts_matches_the_prefilter_missed(self):
+        report = self.index.measure_recall(
+            ["how do i reset my pasword", "configure feature 9", "quantum physics"], limit=5
+        )
+        self.assertEqual(report["queries"], 2)
+        self.assertEqual(report["recall"], 1.0)
+        self.assertEqual(report["missed"], [])
+
+    def test_faq_recall_command_reports_recall(self):
+        out = StringIO()
+        call_command("faq_recall", "--sample", "10", stdout=out)
+        self.assertIn("Matched queries: 0", out.getvalue())
+        ChatHistory.objects.create(user_id="1", question="how do i reset my pasword", response="r")
+        out = StringIO()
+        call_command("faq_recall", "--sample", "10", "--limit", "5", stdout=out)
+        self.assertIn("Matched queries: 1, recalled: 1, recall: 100.00%", out.getvalue())
+
+    def test_batch_search_matches_one_by_one_search(self):
+        queries = ["Where can I download my invoice", "quantum physics", "configure feature 3"]
+        expected = [self.index.search(query) for query in queries]
+        results = self.index.search_many(queries)
+        self.assertEqual([r and r[1] for r in results], [e and e[1] for e in expected])
+
+
+@override_settings(
+    CONVERSATION_CONTEXT=True,
+    CONVERSATION_MAX_TURNS=2,
+    CONVERSATION_SUMMARY_EVERY=2,
+    CONVERSATION_SUMMARY_MAX_FOLD=4,
+)
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        start = timezone.now() - timedelta(hours=1)
+        for i in range(10):
+            ChatHistory.objects.create(
+                user_id="7",
+                question=f"q{i}",
+                response=f"a{i}",
+                timestamp=start + timedelta(minutes=i),
+            )
+
+    @staticmethod
+    def fake_summarize(summary, turns, budget=None):
+        return " ".join(filter(None, [summary] + [turn["question"] for turn in turns]))
+
+    def test_turns_are_folded_oldest_first_and_the_rest_carried_over(self):
+        window = recent_turns("7")
+        self.assertEqual([turn["question"] for turn in window], ["q8", "q9"])
+        with mock.patch("support_agent.conversation.summarize", self.fake_summarize):
+            self.assertEqual(refresh_summary("7", window), "q0 q1 q2 q3")
+            self.assertEqual(refresh_summary("7", window), "q0 q1 q2 q3 q4 q5 q6 q7")
+            # Nothing pending any more
+            self.assertEqual(refresh_summary("7", window), "q0 q1 q2 q3 q4 q5 q6 q7")
+
+    def test_request_path_never_summarizes(self):
+        with mock.patch("support_agent.conversation.summarize") as summarize, mock.patch(
+            "support_agent.conversation.summary_refresher"
+        ) as refresher:
+            context = conversation_context("7")
+        summarize.assert_not_called()
+        refresher.schedule.assert_called_once()
+        self.assertIn("Customer: q9", context)
+
+    def test_one_pending_refresh_per_user(self):
+        release = threading.Event()
+        refresher = SummaryRefresher(max_workers=1)
+        with mock.patch(
+            "support_agent.conversation.refresh_summary", side_effect=lambda *args: release.wait(5)
+        ):
+            self.assertTrue(refresher.schedule("7", []))
+            self.assertFalse(refresher.schedule("7", []))
+            release.set()
+            refresher.executor.shutdown(wait=True)
+        # Once it has run the user can be scheduled again
+        self.assertNotIn("7", refresher._pending)
+
+
+class _RecordingBackend(Backend):
+    name = "recording"
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def complete(self, prompt, system_prompt, timeout, max_tokens=300):
+        self.calls += 1
+        return "answer", None
+
+
+def _expired_deadline():
+    deadline = Deadline(0.001)
+    time.sleep(0.002)
+    return deadline
+
+
+@override_settings(LLM_HTTP_TIMEOUT=60, LLM_CONNECT_TIMEOUT=3, METRICS_ENABLED=False)
+class DeadlineTests(TestCase):
+    def test_http_timeout_is_capped_by_the_time_left(self):
+        self.assertEqual(http_timeout(), (3, 60))
+        connect, read = http_timeout(Deadline(1))
+        self.assertLessEqual(read, 1)
+        self.assertGreater(read, 0)
+        self.assertEqual(connect, read)
+
+    def test_an_expired_deadline_never_yields_a_zero_timeout(self):
+        with self.assertRaises(DeadlineExceeded):
+            http_timeout(_expired_deadline())
+
+    def test_expired_deadline_is_not_a_backend_failure(self):
+        router = ProviderRouter()
+        backend = _RecordingBackend()
+        router._backends = [backend]
+        with self.assertRaises(requests.Timeout):
+            router.complete("prompt", "system", _expired_deadline())
+        self.assertEqual(backend.calls, 0)
+        self.assertEqual(backend.breaker.failures, 0)
+
+    def test_expired_deadline_answers_with_the_fallback(self):
+        self.assertEqual(
+            _generate_response("q", "FAQ answer", deadline=_expired_deadline()),
+            ("FAQ answer", False),
+        )
+        self.assertEqual(
+            _generate_response("q", deadline=_expired_deadline()), (TIMEOUT_MESSAGE, False)
+        )
+
+    @override_settings(CONVERSATION_CONTEXT=True)
+    def test_context_lookup_counts_against_the_deadline(self):
+        ChatHistory.objects.create(user_id="7", question="q", response="a")
+        self.assertIsNone(conversation_context("7", _expired_deadline()))
+        deadline = _expired_deadline()
+        with mock.patch("support_agent.utils.conversation_context") as context, mock.patch(
+            "support_agent.utils.get_llm_response"
+        ):
+            context.return_value = None
+            answer_query("q", "7", deadline)
+        context.assert_called_once_with("7", deadline)
+
+
+
+class MetricsStoreTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "metrics.sqlite3")
+
+    def store(self, retire_after=600.0, flush_interval=3600):
+        store = MetricsStore(self.path, flush_interval=flush_interval, retire_after=retire_after)
+        self.addCleanup(store._stopped.set)
+        self.addCleanup(lambda: store._connection().close())
+        return store
+
+    def total(self, store):
+        return store.collect().get(("calls", '[["provider", "x"]]', ""), 0)
+
+    def test_processes_never_overwrite_each_other(self):
+        # Same pid, as after pid reuse, but separate processes
+        first, second = self.store(), self.store()
+        first.inc("calls", {"provider": "x"}, 3)
+        first.flush()
+        second.inc("calls", {"provider": "x"}, 2)
+        second.flush()
+        self.assertEqual(self.total(second), 5)
+
+    def test_exited_processes_are_folded_into_the_retired_total(self):
+        for _ in range(3):
+            store = self.store()
+            store.inc("calls", {"provider": "x"})
+            store.close()
+        reader = self.store()
+        self.assertEqual(self.total(reader), 3)
+        connection = reader._connection()
+        processes = connection.execute("SELECT DISTINCT process FROM metric_samples").fetchall()
+        self.assertEqual(processes, [("retired",)])
+        self.assertEqual(connection.execute("SELECT * FROM metric_processes").fetchall(), [])
+
+    def test_a_retired_process_that_is_still_alive_is_not_double_counted(self):
+        idle = self.store(retire_after=0)
+        idle.inc("calls", {"provider": "x"}, 4)
+        idle.flush()
+        # Looks stale to the next retirement
+        self.assertEqual(self.store(retire_after=0).retire(), 1)
+        self.assertEqual(self.total(idle), 4)
+        idle.inc("calls", {"provider": "x"})
+        idle.flush()
+        self.assertEqual(self.total(self.store()), 5)
+        self.assertEqual(self.total(self.store()), 5)
+
+    def test_values_are_flushed_by_a_background_thread(self):
+        store = self.store(flush_interval=0.2)
+        reader = self.store()
+        store.inc("calls", {"provider": "x"}, 3)
+        store.observe("latency", {"provider": "x"}, 0.1)
+        # Recording never writes the file itself
+        self.assertEqual(self.total(reader), 0)
+        waited = 0.0
+        while self.total(reader) != 3 and waited < 5:
+            time.sleep(0.05)
+            waited += 0.05
+        self.assertEqual(self.total(reader), 3)
+        # Scrapes only read
+        with mock.patch.object(reader, "_transaction") as transaction:
+            reader.render()
+        transaction.assert_not_called()
+
+
+@mock.patch("support_agent.views.render_metrics", return_value="llm_requests_total 1\n")
+class MetricsEndpointTests(TestCase):
+    @override_settings(METRICS_ENABLED=True, METRICS_TOKEN="")
+    def test_endpoint_is_off_without_a_token(self, render_metrics):
+        self.assertEqual(Client().get("/metrics").status_code, 404)
+        render_metrics.assert_not_called()
+
+    @override_settings(METRICS_ENABLED=True, METRICS_TOKEN="s3cret")
+    def test_scrapers_must_send_the_token(self, render_metrics):
+        for headers in ({}, {"Authorization": "Bearer wrong"}, {"Authorization": "s3cre"}):
+            response = Client().get("/metrics", headers=headers)
+            self.assertEqual(response.status_code, 401, headers)
+        render_metrics.assert_not_called()
+
+        response = Client().get("/metrics", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"llm_requests_total 1\n")
+
+
+class _FailingBackend(_RecordingBackend):
+    name = "failing"
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    def complete(self, prompt, system_prompt, timeout, max_tokens=300):
+        self.calls += 1
+        raise self.error
+
+
+@override_settings(METRICS_ENABLED=False)
+class ProviderStreamTests(TestCase):
+    def setUp(self):
+        self.failing = _FailingBackend(BackendError("down"))
+        self.healthy = _RecordingBackend()
+        self.router = ProviderRouter()
+        self.router._backends = [self.failing, self.healthy]
+
+    def test_stream_fails_over_before_the_first_delta(self):
+        streamed = list(self.router.stream("prompt", "system"))
+        self.assertEqual(streamed, [(self.healthy, "answer")])
+        self.assertEqual(self.failing.breaker.failures, 1)
+        self.assertEqual(self.router.failovers, 1)
+
+    def test_streamed_answer_is_cached_under_the_backend_that_gave_it(self):
+        with mock.patch.object(provider_router, "_backends", self.router._backends), mock.patch(
+            "support_agent.utils.search_faq", return_value=None
+        ):
+            response_cache.clear()
+            self.addCleanup(response_cache.clear)
+            self.assertEqual(list(stream_llm_response("where is my order?", "FAQ")), ["answer"])
+            self.assertIsNone(response_cache.get(_cache_key("where is my order?", "FAQ")))
+            key = _cache_key("where is my order?", "FAQ", backend=self.healthy)
+            self.assertEqual(response_cache.get(key), "answer")
+
+    def test_local_throttling_is_not_a_backend_failure(self):
+        throttled = _FailingBackend(RateLimitExceeded("claude", 1.0))
+        router = ProviderRouter()
+        router._backends = [throttled, self.healthy]
+        for _ in range(10):
+            self.assertEqual(router.complete("prompt", "system")[0], "answer")
+            self.assertEqual(list(router.stream("prompt", "system"))[0][1], "answer")
+        self.assertEqual(throttled.breaker.failures, 0)
+        self.assertEqual(throttled.breaker.state, "closed")
+
+
+class _SlowBackend(_RecordingBackend):
+    name = "slow"
+
+    def __init__(self, delay=None):
+        super().__init__()
+        self.delay = delay
+        self.release = threading.Event()
+
+    def complete(self, prompt, system_prompt, timeout, max_tokens=300):
+        self.calls += 1
+        self.release.wait(self.delay)
+        return "slow answer", None
+
+    async def acomplete(self, prompt, system_prompt, timeout, max_tokens=300):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return "slow answer", None
+
+
+def _half_open(backend):
+    backend.breaker.failures = backend.breaker.failure_threshold
+    backend.breaker.opened_at = time.monotonic() - backend.breaker.reset_timeout
+    return backend
+
+
+@override_settings(METRICS_ENABLED=False, LLM_HEDGE=True, LLM_HEDGE_DELAY=0.05)
+class ProviderCancelTests(TestCase):
+    async def test_cancelled_hedge_loser_hands_back_its_trial(self):
+        trial = _half_open(_SlowBackend(delay=5))
+        router = ProviderRouter()
+        router._backends = [trial, _RecordingBackend()]
+        text, _, backend = await router.acomplete("prompt", "system")
+        self.assertEqual(text, "answer")
+        self.assertIsNot(backend, trial)
+        # Let the cancelled loser unwind
+        await asyncio.sleep(0.01)
+        self.assertEqual(trial.breaker.state, "half_open")
+
+        trial.delay = 0
+        router._backends = [trial]
+        self.assertEqual((await router.acomplete("prompt", "system"))[0], "slow answer")
+        self.assertEqual(trial.calls, 2)
+        self.assertEqual(trial.breaker.state, "closed")
+
+    def test_queued_trial_cancelled_at_the_deadline_is_handed_back(self):
+        busy = _SlowBackend()
+        trial = _half_open(_RecordingBackend())
+        router = ProviderRouter()
+        router._backends = [busy, trial]
+        # One worker: the hedged trial stays queued behind the busy backend
+        router._executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(router._executor.shutdown)
+        self.addCleanup(busy.release.set)
+        with self.assertRaises(requests.Timeout):
+            router.complete("prompt", "system", Deadline(0.2))
+        self.assertEqual(trial.calls, 0)
+        self.assertTrue(trial.breaker.allow())
+
+    @override_settings(LLM_HEDGE_MAX_ABANDONED=1)
+    def test_hedging_pauses_while_abandoned_losers_hold_workers(self):
+        slow, fast = _SlowBackend(), _RecordingBackend()
+        router = ProviderRouter()
+        router._backends = [slow, fast]
+        self.addCleanup(router.executor.shutdown)
+        self.addCleanup(slow.release.set)
+
+        self.assertEqual(router.complete("prompt", "system")[0], "answer")
+        self.assertEqual(router.abandoned, 1)
+        # The loser is still running, so this request waits on the slow backend alone
+        with self.assertRaises(requests.Timeout):
+            router.complete("prompt", "system", Deadline(0.3))
+        self.assertEqual(fast.calls, 1)
+
+        slow.release.set()
+        router.executor.shutdown(wait=True)
+        self.assertEqual(router.abandoned, 0)
+        self.assertTrue(router.can_hedge())
+
+
+def _entry(question, user_id="7"):
+    return ChatHistory(
+        uuid=uuid.uuid4(),
+        user_id=user_id,
+        question=question,
+        response="r",
+        timestamp=timezone.now(),
+    )
+
+
+@override_settings(CHAT_HISTORY_WRITE_ATTEMPTS=2)
+@mock.patch("support_agent.history_writer.close_old_connections")
+class HistoryWriterTests(TestCase):
+    def test_one_bad_row_does_not_lose_the_batch(self, close_old_connections):
+        writer = HistoryWriter(flush_size=10)
+        bad = _entry(None)  # question is NOT NULL
+        for entry in (_entry("q1"), bad, _entry("q2")):
+            writer._queue.put(entry)
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(
+            sorted(ChatHistory.objects.values_list("question", flat=True)), ["q1", "q2"]
+        )
+        # Tried again on the next flush, then dropped
+        self.assertEqual(writer.pending(), 1)
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(writer.stats()["retried"], 1)
+        self.assertEqual(writer.stats()["failed"], 1)
+
+    def test_rows_survive_a_transient_database_error(self, close_old_connections):
+        writer = HistoryWriter(flush_size=10)
+        entries = [_entry(f"q{i}") for i in range(3)]
+        for entry in entries:
+            writer._queue.put(entry)
+        error = OperationalError("database is locked")
+        with mock.patch.object(ChatHistory.objects, "bulk_create", side_effect=error):
+            with mock.patch.object(ChatHistory, "save", side_effect=error):
+                self.assertEqual(writer.flush(), 0)
+        self.assertEqual(writer.pending(), 3)
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(
+            set(ChatHistory.objects.values_list("uuid", flat=True)), {e.uuid for e in entries}
+        )
+        self.assertEqual(writer.stats()["failed"], 0)
+
+
+LOCAL_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+SHARED_CACHE = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "cache_table",
+    }
+}
+
+
+class SharedCacheCheckTests(SimpleTestCase):
+    def ids(self):
+        return [message.id for message in check_shared_caches(None)]
+
+    @override_settings(
+        CACHES=LOCAL_CACHE, LLM_CACHE_BACKEND="memory", AGENT_RATE_LIMIT_STORE="sqlite"
+    )
+    def test_process_local_features_need_no_shared_cache(self):
+        self.assertEqual(self.ids(), [])
+
+    @override_settings(
+        CACHES=LOCAL_CACHE,
+        LLM_CACHE_BACKEND="django",
+        SUPPORT_SINGLEFLIGHT_SHARED=True,
+        AGENT_RATE_LIMIT_STORE="django",
+    )
+    def test_shared_features_on_a_local_memory_cache_are_flagged(self):
+        self.assertEqual(
+            self.ids(), ["support_agent.W001", "support_agent.W002", "support_agent.W003"]
+        )
+
+    @override_settings(
+        CACHES=SHARED_CACHE,
+        LLM_CACHE_BACKEND="django",
+        SUPPORT_SINGLEFLIGHT_SHARED=True,
+        AGENT_RATE_LIMIT_STORE="django",
+    )
+    def test_shared_cache_passes(self):
+        self.assertEqual(self.ids(), [])
+
+
+class StubLLMTests(SimpleTestCase):
+    """The load-testing stand-in, over HTTP in each API's wire format."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        config = StubConfig(
+            latency="fixed:0", token_latency="fixed:0", reply_tokens=8, retry_after=2, hang=1
+        )
+        cls.server = make_server("127.0.0.1", 0, config)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def post(self, path, body, timeout=5, stream=False):
+        return requests.post(f"{self.url}{path}", json=body, timeout=timeout, stream=stream)
+
+    def openai(self, prompt, timeout=5, **body):
+        messages = [{"role": "user", "content": prompt}]
+        return self.post(
+            "/v1/chat/completions",
+            {"model": "gpt-4", "messages": messages, **body},
+            timeout,
+            stream=body.get("stream", False),
+        )
+
+    def test_replies_are_deterministic_in_each_api_format(self):
+        text = self.openai("where is my order?").json()["choices"][0]["message"]["content"]
+        self.assertEqual(
+            self.openai("where is my order?").json()["choices"][0]["message"]["content"], text
+        )
+        self.assertNotEqual(
+            self.openai("reset my password").json()["choices"][0]["message"]["content"], text
+        )
+        ollama = self.post("/api/generate", {"prompt": "where is my order?", "stream": False})
+        self.assertEqual(ollama.json()["response"], text)
+        self.assertEqual(ollama.json()["eval_count"], 8)
+        anthropic = self.post(
+            "/v1/messages", {"messages": [{"role": "user", "content": "where is my order?"}]}
+        )
+        self.assertEqual(anthropic.json()["content"][0]["text"], text)
+        self.assertEqual(anthropic.json()["usage"]["output_tokens"], 8)
+
+    def test_max_tokens_caps_the_reply(self):
+        usage = self.openai("hello", max_tokens=3).json()["usage"]
+        self.assertEqual(usage["completion_tokens"], 3)
+
+    def test_streams_token_by_token(self):
+        with self.post("/api/generate", {"prompt": "hello"}, stream=True) as response:
+            chunks = [json.loads(line) for line in response.iter_lines() if line]
+        self.assertEqual(len(chunks), 9)
+        self.assertTrue(chunks[-1]["done"])
+        text = "".join(chunk["response"] for chunk in chunks)
+
+        with self.openai("hello", stream=True) as response:
+            events = [line for line in response.iter_lines(decode_unicode=True) if line]
+        self.assertEqual(events[-1], "data: [DONE]")
+        deltas = [
+            json.loads(event[len("data: "):])["choices"][0]["delta"].get("content", "")
+            for event in events[:-1]
+        ]
+        self.assertEqual("".join(deltas), text)
+
+    def test_prompts_can_force_each_failure(self):
+        response = self.openai("hello [stub:429]")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "2")
+        response = self.post(
+            "/v1/messages", {"messages": [{"role": "user", "content": "hi [stub:529]"}]}
+        )
+        self.assertEqual(response.status_code, 529)
+        self.assertEqual(response.json()["error"]["type"], "overloaded_error")
+        self.assertEqual(self.openai("hello [stub:500]").status_code, 500)
+        with self.assertRaises(requests.Timeout):
+            self.openai("hello [stub:timeout]", timeout=0.2)
+
+    def test_latency_and_failures_are_drawn_per_request(self):
+        failure, first, _ = StubConfig(latency="fixed:250", failures="500:1").plan("hi")
+        self.assertEqual((failure, first), (500, 0.25))
+        config = StubConfig(latency="uniform:100,200", failures="429:0.5", seed=7)
+        plans = [config.plan("hi") for _ in range(200)]
+        self.assertTrue(all(0.1 <= first <= 0.2 for _, first, _ in plans))
+        self.assertTrue(60 < sum(failure == 429 for failure, _, _ in plans) < 140)
+
+    def test_invalid_specs_are_rejected(self):
+        for spec in ("fixed", "uniform:1", "gamma:1,2", "normal:a,b"):
+            with self.assertRaises(ValueError):
+                parse_latency(spec)
+        for spec in ("429", "500:0.6,429:0.6"):
+            with self.assertRaises(ValueError):
+                parse_failures(spec)
+        self.assertEqual(parse_failures("429:0.1, timeout:0.2"), [(429, 0.1), ("timeout", 0.2)])
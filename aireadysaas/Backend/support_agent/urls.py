@@ -1,6 +1,36 @@
 from django.urls import path
-from .views import customer_support_agent
+from .views import (
+    chat_history_archive,
+    chat_history_detail,
+    chat_history_list,
+    customer_support_agent,
+    customer_support_agent_async,
+    customer_support_agent_batch,
+    customer_support_agent_stream,
+)
 
 urlpatterns = [
     path("ask/", customer_support_agent, name="customer_support_agent"),
+    path(
+        "ask/batch/",
+        customer_support_agent_batch,
+        name="customer_support_agent_batch",
+    ),
+    path(
+        "ask/stream/",
+        customer_support_agent_stream,
+        name="customer_support_agent_stream",
+    ),
+    path(
+        "ask/async/",
+        customer_support_agent_async,
+        name="customer_support_agent_async",
+    ),
+    path("history/", chat_history_list, name="chat_history_list"),
+    path("history/archive/", chat_history_archive, name="chat_history_archive"),
+    path(
+        "history/<uuid:chat_uuid>/",
+        chat_history_detail,
+        name="chat_history_detail",
+    ),
 ]
@@ -1,38 +1,66 @@
+import time
 import requests
-import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from django.conf import settings
-from support_agent.models import FAQ
-from rapidfuzz import process, fuzz
+from .models import ChatHistory
+from utils.metrics import observe_ttft
+from utils.tokens import PromptPart, count_static, count_tokens, fit_parts, token_ledger
+from .conversation import ANONYMOUS_USER, conversation_context
+from .deadline import Deadline, DeadlineExceeded
+from .providers import BackendError, NoBackendConfigured, provider_router
+from .faq_index import faq_index, get_faq_version
+from .knowledge import knowledge_store
+from .response_cache import response_cache, normalize_query
+from .singleflight import SingleFlight, SingleFlightTimeout
+
+SUPPORT_SYSTEM_PROMPT = (
+    "You are a friendly AI customer support agent. Provide concise, helpful answers."
+)
+NOT_CONFIGURED_MESSAGE = "Sorry, the AI service is not configured. Please contact support."
+CONNECTION_ERROR_MESSAGE = (
+    "Sorry, I'm having trouble connecting to the AI service. Please try again."
+)
+GENERIC_ERROR_MESSAGE = "I'm sorry, but I encountered an error. Please try again."
+TIMEOUT_MESSAGE = (
+    "Sorry, this is taking longer than expected. Please try again in a moment."
+)
+
+# Identical support queries in flight in this process share one pipeline run
+_inflight = SingleFlight()
+
+
+@dataclass
+class LLMResponse:
+    """Text returned to the customer plus how it was produced."""
+
+    text: str
+    cache_hit: bool = False
+    coalesced: bool = False
+    # True when a fallback (FAQ text or canned message) was returned instead
+    # of a generated answer, e.g. because the deadline passed
+    degraded: bool = False
 
 
 def search_faq(query):
     """Find the best-matching FAQ using fuzzy search (Levenshtein Distance)."""
     try:
-        # Get all FAQ entries
-        faq_list = list(FAQ.objects.values_list("question", "answer"))
+        # Served from the per-process index; rebuilt only when FAQs change
+        faq_index.ensure_loaded()
 
-        if not faq_list:
+        if not len(faq_index):
             print("🛑 No FAQs found in the database.")
             return None  # No FAQs exist
 
-        # ✅ Find the best match (fix: use fuzz.ratio correctly)
-        best_match = process.extractOne(
-            query, [faq[0] for faq in faq_list], scorer=fuzz.ratio
-        )
+        match = faq_index.search(query, threshold=60)  # 60% threshold for best match
 
-        if best_match:
-            matched_question, similarity_score = best_match[0], best_match[1]
+        if match:
+            matched_question, matched_answer, similarity_score = match
             print(
                 f"✅ Best Match Found: {matched_question} (Similarity: {similarity_score}%)"
             )
-
-            # ✅ If similarity score is high enough, return the corresponding FAQ answer
-            if similarity_score > 60:  # 60% threshold for best match
-                matched_answer = next(
-                    (faq[1] for faq in faq_list if faq[0] == matched_question), None
-                )
-                print(f"✅ Matched FAQ Answer: {matched_answer}")
-                return matched_answer
+            print(f"✅ Matched FAQ Answer: {matched_answer}")
+            return matched_answer
 
         print("🛑 No sufficiently similar FAQ found.")
         return None  # No close enough match found
@@ -42,87 +70,327 @@ def search_faq(query):
         return None
 
 
-def read_knowledge_file():
-    """Read the markdown knowledge file"""
-    knowledge_path = os.path.join(settings.BASE_DIR, "knowledge", "company_knowledge.md")
-    
-    if not os.path.exists(knowledge_path):
+def llm_provider():
+    """Return the (provider, model) pair of the primary LLM backend."""
+    backend = provider_router.primary
+    return backend.name, backend.model
+
+
+def _cache_key(query, faq_answer=None, context=None, backend=None):
+    """Response-cache key for this query (from backend, default the primary), or None."""
+    if not response_cache.enabled:
         return None
-        
+    backend = backend or provider_router.primary
+    provider, model = backend.name, backend.model
+    knowledge_version = None
+    if not faq_answer:
+        knowledge_store.ensure_loaded()
+        knowledge_version = knowledge_store.version
+    return response_cache.make_key(
+        query,
+        faq_answer,
+        provider,
+        model,
+        faq_version=get_faq_version(),
+        knowledge_version=knowledge_version,
+        context=context,
+    )
+
+
+def get_llm_response(query, faq_answer=None, context=None, deadline=None):
+    """
+    Return an LLMResponse, serving repeated questions from the response cache.
+
+    With a ``deadline`` the provider only gets the time that is left; past it
+    the response is degraded to the FAQ answer or TIMEOUT_MESSAGE.
+    """
+    key = _cache_key(query, faq_answer, context)
+    if key:
+        cached = response_cache.get(key)
+        if cached is not None:
+            print(f"⚡ LLM cache hit for Query: {query}")
+            return LLMResponse(cached, cache_hit=True)
+
+    holds_flight = False
+    if key and response_cache.shared_flights:
+        timeout = getattr(settings, "SUPPORT_SINGLEFLIGHT_TIMEOUT", 30)
+        holds_flight = response_cache.acquire_flight(key, timeout)
+        if not holds_flight:
+            # Another worker is already asking the LLM the same thing
+            wait = deadline.cap(timeout) if deadline else timeout
+            cached = response_cache.wait_for(key, wait)
+            if cached is not None:
+                print(f"🔗 Shared in-flight answer for Query: {query}")
+                return LLMResponse(cached, cache_hit=True, coalesced=True)
+
+    try:
+        answer, ok = _generate_response(query, faq_answer, context, deadline)
+        if ok and key:
+            # Fallback/error messages are never cached
+            response_cache.set(key, answer)
+    finally:
+        if holds_flight:
+            response_cache.release_flight(key)
+    return LLMResponse(answer, degraded=not ok)
+
+
+def answer_query(query, user_id=None, deadline=None):
+    """
+    Run the FAQ search + LLM pipeline for a query.
+
+    Concurrent callers with the same normalized query (and conversation
+    context, see CONVERSATION_CONTEXT) wait for the first caller's result
+    instead of each calling the provider. A waiter that times out
+    (SUPPORT_SINGLEFLIGHT_TIMEOUT) runs the pipeline itself. Every step is
+    bounded by ``deadline`` when one is given.
+    """
+    # Started before the context lookup so that counts against the budget too
+    deadline = deadline or Deadline()
+    context = conversation_context(user_id, deadline)
+
+    def run():
+        return get_llm_response(query, search_faq(query), context, deadline)
+
+    timeout = deadline.cap(getattr(settings, "SUPPORT_SINGLEFLIGHT_TIMEOUT", 30))
+    try:
+        result, shared = _inflight.do(
+            (normalize_query(query), context), run, timeout=timeout
+        )
+    except SingleFlightTimeout:
+        if deadline.expired:
+            print(f"⏱️ Deadline passed waiting for in-flight Query: {query}")
+            faq_answer = search_faq(query)
+            return LLMResponse(faq_answer or TIMEOUT_MESSAGE, degraded=True)
+        print(f"⏱️ Timed out waiting for in-flight Query: {query}. Running it directly.")
+        return run()
+    if shared:
+        print(f"🔗 Coalesced with in-flight Query: {query}")
+        return replace(result, coalesced=True)
+    return result
+
+
+def answer_batch(items, concurrency=None, save=True):
+    """
+    Answer many ``{"user_id", "query"}`` items at once.
+
+    All queries are matched against the FAQ set in one vectorized pass,
+    identical (normalized query, FAQ answer) pairs share a single LLM call,
+    the remaining calls run on at most ``concurrency`` threads
+    (SUPPORT_BATCH_CONCURRENCY), and the results are written with one
+    ``bulk_create``. Returns the ChatHistory rows in input order.
+    """
+    concurrency = concurrency or getattr(settings, "SUPPORT_BATCH_CONCURRENCY", 8)
+    queries = [str(item.get("query") or "") for item in items]
+
     try:
-        with open(knowledge_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        matches = faq_index.search_many(queries, threshold=60)
     except Exception as e:
-        print(f"Error reading knowledge file: {e}")
-        return None
+        print(f"❌ Error in batch FAQ matching: {e}")
+        matches = [None] * len(queries)
+    faq_answers = [match[1] if match else None for match in matches]
+
+    # One LLM call per distinct prompt
+    unique = {}
+    for query, faq_answer in zip(queries, faq_answers):
+        unique.setdefault((normalize_query(query), faq_answer), (query, faq_answer))
+    print(f"📦 Batch of {len(items)} queries → {len(unique)} distinct LLM prompts")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            key: executor.submit(get_llm_response, query, faq_answer)
+            for key, (query, faq_answer) in unique.items()
+        }
+        answers = {key: future.result().text for key, future in futures.items()}
+
+    entries = [
+        ChatHistory(
+            user_id=item.get("user_id", ANONYMOUS_USER),
+            question=query,
+            response=answers[(normalize_query(query), faq_answer)],
+        )
+        for item, query, faq_answer in zip(items, queries, faq_answers)
+    ]
+    if save:
+        entries = ChatHistory.objects.bulk_create(entries)
+    return entries
+
 
-def generate_response_with_llm(query, faq_answer=None):
+def generate_response_with_llm(query, faq_answer=None, context=None):
     """Use GPT-4 or Ollama to refine the FAQ answer or generate a new response."""
-    try:
-        # Always read knowledge file
-        knowledge_content = read_knowledge_file()
-        
-        if faq_answer:
-            print(f"📝 Using FAQ Answer for Query: {query} → {faq_answer}")
-            prompt = f"""You are a professional AI customer support assistant.
+    return get_llm_response(query, faq_answer, context).text
+
+
+FAQ_PROMPT = """You are a professional AI customer support assistant.
 A customer asked: '{query}'.
 Here is the correct FAQ answer: '{faq_answer}'.
 Please rewrite this answer in a polite, natural, and engaging way."""
-        elif knowledge_content:
-            print(f"📄 Using Knowledge Document for Query: {query}")
-            prompt = f"""You are a professional AI customer support assistant for our company.
+
+KNOWLEDGE_PROMPT = """You are a professional AI customer support assistant for our company.
 A customer asked: '{query}'.
 
-Here is our company knowledge base:
+Here are the relevant sections of our company knowledge base:
 {knowledge_content}
 
 Please provide a helpful, concise answer based ONLY on the information in the knowledge base above. If the information isn't in the knowledge base, politely say so."""
-        else:
-            print(f"⚠️ No FAQ or knowledge found for: {query}. Generating general response.")
-            prompt = f"""A customer asked: '{query}'.
+
+GENERAL_PROMPT = """A customer asked: '{query}'.
 No specific information exists for this question. Please generate a helpful response and offer to connect them with support."""
 
-        if settings.USE_OLLAMA:
-            print("🤖 Using Ollama...")
-            ollama_url = "http://localhost:11434/api/generate"
-            data = {"model": "mistral", "prompt": prompt}
-            response = requests.post(ollama_url, json=data).json()
-            return response["response"].strip()
-        else:
-            print("🤖 Using OpenAI...")
-            if not settings.OPENAI_API_KEY:
-                print("❌ No OpenAI API key found!")
-                return "Sorry, the AI service is not configured. Please contact support."
-                
-            openai_url = "https://api.openai.com/v1/chat/completions"
-            headers = {"Authorization": f"Bearer {settings.OPENAI_API_KEY}"}
-            data = {
-                "model": "gpt-4",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a friendly AI customer support agent. Provide concise, helpful answers.",
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                "max_tokens": 300,
-            }
-            print(f"📤 Sending request to OpenAI...")
-            response = requests.post(openai_url, json=data, headers=headers)
-            response_json = response.json()
-            
-            if response.status_code != 200:
-                print(f"❌ OpenAI Error: {response_json}")
-                return "Sorry, I'm having trouble connecting to the AI service. Please try again."
-            
-            answer = response_json["choices"][0]["message"]["content"].strip()
-            print(f"✅ Got response from OpenAI: {answer[:100]}...")
-            return answer
+CONTEXT_PROMPT = """Conversation with this customer so far:
+{context}
+
+"""
+
+
+def build_prompt(query, faq_answer=None, context=None):
+    """
+    Build the support prompt from the FAQ answer or the relevant knowledge chunks,
+    preceded by the conversation context when there is one.
+    """
+    return build_prompt_with_estimate(query, faq_answer, context)[0]
 
+
+def build_prompt_with_estimate(query, faq_answer=None, context=None):
+    """
+    build_prompt plus its estimated token count (system prompt included).
+
+    The prompt is kept within SUPPORT_PROMPT_TOKEN_BUDGET by trimming, in
+    order: knowledge chunks, older conversation context, the FAQ answer and
+    finally the query itself.
+    """
+    # Only the knowledge chunks relevant to the query, within the token budget
+    chunks = [] if faq_answer else knowledge_store.retrieve(query)
+    knowledge_content = "\n\n".join(chunk.text for chunk in chunks)
+
+    if faq_answer:
+        print(f"📝 Using FAQ Answer for Query: {query} → {faq_answer}")
+        template = FAQ_PROMPT
+    elif knowledge_content:
+        print(f"📄 Using Knowledge Document for Query: {query}")
+        template = KNOWLEDGE_PROMPT
+    else:
+        print(f"⚠️ No FAQ or knowledge found for: {query}. Generating general response.")
+        template = GENERAL_PROMPT
+    if context:
+        template = CONTEXT_PROMPT + template
+
+    _, model = llm_provider()
+    empty = template.format(query="", faq_answer="", knowledge_content="", context="")
+    overhead = count_static(SUPPORT_SYSTEM_PROMPT, model) + count_static(empty, model)
+    texts, estimated = fit_parts(
+        [
+            PromptPart("query", query, priority=3),
+            PromptPart("faq_answer", faq_answer or "", priority=2),
+            # The newest turns are at the end of the context
+            PromptPart("context", context or "", priority=1, keep="tail"),
+            PromptPart(
+                "knowledge_content",
+                knowledge_content,
+                priority=0,
+                tokens=sum(chunk.tokens for chunk in chunks) if chunks else 0,
+            ),
+        ],
+        getattr(settings, "SUPPORT_PROMPT_TOKEN_BUDGET", 3000),
+        model,
+        overhead,
+    )
+    # Drop the headers of sections that were trimmed away entirely
+    if context and not texts["context"]:
+        template = template[len(CONTEXT_PROMPT):]
+    if chunks and not texts["knowledge_content"]:
+        template = GENERAL_PROMPT
+    return template.format(**texts), estimated
+
+
+def complete_prompt(prompt, estimated_tokens=None, call="support", deadline=None):
+    """
+    Send a prompt through the provider router; returns (answer, ok). Timeouts raise.
+
+    Each backend request only gets the time left on ``deadline``
+    (LLM_HTTP_TIMEOUT without one). The estimated and provider-reported
+    prompt tokens are recorded in the token ledger under ``call``.
+    """
+    _, model = llm_provider()
+    if estimated_tokens is None:
+        estimated_tokens = count_static(SUPPORT_SYSTEM_PROMPT, model) + count_tokens(
+            prompt, model
+        )
+
+    try:
+        answer, prompt_tokens, backend = provider_router.complete(
+            prompt, SUPPORT_SYSTEM_PROMPT, deadline
+        )
+    except NoBackendConfigured:
+        print("❌ No LLM backend is configured (missing API key?)")
+        return NOT_CONFIGURED_MESSAGE, False
+    except BackendError as e:
+        print(f"❌ {e}")
+        return CONNECTION_ERROR_MESSAGE, False
+
+    if not backend.records_usage:
+        token_ledger.record(call, backend.model, estimated_tokens, prompt_tokens)
+    print(f"✅ Got response from {backend.name}: {answer[:100]}...")
+    return answer, True
+
+
+def _generate_response(query, faq_answer=None, context=None, deadline=None):
+    """Call the configured LLM; returns (answer, ok) where ok means worth caching."""
+    try:
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded("Deadline passed before the LLM call")
+        prompt, estimated = build_prompt_with_estimate(query, faq_answer, context)
+        return complete_prompt(prompt, estimated, deadline=deadline)
+    except requests.Timeout as e:
+        print(f"⏱️ LLM call ran out of time ({e}); answering with the fallback")
+        return (faq_answer if faq_answer else TIMEOUT_MESSAGE), False
     except Exception as e:
         print(f"❌ Error generating response: {e}")
-        return (
-            faq_answer
-            if faq_answer
-            else "I'm sorry, but I encountered an error. Please try again."
-        )
+        return (faq_answer if faq_answer else GENERIC_ERROR_MESSAGE), False
+
+
+def stream_llm_response(query, faq_answer=None, context=None):
+    """
+    Yield the answer as text deltas while the LLM generates it.
+
+    Cached answers are yielded in one piece. A complete streamed answer is
+    stored in the response cache; on failure before the first delta the
+    usual fallback message is yielded instead.
+    """
+    key = _cache_key(query, faq_answer, context)
+    if key:
+        cached = response_cache.get(key)
+        if cached is not None:
+            print(f"⚡ LLM cache hit for Query: {query}")
+            yield cached
+            return
+
+    parts = []
+    backend = None
+    started = time.monotonic()
+    try:
+        prompt, estimated = build_prompt_with_estimate(query, faq_answer, context)
+        # Same backends and breakers as complete_prompt; the backend is known
+        # once the first delta arrives
+        for backend, delta in provider_router.stream(prompt, SUPPORT_SYSTEM_PROMPT):
+            if not parts and not backend.records_usage:
+                # Agent backends record their own calls
+                ttft = time.monotonic() - started
+                observe_ttft(backend.name, backend.model, "support_stream", ttft)
+                # Streamed responses carry no usage block, so only the estimate is recorded
+                token_ledger.record("support_stream", backend.model, estimated)
+            parts.append(delta)
+            yield delta
+    except NoBackendConfigured:
+        print("❌ No LLM backend is configured (missing API key?)")
+        yield NOT_CONFIGURED_MESSAGE
+        return
+    except Exception as e:
+        print(f"❌ Error streaming response: {e}")
+        if not parts:
+            yield faq_answer if faq_answer else GENERIC_ERROR_MESSAGE
+        return
+
+    answer = "".join(parts).strip()
+    if answer and backend is not None and response_cache.enabled:
+        # Keyed by the backend that actually answered
+        response_cache.set(_cache_key(query, faq_answer, context, backend), answer)
@@ -1,25 +1,265 @@
+import hmac
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework import status
 from rest_framework.response import Response
-from rest_framework.decorators import api_view
-from .utils import search_faq, generate_response_with_llm
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import IsAuthenticated
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from utils.metrics import render_metrics
+from .utils import answer_batch, answer_query, search_faq, stream_llm_response
+from .async_utils import aanswer_query
+from .conversation import ANONYMOUS_USER, GUEST_PREFIX, conversation_context
+from .deadline import Deadline
+from .archive import archived_page
+from .history_writer import save_chat_history, asave_chat_history
 from .models import ChatHistory
-from .serializers import ChatHistorySerializer
+from .pagination import InvalidCursor, keyset_page
+from .serializers import ChatHistoryListSerializer, ChatHistorySerializer
+
+
+def chat_owner(user, supplied_id=None):
+    """
+    The ChatHistory.user_id to store a chat under.
+
+    Signed-in users' chats belong to their account, whatever the request
+    says. Anonymous callers keep their own id, namespaced so it can never
+    match an account's history.
+    """
+    if user.is_authenticated:
+        return str(user.pk)
+    return f"{GUEST_PREFIX}{supplied_id}" if supplied_id else ANONYMOUS_USER
 
 
 @api_view(["POST"])
 def customer_support_agent(request):
-    user_id = request.data.get("user_id", "anonymous")
+    # The whole request, LLM call included, must finish within the budget
+    deadline = Deadline.for_request()
+    user_id = chat_owner(request.user, request.data.get("user_id"))
     query = request.data.get("query", "")
 
-    # Step 1: Check if an FAQ answer exists
-    faq_answer = search_faq(query)
-
-    # Step 2: Generate a polished response using the LLM
-    response = generate_response_with_llm(query, faq_answer)
+    # Step 1 + 2: Match an FAQ and polish it with the LLM (cached and coalesced
+    # with identical in-flight queries)
+    llm_response = answer_query(query, user_id, deadline)
+    response = llm_response.text
 
     # Step 3: Save history
-    chat_entry = ChatHistory.objects.create(
-        user_id=user_id, question=query, response=response
-    )
+    chat_entry = save_chat_history(user_id, query, response, llm_response.degraded)
     serializer = ChatHistorySerializer(chat_entry)
 
-    return Response(serializer.data)
+    return Response(
+        serializer.data,
+        headers={
+            "X-LLM-Cache": "hit" if llm_response.cache_hit else "miss",
+            "X-Coalesced": "true" if llm_response.coalesced else "false",
+        },
+    )
+
+
+@api_view(["POST"])
+def customer_support_agent_batch(request):
+    """Answer a list of {user_id, query} items in one request."""
+    items = request.data.get("items")
+    if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+        return Response(
+            {"error": "items must be a list of {user_id, query} objects"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    max_items = getattr(settings, "SUPPORT_BATCH_MAX_ITEMS", 1000)
+    if len(items) > max_items:
+        return Response(
+            {"error": f"A batch can contain at most {max_items} items"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    concurrency = request.data.get("concurrency")
+    max_concurrency = getattr(settings, "SUPPORT_BATCH_CONCURRENCY", 8)
+    try:
+        concurrency = min(int(concurrency), max_concurrency) if concurrency else None
+    except (TypeError, ValueError):
+        concurrency = None
+
+    items = [
+        {**item, "user_id": chat_owner(request.user, item.get("user_id"))} for item in items
+    ]
+    entries = answer_batch(items, concurrency=concurrency)
+    return Response(ChatHistorySerializer(entries, many=True).data)
+
+
+def _sse(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@api_view(["POST"])
+def customer_support_agent_stream(request):
+    """Same pipeline as /api/ask/, but streams tokens as server-sent events."""
+    user_id = chat_owner(request.user, request.data.get("user_id"))
+    query = request.data.get("query", "")
+
+    def events():
+        faq_answer = search_faq(query)
+        context = conversation_context(user_id)
+
+        parts = []
+        for delta in stream_llm_response(query, faq_answer, context):
+            parts.append(delta)
+            yield _sse("token", {"text": delta})
+
+        # Persist the assembled answer in a single write once streaming is done
+        chat_entry = save_chat_history(user_id, query, "".join(parts).strip())
+        yield _sse("done", ChatHistorySerializer(chat_entry).data)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _jwt_user(request):
+    """The user of the request's JWT, as the DRF views see it (AnonymousUser without one)."""
+    authenticated = JWTAuthentication().authenticate(request)
+    return authenticated[0] if authenticated else AnonymousUser()
+
+
+@require_POST
+async def customer_support_agent_async(request):
+    """
+    Async variant of /api/ask/ for ASGI deployments.
+
+    DRF views are sync-only, so this is a plain Django async view: the event
+    loop is free while the LLM call is in flight, letting one process hold
+    many concurrent chats. Callers authenticate with the same JWT as the rest
+    of the API; session cookies are ignored. Being a plain Django view, it is
+    CSRF protected like any form POST.
+    """
+    deadline = Deadline.for_request()
+    try:
+        user = await sync_to_async(_jwt_user)(request)
+    except InvalidToken:
+        return JsonResponse(
+            {"error": "Your authentication token is expired. Please login again."},
+            status=401,
+        )
+    except AuthenticationFailed as e:
+        return JsonResponse({"error": str(e.detail)}, status=401)
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON body"}, status=400)
+
+    user_id = chat_owner(user, data.get("user_id"))
+    query = data.get("query", "")
+
+    llm_response = await aanswer_query(query, user_id, deadline)
+
+    chat_entry = await asave_chat_history(
+        user_id, query, llm_response.text, llm_response.degraded
+    )
+    response = JsonResponse(ChatHistorySerializer(chat_entry).data)
+    response["X-LLM-Cache"] = "hit" if llm_response.cache_hit else "miss"
+    response["X-Coalesced"] = "true" if llm_response.coalesced else "false"
+    return response
+
+
+def _page_limit(request):
+    """The ``limit`` query param, defaulted and capped by the history page size settings."""
+    default_limit = getattr(settings, "CHAT_HISTORY_PAGE_SIZE", 50)
+    max_limit = getattr(settings, "CHAT_HISTORY_MAX_PAGE_SIZE", 200)
+    try:
+        limit = int(request.query_params.get("limit", default_limit))
+    except ValueError:
+        limit = default_limit
+    return max(1, min(limit, max_limit))
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def chat_history_list(request):
+    """
+    The signed-in user's past chats, newest first, one keyset page at a time.
+
+    Query params: ``cursor`` (the ``next`` value of the previous page) and
+    ``limit``. Rows omit ``response``; fetch a single chat from
+    /api/history/<uuid>/ for the full text.
+    """
+    user_id = chat_owner(request.user)
+    limit = _page_limit(request)
+
+    queryset = ChatHistory.objects.filter(user_id=user_id).defer("response")
+    try:
+        rows, next_cursor = keyset_page(
+            queryset, request.query_params.get("cursor"), limit
+        )
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(
+        {
+            "results": ChatHistoryListSerializer(rows, many=True).data,
+            "next": next_cursor,
+        }
+    )
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def chat_history_detail(request, chat_uuid):
+    """One of the signed-in user's chat turns including its response, by uuid."""
+    try:
+        # Other users' chats are reported as missing, not forbidden
+        chat_entry = ChatHistory.objects.get(uuid=chat_uuid, user_id=chat_owner(request.user))
+    except ChatHistory.DoesNotExist:
+        return Response(
+            {"error": "Chat not found"}, status=status.HTTP_404_NOT_FOUND
+        )
+    return Response(ChatHistorySerializer(chat_entry).data)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def chat_history_archive(request):
+    """
+    The signed-in user's archived chats (moved out by archive_chat_history),
+    newest first.
+
+    Query params: ``cursor`` (the ``next`` value of the previous page) and
+    ``limit``, capped like the live history list. A page never spans two
+    archive segments, so it may hold fewer than ``limit`` rows.
+    """
+    user_id = chat_owner(request.user)
+    try:
+        rows, next_cursor = archived_page(
+            user_id, request.query_params.get("cursor"), _page_limit(request)
+        )
+    except ValueError:
+        return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({"results": rows, "next": next_cursor})
+
+
+@require_GET
+def metrics(request):
+    """
+    LLM call metrics of every worker in the Prometheus text format.
+
+    Served only when METRICS_TOKEN is set, to scrapers sending it as
+    ``Authorization: Bearer <token>``.
+    """
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if not settings.METRICS_ENABLED or not token:
+        raise Http404
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        response = HttpResponse("Invalid metrics token", status=401)
+        response["WWW-Authenticate"] = "Bearer"
+        return response
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
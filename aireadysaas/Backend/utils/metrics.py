@@ -0,0 +1,451 @@
+"""
+LLM call metrics shared by support_agent and agents, in Prometheus format.
+
+Each process keeps cheap in-memory counters and histograms. A background
+thread writes their cumulative values to a shared SQLite file every
+``METRICS_FLUSH_INTERVAL`` seconds (and at exit), one row per process and
+series, so recording a value never touches the file, even inside an async
+call. Processes are keyed by a random id, never by pid, so a recycled pid
+cannot overwrite another process's values. ``render_metrics`` only reads:
+it sums the rows of every process, so the ``/metrics`` endpoint reports the
+whole deployment (as of the last flushes) whichever worker serves it.
+
+A process that exits, or has not flushed for ``METRICS_RETIRE_AFTER``
+seconds, is retired by the flush threads: its rows are added to a single "retired" total and
+deleted, so counters never go backwards and the file does not grow with
+every restart. A retired process that turns out to be alive starts over
+under a new id with only what it counted since its last flush.
+
+Series (labels in braces):
+    llm_requests_total{provider,model,call,outcome}
+    llm_errors_total{provider,model,call,error}
+    llm_request_duration_seconds{provider,model,call}      histogram
+    llm_time_to_first_token_seconds{provider,model,call}   histogram
+    llm_prompt_tokens_total{provider,model,call}
+    llm_completion_tokens_total{provider,model,call}
+    llm_retries_total{provider,error}
+    llm_rate_limit_wait_seconds_total{provider}
+    llm_rate_limit_rejections_total{provider}
+"""
+import atexit
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+
+# Process id under which the rows of exited processes are summed
+RETIRED = "retired"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+# name -> (type, help)
+METRICS = {
+    "llm_requests_total": ("counter", "LLM calls by outcome (ok or error)"),
+    "llm_errors_total": ("counter", "Failed LLM calls by error type"),
+    "llm_request_duration_seconds": ("histogram", "LLM call latency, retries and rate-limit waits included"),
+    "llm_time_to_first_token_seconds": ("histogram", "Time to the first streamed token"),
+    "llm_prompt_tokens_total": ("counter", "Prompt tokens sent"),
+    "llm_completion_tokens_total": ("counter", "Completion tokens received"),
+    "llm_retries_total": ("counter", "Retried LLM call attempts by error type"),
+    "llm_rate_limit_wait_seconds_total": ("counter", "Time spent waiting on rate limiters"),
+    "llm_rate_limit_rejections_total": ("counter", "Calls refused by a rate limiter instead of waiting"),
+}
+
+
+def _label_key(labels):
+    return _encode_labels(tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+@lru_cache(maxsize=4096)
+def _encode_labels(pairs):
+    # Label sets repeat endlessly, so their JSON keys are cached
+    return json.dumps(pairs)
+
+
+@lru_cache(maxsize=None)
+def _bucket_fields(buckets):
+    return tuple(f"le:{bound}" for bound in buckets)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class MetricsStore:
+    """Per-process metric values, flushed to a SQLite file shared by all workers."""
+
+    def __init__(self, path, flush_interval=5.0, retire_after=600.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retire_after = retire_after
+        self._lock = threading.Lock()
+        # Flushes of one process run one at a time, so none writes stale values
+        self._flush_lock = threading.Lock()
+        self._values = {}  # (name, label key, field) -> cumulative value
+        self._flushed = {}  # the values as last written to the file
+        self._dirty = set()
+        self._pid = os.getpid()
+        self._process = uuid.uuid4().hex
+        self._registered = False
+        self._local = threading.local()
+        self._flusher_pid = None  # pid whose flush thread is running
+        self._stopped = threading.Event()
+
+    def _reset_after_fork(self):
+        # A forked worker must not re-report its parent's values
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._process = uuid.uuid4().hex
+            self._registered = False
+            self._values = {}
+            self._flushed = {}
+            self._dirty = set()
+            self._flush_lock = threading.Lock()
+            self._local = threading.local()
+
+    def inc(self, name, labels, amount=1.0):
+        key = (name, _label_key(labels), "")
+        with self._lock:
+            self._reset_after_fork()
+            self._values[key] = self._values.get(key, 0.0) + amount
+            self._dirty.add(key)
+            self._start_flusher()
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        label_key = _label_key(labels)
+        bucket_fields = _bucket_fields(buckets)
+        # Buckets are stored cumulatively, as Prometheus exposes them
+        fields = [field for bound, field in zip(buckets, bucket_fields) if value <= bound]
+        fields += ["le:+Inf", "count"]
+        with self._lock:
+            self._reset_after_fork()
+            values = self._values
+            if (name, label_key, "count") not in values:
+                # Zero-count buckets of a new series still have to be exposed
+                for field in bucket_fields:
+                    values[(name, label_key, field)] = 0.0
+            for field in fields:
+                key = (name, label_key, field)
+                values[key] = values.get(key, 0.0) + 1
+            key = (name, label_key, "sum")
+            values[key] = values.get(key, 0.0) + value
+            self._dirty.update((name, label_key, field) for field in bucket_fields)
+            self._dirty.update(((name, label_key, "le:+Inf"), (name, label_key, "count"), key))
+            self._start_flusher()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS metric_samples (process TEXT NOT NULL, "
+                "name TEXT NOT NULL, labels TEXT NOT NULL, field TEXT NOT NULL, "
+                "value REAL NOT NULL, PRIMARY KEY (process, name, labels, field))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS metric_processes (process TEXT PRIMARY KEY, "
+                "pid INTEGER NOT NULL, flushed_at REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        # IMMEDIATE: flushes and retirements of other processes are serialized
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _start_flusher(self):
+        # Called with self._lock held; threads do not survive a fork, so every
+        # process starts its own
+        if self._flusher_pid == self._pid or self._stopped.is_set():
+            return
+        self._flusher_pid = self._pid
+        threading.Thread(target=self._flush_loop, name="llm-metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        """Flush every flush_interval and retire stale processes now and then."""
+        retire_interval = max(self.flush_interval, self.retire_after / 10)
+        last_retire = time.monotonic()
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.monotonic() - last_retire >= retire_interval:
+                    last_retire = time.monotonic()
+                    self.retire()
+            except Exception as e:
+                print(f"⚠️ LLM metrics flush thread error: {e}")
+
+    def flush(self):
+        """Write this process's changed values to the shared file."""
+        with self._lock:
+            self._reset_after_fork()
+        with self._flush_lock:
+            if self._flush_once():
+                print("♻️ LLM metrics of this process were retired; continuing under a new id")
+                self._flush_once()
+
+    def _flush_once(self):
+        """One flush; True if this process turned out to be retired and restarted."""
+        with self._lock:
+            self._reset_after_fork()
+            process, registered = self._process, self._registered
+            if not registered and not self._dirty:
+                return False  # nothing to report yet
+            dirty, self._dirty = self._dirty, set()
+            rows = {key: self._values[key] for key in dirty}
+        try:
+            with self._transaction() as connection:
+                if registered and not connection.execute(
+                    "SELECT 1 FROM metric_processes WHERE process = ?", (process,)
+                ).fetchone():
+                    retired = True
+                else:
+                    retired = False
+                    connection.execute(
+                        "INSERT OR REPLACE INTO metric_processes (process, pid, flushed_at) "
+                        "VALUES (?, ?, ?)",
+                        (process, self._pid, time.time()),
+                    )
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO metric_samples "
+                        "(process, name, labels, field, value) VALUES (?, ?, ?, ?, ?)",
+                        [(process, *key, value) for key, value in rows.items()],
+                    )
+        except sqlite3.Error as e:
+            with self._lock:
+                self._dirty |= dirty
+            print(f"⚠️ Could not flush LLM metrics: {e}")
+            return False
+
+        with self._lock:
+            if process != self._process:
+                return False  # forked meanwhile; the child starts from scratch
+            if retired:
+                self._restart()
+            else:
+                self._registered = True
+                self._flushed.update(rows)
+        return retired
+
+    def _restart(self):
+        """Continue under a new id with only what was counted since the last flush."""
+        # The retired total already holds everything that was flushed
+        self._values = {
+            key: value - self._flushed.get(key, 0.0) for key, value in self._values.items()
+        }
+        self._flushed = {}
+        self._dirty = set(self._values)
+        self._process = uuid.uuid4().hex
+        self._registered = False
+
+    def retire(self, processes=None):
+        """
+        Fold the rows of processes into the retired total and delete them.
+
+        Without ``processes``, retires every process that has not flushed for
+        ``retire_after`` seconds. Returns how many processes were retired.
+        """
+        try:
+            with self._transaction() as connection:
+                if processes is None:
+                    processes = [
+                        row[0]
+                        for row in connection.execute(
+                            "SELECT process FROM metric_processes WHERE flushed_at < ?",
+                            (time.time() - self.retire_after,),
+                        )
+                    ]
+                for process in processes:
+                    connection.execute(
+                        "INSERT INTO metric_samples (process, name, labels, field, value) "
+                        "SELECT ?, name, labels, field, value FROM metric_samples "
+                        "WHERE process = ? "
+                        "ON CONFLICT (process, name, labels, field) "
+                        "DO UPDATE SET value = value + excluded.value",
+                        (RETIRED, process),
+                    )
+                    connection.execute("DELETE FROM metric_samples WHERE process = ?", (process,))
+                    connection.execute(
+                        "DELETE FROM metric_processes WHERE process = ?", (process,)
+                    )
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not retire LLM metrics: {e}")
+            return 0
+        return len(processes)
+
+    def close(self):
+        """Stop the flush thread, then flush and retire this process (at exit)."""
+        self._stopped.set()
+        with self._flush_lock:
+            if self._flush_once():
+                self._flush_once()
+            with self._lock:
+                process = self._process
+                self._restart()
+            self.retire([process])
+
+    def collect(self):
+        """
+        Values summed over every process: {(name, label key, field): value}.
+
+        Read-only: values are as of each process's last flush.
+        """
+        rows = self._connection().execute(
+            "SELECT name, labels, field, SUM(value) FROM metric_samples "
+            "GROUP BY name, labels, field"
+        ).fetchall()
+        return {(name, labels, field): value for name, labels, field, value in rows}
+
+    def render(self):
+        """The Prometheus text exposition of every process's metrics."""
+        series = {}
+        for (name, labels, field), value in self.collect().items():
+            series.setdefault(name, {}).setdefault(labels, {})[field] = value
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, fields in sorted(series.get(name, {}).items()):
+                pairs = [tuple(pair) for pair in json.loads(labels)]
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(pairs)} {_format_value(fields.get('', 0.0))}")
+                    continue
+                bounds = sorted(
+                    (field[3:] for field in fields if field.startswith("le:") and field != "le:+Inf"),
+                    key=float,
+                )
+                for bound in bounds + ["+Inf"]:
+                    lines.append(
+                        f"{name}_bucket{_format_labels(pairs + [('le', bound)])} "
+                        f"{_format_value(fields.get('le:' + bound, 0.0))}"
+                    )
+                lines.append(f"{name}_sum{_format_labels(pairs)} {_format_value(fields.get('sum', 0.0))}")
+                lines.append(f"{name}_count{_format_labels(pairs)} {_format_value(fields.get('count', 0.0))}")
+        return "\n".join(lines) + "\n"
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_metrics_store():
+    """The shared MetricsStore configured from settings."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MetricsStore(
+                    getattr(settings, "METRICS_PATH", "")
+                    or os.path.join(tempfile.gettempdir(), "llm_metrics.sqlite3"),
+                    getattr(settings, "METRICS_FLUSH_INTERVAL", 5.0),
+                    getattr(settings, "METRICS_RETIRE_AFTER", 600.0),
+                )
+                atexit.register(_store.close)
+    return _store
+
+
+def _enabled():
+    return getattr(settings, "METRICS_ENABLED", True)
+
+
+def observe_llm_call(provider, model, call, seconds, error=None):
+    """Record one LLM call's latency and outcome."""
+    if not _enabled():
+        return
+    store = get_metrics_store()
+    labels = {"provider": provider, "model": model, "call": call}
+    store.observe("llm_request_duration_seconds", labels, seconds)
+    store.inc("llm_requests_total", {**labels, "outcome": "error" if error else "ok"})
+    if error is not None:
+        store.inc("llm_errors_total", {**labels, "error": type(error).__name__})
+
+
+def observe_llm_tokens(provider, model, call, prompt_tokens=None, completion_tokens=None):
+    """Record the tokens an LLM call used (None when the provider did not say)."""
+    if not _enabled():
+        return
+    store = get_metrics_store()
+    labels = {"provider": provider, "model": model, "call": call}
+    if prompt_tokens is not None:
+        store.inc("llm_prompt_tokens_total", labels, prompt_tokens)
+    if completion_tokens is not None:
+        store.inc("llm_completion_tokens_total", labels, completion_tokens)
+
+
+def observe_ttft(provider, model, call, seconds):
+    """Record a stream's time to first token."""
+    if _enabled():
+        get_metrics_store().observe(
+            "llm_time_to_first_token_seconds",
+            {"provider": provider, "model": model, "call": call},
+            seconds,
+        )
+
+
+def observe_retry(provider, error):
+    """Record a retried attempt."""
+    if _enabled():
+        get_metrics_store().inc(
+            "llm_retries_total", {"provider": provider, "error": type(error).__name__}
+        )
+
+
+def observe_rate_limit(provider, waited=0.0, rejected=False):
+    """Record time spent waiting on a rate limiter, or a non-blocking rejection."""
+    if not _enabled():
+        return
+    store = get_metrics_store()
+    if waited:
+        store.inc("llm_rate_limit_wait_seconds_total", {"provider": provider}, waited)
+    if rejected:
+        store.inc("llm_rate_limit_rejections_total", {"provider": provider})
+
+
+@contextmanager
+def llm_call(provider, model, call):
+    """
+    Time an LLM call; failures are recorded with their error type.
+
+    Usage::
+
+        with llm_call("claude", model, "claude_dev"):
+            response = client.messages.create(...)
+    """
+    started = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        observe_llm_call(provider, model, call, time.monotonic() - started, e)
+        raise
+    observe_llm_call(provider, model, call, time.monotonic() - started)
+
+
+def render_metrics():
+    """Prometheus text for every worker's LLM metrics."""
+    return get_metrics_store().render()
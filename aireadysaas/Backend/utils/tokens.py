@@ -0,0 +1,200 @@
+"""
+Prompt token counting and budgets shared by support_agent and agents.
+
+Counts use ``tiktoken`` when it is installed (OpenAI models) and otherwise a
+characters-per-token estimate for the model family. Static text such as
+system prompts and prompt templates is counted once per model through
+``count_static``; per-call text goes through ``count_tokens``.
+
+``fit_parts`` enforces a per-call budget: when the prompt is too large, the
+lowest-priority part is trimmed (or dropped) first. ``token_ledger`` records
+the estimated and, when the provider reports it, the actual prompt tokens of
+every call.
+"""
+import threading
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # optional; fall back to the character estimate
+    tiktoken = None
+
+# Average characters per token by model family (English text)
+CHARS_PER_TOKEN = {"claude": 3.5, "gpt": 4.0, "mistral": 3.8}
+DEFAULT_CHARS_PER_TOKEN = 4.0
+
+# Context windows (prompt + completion) of the models used in this project
+MODEL_CONTEXT_WINDOWS = {
+    "claude-3-opus-20240229": 200_000,
+    "claude-3-sonnet-20240229": 200_000,
+    "gpt-4": 8_192,
+    "gpt-4-turbo": 128_000,
+    "gpt-3.5-turbo": 16_385,
+    "mistral": 32_768,
+}
+
+TRUNCATION_MARK = "…"
+
+
+@lru_cache(maxsize=32)
+def _encoding(model):
+    if tiktoken is None or not model or not model.startswith("gpt"):
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _chars_per_token(model):
+    for family, ratio in CHARS_PER_TOKEN.items():
+        if model and model.startswith(family):
+            return ratio
+    return DEFAULT_CHARS_PER_TOKEN
+
+
+def count_tokens(text, model=None):
+    """Number of prompt tokens text costs on model (exact with tiktoken, else estimated)."""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return max(1, round(len(text) / _chars_per_token(model)))
+
+
+@lru_cache(maxsize=4096)
+def count_static(text, model=None):
+    """count_tokens for text that repeats across calls (system prompts, templates)."""
+    return count_tokens(text, model)
+
+
+def truncate_tokens(text, max_tokens, model=None, keep="head"):
+    """Cut text to about max_tokens, keeping its start ("head") or its end ("tail")."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+
+    encoding = _encoding(model)
+    if encoding is not None:
+        ids = encoding.encode(text)
+        ids = ids[:max_tokens] if keep == "head" else ids[-max_tokens:]
+        kept = encoding.decode(ids)
+    else:
+        chars = int(max_tokens * _chars_per_token(model))
+        kept = text[:chars] if keep == "head" else text[-chars:]
+    return kept.rstrip() + TRUNCATION_MARK if keep == "head" else TRUNCATION_MARK + kept.lstrip()
+
+
+def prompt_budget(model, max_tokens=0, budget=None):
+    """The prompt budget for a call: explicit, else the context window minus max_tokens."""
+    if budget:
+        return budget
+    window = MODEL_CONTEXT_WINDOWS.get(model)
+    return window - max_tokens if window else None
+
+
+@dataclass
+class PromptPart:
+    """One named piece of a prompt; lower priority is trimmed first."""
+
+    name: str
+    text: str
+    priority: int = 0
+    keep: str = "head"
+    tokens: int = None  # precomputed count (e.g. cached knowledge chunks)
+
+
+def fit_parts(parts, budget, model=None, overhead=0):
+    """
+    Trim parts until overhead plus their tokens fits in budget.
+
+    ``overhead`` is the (static) cost of everything around the parts, such as
+    the system prompt and template. Returns ``(texts, estimated)`` where
+    texts maps each part name to its possibly trimmed text.
+    """
+    counts = {
+        part.name: part.tokens if part.tokens is not None else count_tokens(part.text, model)
+        for part in parts
+    }
+    texts = {part.name: part.text for part in parts}
+    total = overhead + sum(counts.values())
+    if not budget or total <= budget:
+        return texts, total
+
+    # Lowest priority first; among equals, later parts go first
+    order = sorted(enumerate(parts), key=lambda item: (item[1].priority, -item[0]))
+    for _, part in order:
+        over = total - budget
+        if over <= 0:
+            break
+        if not counts[part.name]:
+            continue
+        keep_tokens = counts[part.name] - over
+        trimmed = truncate_tokens(part.text, keep_tokens, model, part.keep) if keep_tokens > 0 else ""
+        new_count = count_tokens(trimmed, model)
+        print(
+            f"✂️ Trimmed prompt part '{part.name}' from {counts[part.name]} to "
+            f"{new_count} tokens to fit a {budget}-token budget"
+        )
+        total -= counts[part.name] - new_count
+        counts[part.name] = new_count
+        texts[part.name] = trimmed
+    return texts, total
+
+
+def fit_prompt(system_prompt, prompt, model, max_tokens=0, budget=None):
+    """
+    Join an agent's system prompt and user prompt within the model's budget.
+
+    The system prompt is static (counted once per model) and never trimmed;
+    the user prompt is cut from the end if needed. Returns
+    ``(full_prompt, estimated_tokens)``.
+    """
+    budget = prompt_budget(model, max_tokens, budget)
+    overhead = count_static(system_prompt, model) + 1  # +1 for the separator
+    texts, estimated = fit_parts([PromptPart("prompt", prompt)], budget, model, overhead)
+    return f"{system_prompt}\n\n{texts['prompt']}", estimated
+
+
+class TokenLedger:
+    """Per-process record of estimated vs. actual prompt tokens per call site."""
+
+    def __init__(self, recent=200):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=recent)
+        self._totals = defaultdict(
+            lambda: {"calls": 0, "estimated": 0, "actual": 0, "measured_calls": 0}
+        )
+
+    def record(self, call, model, estimated, actual=None):
+        with self._lock:
+            self._recent.append(
+                {"call": call, "model": model, "estimated": estimated, "actual": actual}
+            )
+            totals = self._totals[call]
+            totals["calls"] += 1
+            totals["estimated"] += estimated or 0
+            if actual is not None:
+                totals["actual"] += actual
+                totals["measured_calls"] += 1
+        if actual is not None:
+            print(f"🔢 {call} ({model}): estimated {estimated} / actual {actual} prompt tokens")
+        else:
+            print(f"🔢 {call} ({model}): estimated {estimated} prompt tokens")
+
+    def recent(self):
+        with self._lock:
+            return list(self._recent)
+
+    def stats(self):
+        with self._lock:
+            return {call: dict(totals) for call, totals in self._totals.items()}
+
+
+# Shared per-process ledger
+token_ledger = TokenLedger()
+